@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Union
+
+import numpy as np
+from langchain_core.documents import Document
+
+
+class AnswerCache:
+    """
+    Persistent cache of answers in front of the RetrievalQA chain.
+    Exact repeats of a normalized question hit directly, near-duplicates hit when
+    the cosine similarity of their query embeddings reaches the threshold.
+    Entries are dropped when the ingestion manifest, or the manifest of any shard,
+    or the configuration changes, and evicted by least recent use and age.
+    """
+
+    def __init__(self, path: str, manifest_path: Union[str, List[str]], config: str, embed_query: Callable[[str], List[float]],
+                 similarity: float = 0.95, max_entries: int = 1000, ttl_seconds: float = 7 * 24 * 3600):
+        self.manifest_paths = [manifest_path] if isinstance(manifest_path, str) else list(manifest_path)
+        self.config = config
+        self.embed_query = embed_query
+        self.similarity = similarity
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.manifest_version = None
+        self.version = None
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS answers (query TEXT PRIMARY KEY, embedding BLOB, result TEXT NOT NULL, "
+                        "sources TEXT, version TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)")
+        self.db.commit()
+        self.refresh()
+
+    def refresh(self) -> None:
+        """Invalidate the entries of a previous corpus or configuration and expired entries."""
+        # docs_loader.py only rewrites the manifest when the ingested documents changed
+        versions = []
+        for manifest_path in self.manifest_paths:
+            try:
+                stat_result = os.stat(manifest_path)
+                versions.append(f"{stat_result.st_size}:{stat_result.st_mtime_ns}")
+            except OSError:
+                versions.append("")
+        manifest_version = ",".join(versions)
+        if manifest_version == self.manifest_version:
+            return
+        self.manifest_version = manifest_version
+        self.version = hashlib.sha256(f"{manifest_version}|{self.config}".encode('utf-8')).hexdigest()
+        self.db.execute("DELETE FROM answers WHERE version != ? OR created < ?", (self.version, time.time() - self.ttl_seconds))
+        self.db.commit()
+        self.load_embeddings()
+
+    def load_embeddings(self) -> None:
+        rows = self.db.execute("SELECT query, embedding FROM answers WHERE embedding IS NOT NULL").fetchall()
+        self.queries = [query for query, _ in rows]
+        self.embeddings = np.array([np.frombuffer(blob, dtype=np.float32) for _, blob in rows]) if rows else None
+
+    def normalize(self, vector: List[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, query: str, need_sources: bool = True):
+        """Return the cached result and the kind of hit, or None and the query embedding to store later."""
+        now = time.time()
+        with self.lock:
+            self.refresh()
+            row = self.db.execute("SELECT query, result, sources FROM answers WHERE query = ? AND created >= ?",
+                                  (query, now - self.ttl_seconds)).fetchone()
+            search = row is None and self.similarity < 1 and self.embeddings is not None
+        hit = "exact" if row else None
+
+        embedding = None
+        if search:
+            # Embed outside the lock, concurrent server sessions must not wait on each other
+            embedding = self.normalize(self.embed_query(query))
+            with self.lock:
+                if self.embeddings is not None:
+                    scores = self.embeddings @ embedding
+                    best = int(np.argmax(scores))
+                    if scores[best] >= self.similarity:
+                        row = self.db.execute("SELECT query, result, sources FROM answers WHERE query = ? AND created >= ?",
+                                              (self.queries[best], now - self.ttl_seconds)).fetchone()
+                        hit = "similar" if row else None
+
+        if row is None or (need_sources and row[2] is None):
+            return None, embedding
+        with self.lock:
+            self.db.execute("UPDATE answers SET last_used = ? WHERE query = ?", (now, row[0]))
+            self.db.commit()
+
+        result = {"query": query, "result": row[1], "cache_hit": hit}
+        if row[2] is not None:
+            result["source_documents"] = [Document(page_content=source["page_content"], metadata=source["metadata"])
+                                          for source in json.loads(row[2])]
+        return result, embedding
+
+    def store(self, query: str, result: Dict, embedding: Optional[np.ndarray] = None) -> None:
+        if self.max_entries <= 0:
+            return
+        if embedding is None and self.similarity < 1:
+            embedding = self.normalize(self.embed_query(query))
+        sources = None
+        if 'source_documents' in result:
+            sources = json.dumps([{"page_content": document.page_content, "metadata": document.metadata}
+                                  for document in result['source_documents']])
+        with self.lock:
+            now = time.time()
+            self.db.execute("INSERT OR REPLACE INTO answers (query, embedding, result, sources, version, created, last_used) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (query, embedding.astype(np.float32).tobytes() if embedding is not None else None,
+                             result['result'], sources, self.version, now, now))
+            # Keep the most recently used entries
+            self.db.execute("DELETE FROM answers WHERE query NOT IN (SELECT query FROM answers ORDER BY last_used DESC LIMIT ?)",
+                            (self.max_entries,))
+            self.db.commit()
+            self.load_embeddings()
+
+
+class CachedQA:
+    """RetrievalQA chain behind an answer cache, cached results carry the kind of hit in 'cache_hit'."""
+
+    def __init__(self, qa, cache: AnswerCache):
+        self.qa = qa
+        self.cache = cache
+
+    def invoke(self, query: str, config: Optional[Dict] = None) -> Dict:
+        result, embedding = self.cache.lookup(query, need_sources=self.qa.return_source_documents)
+        if result is None:
+            result = self.qa.invoke(query, config=config)
+            try:
+                self.cache.store(query, result, embedding)
+            except Exception as e:
+                logging.warning(f"Failed to cache the answer: {e}")
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.qa, name)
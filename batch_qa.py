@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Set, Tuple
+
+from langchain_core.embeddings import Embeddings
+
+
+class PrecomputedQueryEmbeddings(Embeddings):
+    """
+    Serve the query embeddings computed ahead by one batched encoder call,
+    other texts are embedded by the model as usual.
+    """
+
+    def __init__(self, embeddings: Embeddings):
+        self.embeddings = embeddings
+        self.vectors: Dict[str, List[float]] = {}
+
+    def precompute(self, queries: List[str]) -> None:
+        queries = [query for query in dict.fromkeys(queries) if query not in self.vectors]
+        if queries:
+            self.vectors.update(zip(queries, self.embeddings.embed_documents(queries)))
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = self.vectors.get(text)
+        return vector if vector is not None else self.embeddings.embed_query(text)
+
+
+def read_questions(path: str) -> List[str]:
+    """Questions from a file, or stdin for "-", one per line. Blank lines and # comments are skipped."""
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        # Normalized like the interactive questions
+        return [line.strip().lower() for line in f if line.strip() and not line.lstrip().startswith("#")]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def load_completed(path: str) -> Set[Tuple[int, str]]:
+    """
+    The (id, question) of the answers already in the output file. A last line cut
+    by an interrupted run is removed, failed questions are asked again.
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+            data = data[:data.rfind(b"\n") + 1]
+    completed = set()
+    for line in data.decode("utf-8").splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if "error" not in record:
+            completed.add((record["id"], record["question"]))
+    return completed
+
+
+class BatchRunner:
+    """
+    Answer a list of questions without interaction. The query embeddings are computed
+    in one batch, the retrievals run in parallel, at most `concurrency` answers are
+    generated by Ollama at a time and every answer is appended to a JSON-lines file
+    as soon as it is complete.
+    """
+
+    def __init__(self, qa, stream_answer: Callable, output_path: str, concurrency: int = 4,
+                 search_workers: int = 0, hide_source: bool = False):
+        self.qa = qa
+        self.stream_answer = stream_answer
+        self.output_path = output_path
+        self.concurrency = max(1, concurrency)
+        self.search_workers = search_workers or os.cpu_count() or 1
+        self.hide_source = hide_source
+        self.lock = threading.Lock()
+        self.answered = 0
+        self.failed = 0
+        self.total = 0
+
+    def retrieve(self, query: str):
+        """Run a question up to its sources, the generator is resumed by an LLM worker."""
+        start = time.time()
+        answer = self.stream_answer(self.qa, query)
+        _, documents = next(answer)
+        return answer, documents, time.time() - start, time.time()
+
+    def generate(self, output, question_id: int, query: str, retrieved) -> None:
+        start = time.time()
+        record = {"id": question_id, "question": query}
+        try:
+            answer, documents, search_seconds, retrieved_at = retrieved.result()
+            tokens = []
+            stats = {}
+            for event, data in answer:
+                if event == "token":
+                    tokens.append(data)
+                elif event == "done":
+                    stats = data
+            record["answer"] = "".join(tokens)
+            if not self.hide_source:
+                record["sources"] = [{"source": document.metadata['source'], "content": document.page_content}
+                                     for document in documents]
+            record["timings"] = {"search_seconds": search_seconds,
+                                 "llm_wait_seconds": start - retrieved_at,
+                                 "rerank_seconds": stats.get("rerank_seconds"),
+                                 "prompt_tokens": stats.get("prompt_tokens"),
+                                 "generation_seconds": time.time() - start,
+                                 "tokens": stats.get("tokens"),
+                                 "tokens_per_second": stats.get("tokens_per_second"),
+                                 "cache_hit": stats.get("cache_hit")}
+        except Exception as e:
+            logging.error(f"Error processing query: {e}")
+            record["error"] = str(e)
+        with self.lock:
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+            if "error" in record:
+                self.failed += 1
+            else:
+                self.answered += 1
+            print(f"[{self.answered + self.failed}/{self.total}] {query}"
+                  f"{' failed' if 'error' in record else ''} ({time.time() - start:.2f}s)", file=sys.stderr)
+
+    def run(self, questions: List[str], embeddings: PrecomputedQueryEmbeddings = None) -> None:
+        completed = load_completed(self.output_path)
+        pending = [(i, query) for i, query in enumerate(questions) if (i, query) not in completed]
+        self.total = len(pending)
+        if completed:
+            print(f"Resuming, {len(questions) - len(pending)} of {len(questions)} questions already answered in {self.output_path}")
+        if not pending:
+            return
+        start = time.time()
+        if embeddings is not None:
+            embeddings.precompute([query for _, query in pending])
+            print(f"Embedded {len(pending)} questions in {time.time() - start:.2f}s")
+
+        search_pool = ThreadPoolExecutor(max_workers=self.search_workers, thread_name_prefix="vaultchat-search")
+        llm_pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="vaultchat-llm")
+        try:
+            with open(self.output_path, "a", encoding="utf-8") as output:
+                searches = {search_pool.submit(self.retrieve, query): (i, query) for i, query in pending}
+                # Questions reach the LLM workers in the order their retrieval completes
+                generations = [llm_pool.submit(self.generate, output, *searches[future], future)
+                               for future in as_completed(searches)]
+                for future in generations:
+                    future.result()
+        except KeyboardInterrupt:
+            search_pool.shutdown(wait=False, cancel_futures=True)
+            llm_pool.shutdown(wait=False, cancel_futures=True)
+            print(f"\nInterrupted, run the same command again to resume from {self.output_path}")
+            raise
+        finally:
+            search_pool.shutdown()
+            llm_pool.shutdown()
+        elapsed = time.time() - start
+        print(f"Answered {self.answered} questions in {elapsed:.2f}s ({self.answered / max(elapsed, 1e-6):.2f} questions/sec), "
+              f"{self.failed} failed, answers in {self.output_path}")
+
+
+def run_batch(qa, stream_answer: Callable, embeddings: PrecomputedQueryEmbeddings, questions_path: str,
+              output_path: str, concurrency: int, hide_source: bool = False) -> None:
+    questions = read_questions(questions_path)
+    if not questions:
+        print(f"No questions found in {questions_path}")
+        return
+    BatchRunner(qa, stream_answer, output_path, concurrency, hide_source=hide_source).run(questions, embeddings)
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+import re
+import json
+import logging
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from langchain_core.documents import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+HEADING = re.compile(r"^(#{1,6})\s+(\S.*?)\s*#*\s*$")
+FENCE = re.compile(r"^\s*(```|~~~)")
+TABLE_ROW = re.compile(r"^\s*\|")
+
+# Special tokens added by the tokenizer around every chunk, [CLS] and [SEP] for BERT models
+SPECIAL_TOKENS = 2
+
+
+class TokenCounter:
+    """
+    Count tokens with the tokenizer of the embedding model, the texts of a call
+    are tokenized as one batch and their counts cached. Without the tokenizer,
+    about 4 characters per token are assumed. The tokenizer is read from the local
+    Hugging Face cache first, and only downloaded when local_files_only is False.
+    """
+
+    def __init__(self, model_name: str, max_cached: int = 100000, local_files_only: bool = False):
+        self.model_name = model_name
+        self.max_cached = max_cached
+        self.local_files_only = local_files_only
+        self.cache: "OrderedDict[str, int]" = OrderedDict()
+        self.tokenizer = None
+        self.max_sequence_length = None
+        try:
+            from transformers import AutoTokenizer
+            self.tokenizer = self.from_hub(lambda local_files_only: AutoTokenizer.from_pretrained(model_name, local_files_only=local_files_only))
+            self.max_sequence_length = self.load_max_sequence_length()
+        except Exception as e:
+            logging.warning(f"Tokenizer of {model_name} unavailable, chunk sizes are estimated: {e}")
+
+    def from_hub(self, load):
+        """Load from the local cache, then from the Hub unless local_files_only, so cached models need no network."""
+        try:
+            return load(True)
+        except Exception:
+            if self.local_files_only:
+                raise
+            return load(False)
+
+    def load_max_sequence_length(self) -> Optional[int]:
+        # sentence-transformers models truncate at their own max_seq_length, often below the tokenizer limit
+        try:
+            from huggingface_hub import hf_hub_download
+            config_path = self.from_hub(lambda local_files_only: hf_hub_download(self.model_name, 'sentence_bert_config.json',
+                                                                                 local_files_only=local_files_only))
+            with open(config_path, encoding='utf-8') as f:
+                return int(json.load(f)['max_seq_length'])
+        except Exception:
+            model_max_length = getattr(self.tokenizer, 'model_max_length', None)
+            return model_max_length if model_max_length and model_max_length < 100000 else None
+
+    def count_many(self, texts: List[str]) -> List[int]:
+        missing = list(dict.fromkeys(text for text in texts if text not in self.cache))
+        if missing:
+            if self.tokenizer is not None:
+                counts = [len(ids) for ids in self.tokenizer(missing, add_special_tokens=False)['input_ids']]
+            else:
+                counts = [len(text) // 4 + 1 for text in missing]
+            for text, count in zip(missing, counts):
+                self.cache[text] = count
+            while len(self.cache) > self.max_cached:
+                self.cache.popitem(last=False)
+        return [self.cache[text] for text in texts]
+
+    def count(self, text: str) -> int:
+        return self.count_many([text])[0]
+
+
+class Block:
+    """A heading, paragraph, table or code block, located by its offsets in the document text."""
+
+    def __init__(self, kind: str, start: int, end: int, headings: Tuple[str, ...]):
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.headings = headings
+
+
+def table_header(table: str) -> str:
+    """The header row and delimiter row of a markdown table, if it has them."""
+    rows = table.splitlines(keepends=True)
+    return "".join(rows[:2]) if len(rows) > 2 and set(rows[1].strip()) <= set("|-: ") else ""
+
+
+def parse_blocks(text: str) -> List[Block]:
+    """Split markdown or plain text into headings, paragraphs, tables and fenced code blocks."""
+    blocks: List[Block] = []
+    headings: List[Tuple[int, str]] = []
+    lines = text.splitlines(keepends=True)
+    offset = 0
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        start = offset
+        if not line.strip():
+            offset += len(line)
+            i += 1
+            continue
+        heading = HEADING.match(line)
+        if heading:
+            level = len(heading.group(1))
+            headings = [(lvl, title) for lvl, title in headings if lvl < level] + [(level, heading.group(2))]
+            offset += len(line)
+            i += 1
+            blocks.append(Block("heading", start, offset, tuple(title for _, title in headings)))
+            continue
+        if FENCE.match(line):
+            fence = FENCE.match(line).group(1)
+            offset += len(line)
+            i += 1
+            while i < len(lines):
+                offset += len(lines[i])
+                i += 1
+                if lines[i - 1].strip().startswith(fence):
+                    break
+            kind = "code"
+        elif TABLE_ROW.match(line):
+            while i < len(lines) and TABLE_ROW.match(lines[i]):
+                offset += len(lines[i])
+                i += 1
+            kind = "table"
+        else:
+            # A paragraph runs until a blank line or the start of another kind of block
+            offset += len(line)
+            i += 1
+            while i < len(lines) and lines[i].strip() and not (
+                    HEADING.match(lines[i]) or FENCE.match(lines[i]) or TABLE_ROW.match(lines[i])):
+                offset += len(lines[i])
+                i += 1
+            kind = "paragraph"
+        blocks.append(Block(kind, start, offset, tuple(title for _, title in headings)))
+    # Trailing newlines are not part of a block
+    for block in blocks:
+        block.end = block.start + len(text[block.start:block.end].rstrip())
+    return blocks
+
+
+class StructuredChunker:
+    """
+    Split documents into chunks of at most max_tokens tokens of the embedding model.
+    Chunks follow the markdown structure: a heading starts a new chunk, paragraphs,
+    tables and code blocks are packed whole while they fit, and only a block larger
+    than a chunk is split, tables by rows with their header repeated. A chunk that
+    continues the section of the previous one starts with up to chunk_overlap tokens
+    of its last paragraph. Each chunk records its heading path and its start index
+    in the document, and the length of the repeated table header it starts with.
+    """
+
+    def __init__(self, model_name: str, chunk_size: int, chunk_overlap: int, local_files_only: bool = False):
+        self.counter = TokenCounter(model_name, local_files_only=local_files_only)
+        max_tokens = chunk_size
+        if self.counter.max_sequence_length:
+            # Longer chunks would be truncated by the embedding model
+            max_tokens = min(max_tokens, self.counter.max_sequence_length - SPECIAL_TOKENS)
+        self.max_tokens = max(16, max_tokens)
+        self.chunk_overlap = max(0, min(chunk_overlap, self.max_tokens // 2))
+        self.splitter = RecursiveCharacterTextSplitter(chunk_size=self.max_tokens, chunk_overlap=self.chunk_overlap,
+                                                       length_function=self.counter.count)
+
+    def overlap(self, text: str, block: Block) -> Tuple[Optional[int], int]:
+        """Start and tokens of the last words of a paragraph that fit in chunk_overlap tokens."""
+        start, tokens = None, 0
+        if not self.chunk_overlap or block.kind != "paragraph":
+            return start, tokens
+        for word in reversed(list(re.finditer(r"\S+", text[block.start:block.end]))):
+            word_start = block.start + word.start()
+            word_tokens = self.counter.count(text[word_start:block.end])
+            if word_tokens > self.chunk_overlap:
+                break
+            start, tokens = word_start, word_tokens
+        return start, tokens
+
+    def split_large_block(self, text: str, block: Block) -> List[Tuple[int, int]]:
+        """Offsets of the pieces of a block longer than a chunk."""
+        content = text[block.start:block.end]
+        if block.kind == "table":
+            rows = content.splitlines(keepends=True)
+            header = table_header(content)
+            counts = self.counter.count_many(rows)
+            header_tokens = self.counter.count(header) if header else 0
+            pieces = []
+            piece_start, piece_tokens, piece_rows = 0, header_tokens, 0
+            position = len(header)
+            for row, row_tokens in zip(rows[2:] if header else rows, counts[2:] if header else counts):
+                if piece_tokens + row_tokens > self.max_tokens and piece_rows:
+                    pieces.append((piece_start, position))
+                    piece_start, piece_tokens, piece_rows = position, header_tokens, 0
+                piece_tokens += row_tokens
+                piece_rows += 1
+                position += len(row)
+            pieces.append((piece_start, position))
+            # Every piece but the first gets the header prepended when the chunk is built
+            return [(block.start + start, block.start + start + len(content[start:end].rstrip())) for start, end in pieces]
+        pieces = []
+        search_from = 0
+        for piece in self.splitter.split_text(content):
+            index = content.find(piece, search_from)
+            index = search_from if index < 0 else index
+            pieces.append((block.start + index, block.start + index + len(piece)))
+            search_from = index + 1
+        return pieces
+
+    def split_text(self, text: str) -> List[Tuple[int, int, Tuple[str, ...], str]]:
+        """Return the (start, end, heading path, prefix) of each chunk of a text."""
+        blocks = parse_blocks(text)
+        counts = self.counter.count_many([text[block.start:block.end] for block in blocks])
+        chunks = []
+        current: List[Block] = []
+        current_tokens = 0
+        # Start and tokens of the end of the previous chunk repeated by the next one
+        overlap_start, overlap_tokens = None, 0
+
+        def flush(overlap: bool = False):
+            nonlocal current, current_tokens, overlap_start, overlap_tokens
+            if current:
+                start = current[0].start if overlap_start is None else overlap_start
+                chunks.append((start, current[-1].end, current[0].headings, ""))
+            overlap_start, overlap_tokens = self.overlap(text, current[-1]) if overlap and current else (None, 0)
+            current, current_tokens = [], 0
+
+        for block, tokens in zip(blocks, counts):
+            if block.kind == "heading" and any(kept.kind != "heading" for kept in current):
+                flush()
+            if tokens > self.max_tokens:
+                flush()
+                overlap_start, overlap_tokens = None, 0
+                pieces = self.split_large_block(text, block)
+                header = table_header(text[block.start:block.end]) if block.kind == "table" else ""
+                for i, (start, end) in enumerate(pieces):
+                    chunks.append((start, end, block.headings, header if i else ""))
+                continue
+            if current and current_tokens + tokens > self.max_tokens:
+                # The next chunk continues the same section, it repeats the end of this one
+                flush(overlap=True)
+            if not current:
+                if overlap_tokens + tokens > self.max_tokens:
+                    overlap_start, overlap_tokens = None, 0
+                current_tokens = overlap_tokens
+            current.append(block)
+            current_tokens += tokens
+        flush()
+        return chunks
+
+    def split_documents(self, documents: List[Document]) -> List[Document]:
+        chunks = []
+        for document in documents:
+            text = document.page_content
+            for start, end, headings, prefix in self.split_text(text):
+                metadata = dict(document.metadata)
+                metadata['start_index'] = start
+                if headings:
+                    metadata['headings'] = " > ".join(headings)
+                content = text[start:end]
+                if prefix:
+                    # The source text of the chunk starts after the repeated table header
+                    content = prefix + content
+                    metadata['prefix_length'] = len(prefix)
+                chunks.append(Document(page_content=content, metadata=metadata))
+        return chunks
@@ -1,11 +1,23 @@
 #!/usr/bin/env python3
 import os
 from dotenv import load_dotenv
-import markdown
 import chromadb
 from chromadb.config import Settings
-import glob
-from typing import List
+import json
+import heapq
+import signal
+import fnmatch
+import hashlib
+import queue
+import threading
+import subprocess
+import sys
+import time
+import psutil
+from collections import deque
+from typing import Callable, Dict, Iterable, Iterator, List, Set, Tuple
+import multiprocessing
+import multiprocessing.connection
 from multiprocessing import Pool
 from tqdm import tqdm
 import logging
@@ -34,9 +46,17 @@ from langchain_community.document_loaders import (
 )
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import Chroma
+from langchain_core.vectorstores import VectorStore
+from langchain_core.embeddings import Embeddings
 from langchain_huggingface import HuggingFaceEmbeddings
 
+from chunker import StructuredChunker
+from embedding_cache import cached_embeddings, cache_stats
+from fast_loaders import FastCSVLoader, FastEmailLoader, FastHTMLLoader, FastMarkdownLoader
+from vector_store import MmapVectorStore, open_vector_store, vector_store_exists
+from lexical_index import LexicalIndex
+from shards import parse_shards, partition_files, shard_directory
+
 # Load environment variables
 default_num_processes = os.getenv('DEFAULT_NUM_PROCESSES')
 persist_directory = os.getenv('PERSISTENT_DATABASE', 'chroma_db')
@@ -48,20 +68,50 @@ embeddings_batch_size = int(os.getenv('BATCH_SIZE', 5461))
 chunk_size = int(os.getenv('CHUNK_SIZE', 500))
 chunk_overlap = int(os.getenv('CHUNK_OVERLAP', 3))
 max_file_size_mb = int(os.getenv('MAX_FILE_SIZE_MB', 200))
+manifest_path = os.path.join(persist_directory, 'ingest_manifest.json')
+embeddings_cache_directory = os.getenv('EMBEDDINGS_CACHE_DIRECTORY', 'embeddings_cache')
+embeddings_cache_max_entries = int(os.getenv('EMBEDDINGS_CACHE_MAX_ENTRIES', 1000000))
+hybrid_search = os.getenv('HYBRID_SEARCH', 'True') == 'True'
+lexical_index_directory = os.path.join(persist_directory, 'lexical_index')
+embedding_workers = int(os.getenv('EMBEDDING_WORKERS', 1))
+embedding_batch_tokens = int(os.getenv('EMBEDDING_BATCH_TOKENS', 0))
+loader_tier = os.getenv('LOADER_TIER', 'fast')
+chunker_name = os.getenv('CHUNKER', 'structured')
+ignore_file_name = '.vaultignore'
+file_timeout_seconds = float(os.getenv('FILE_TIMEOUT_SECONDS', 600))
+slow_file_seconds = float(os.getenv('SLOW_FILE_SECONDS', 60))
+max_tasks_per_worker = int(os.getenv('MAX_TASKS_PER_WORKER', 100))
+small_file_bytes = int(os.getenv('SMALL_FILE_KB', 64)) * 1024
+small_files_per_task = int(os.getenv('SMALL_FILES_PER_TASK', 32))
+schedule_window = int(os.getenv('SCHEDULE_WINDOW', 256))
+retry_list_path = os.path.join(persist_directory, 'ingest_retry.json')
+checkpoint_path = os.path.join(persist_directory, 'ingest_checkpoint.jsonl')
+shards_setting = os.getenv('SHARDS', '')
+shard_parallelism = int(os.getenv('SHARD_PARALLELISM', 2))
+# Set by ingest_shards for the docs_loader.py process of each shard
+shard_name = os.getenv('SHARD_NAME', '')
+# The source files of a hash shard, listed by the single walk of the parent process
+shard_file_list = os.getenv('SHARD_FILE_LIST', '')
+vector_store_kind = os.getenv('VECTOR_STORE', 'chroma')
+vector_quantization = os.getenv('VECTOR_QUANTIZATION', 'int8')
+vector_probes = int(os.getenv('VECTOR_PROBES', 16))
 
 # Define anonymize telemetry for Chroma DB
 client = chromadb.Client(Settings(anonymized_telemetry=anonymize_telemetry))
 
-def submit_embeddings_in_batches(embeddings, texts, metadatas, ids, chroma_collection, batch_size=embeddings_batch_size):
-    total_batches = (len(embeddings) + batch_size - 1) // batch_size
-    for i in tqdm(range(total_batches), desc="Submitting Embeddings", ncols=80):
-        start_idx = i * batch_size
+def submit_embeddings_in_batches(embeddings, texts, metadatas, ids, vectorstore, batch_size=embeddings_batch_size):
+    """
+    Upsert chunks with their precomputed embeddings under explicit ids,
+    writing a chunk id again replaces the stored chunk instead of duplicating it
+    """
+    for start_idx in range(0, len(embeddings), batch_size):
         end_idx = min(start_idx + batch_size, len(embeddings))
-        batch_embeddings = embeddings[start_idx:end_idx]
-        batch_texts = texts[start_idx:end_idx] if texts else None
-        batch_metadatas = metadatas[start_idx:end_idx] if metadatas else None
-        batch_ids = ids[start_idx:end_idx] if ids else None
-        chroma_collection.add_texts(texts=batch_texts, embeddings=batch_embeddings, metadatas=batch_metadatas, ids=batch_ids)
+        if isinstance(vectorstore, MmapVectorStore):
+            vectorstore.add_embeddings(ids[start_idx:end_idx], texts[start_idx:end_idx],
+                                       metadatas[start_idx:end_idx], embeddings[start_idx:end_idx])
+        else:
+            vectorstore._collection.upsert(ids=ids[start_idx:end_idx], embeddings=embeddings[start_idx:end_idx],
+                                           documents=texts[start_idx:end_idx], metadatas=metadatas[start_idx:end_idx])
 
 class ElmLoader(UnstructuredEmailLoader):
     def load(self) -> List[UnstructuredFileLoader]:
@@ -79,7 +129,7 @@ class ElmLoader(UnstructuredEmailLoader):
         return docs
 
 # Map file extensions to document loaders and their arguments
-LOADER_MAPPING = {
+UNSTRUCTURED_LOADER_MAPPING = {
     ".csv": (CSVLoader, {}),
     ".doc": (UnstructuredWordDocumentLoader, {}),
     ".docx": (UnstructuredWordDocumentLoader, {}),
@@ -96,6 +146,24 @@ LOADER_MAPPING = {
     # Add more mappings for other file extensions and loaders as needed
 }
 
+# Standard library loaders for plain text formats, the unstructured loaders
+# are only imported by a worker when one of these fails on a file
+FAST_LOADER_MAPPING = {
+    ".csv": (FastCSVLoader, {}),
+    ".eml": (FastEmailLoader, {}),
+    ".html": (FastHTMLLoader, {}),
+    ".md": (FastMarkdownLoader, {"encoding": "utf8"}),
+}
+
+def loader_mapping(tier: str) -> Dict[str, Tuple[type, Dict]]:
+    if tier == 'fast':
+        return {**UNSTRUCTURED_LOADER_MAPPING, **FAST_LOADER_MAPPING}
+    if tier != 'unstructured':
+        logging.warning(f"Unknown LOADER_TIER '{tier}', using the unstructured loaders")
+    return dict(UNSTRUCTURED_LOADER_MAPPING)
+
+LOADER_MAPPING = loader_mapping(loader_tier)
+
 # Create console handler and set level to warning, so we can scare the cats
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.WARNING)
@@ -105,12 +173,16 @@ console_handler.setFormatter(formatter)
 # Add the handler to the root logger
 logging.getLogger('').addHandler(console_handler)
 
-def validate_file(file_path: str) -> bool:
-    if not os.path.exists(file_path):
-        logging.warning(f"File does not exist: {file_path}")
-        return False
-    
-    file_size = os.path.getsize(file_path)
+def validate_file(file_path: str, stat_result: os.stat_result = None) -> bool:
+    # A single stat call, reused from the discovery walk when available
+    if stat_result is None:
+        try:
+            stat_result = os.stat(file_path)
+        except OSError:
+            logging.warning(f"File does not exist: {file_path}")
+            return False
+
+    file_size = stat_result.st_size
     
     # Check if the file is an empty promise
     if file_size == 0:
@@ -132,38 +204,368 @@ def validate_file(file_path: str) -> bool:
 
     return True
 
+def loader_worker(connection, max_tasks: int) -> None:
+    """
+    Loader worker process of the LoaderPool: load and split the files of each task it receives.
+    Every file is announced before it is loaded, so the parent knows which file a stuck worker is on.
+    The worker exits after max_tasks tasks, the parent replaces it.
+    """
+    # Interrupts are handled by the parent, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The parent downloaded the tokenizer, workers do not wait on the network when offline
+    text_splitter = create_text_splitter(local_files_only=True)
+    tasks = 0
+    while not max_tasks or tasks < max_tasks:
+        try:
+            task = connection.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        for file_path in task:
+            connection.send(("start", file_path))
+            start = time.perf_counter()
+            documents = load_single_document(file_path)
+            chunks = text_splitter.split_documents(documents) if documents else []
+            connection.send(("file", file_path, len(documents), chunks, time.perf_counter() - start))
+        connection.send(("done",))
+        tasks += 1
+
+class LoaderPool:
+    """
+    Loader worker processes fed one scheduler task at a time through a pipe each.
+    A worker busy on a file for longer than file_timeout, in Python or in native code,
+    is killed and replaced, and the rest of its task goes to the next idle worker.
+    A worker that crashes is replaced the same way, and workers are replaced after
+    max_tasks tasks to release the memory leaked by the parsers.
+    """
+
+    def __init__(self, processes: int, file_timeout: float = 0, max_tasks: int = 0):
+        self.processes = processes
+        self.file_timeout = file_timeout
+        self.max_tasks = max_tasks
+        self.workers: List[Dict] = []
+        # Workers that exited before their first message, a broken loader setup ends the run
+        self.failed_starts = 0
+
+    def start_worker(self) -> Dict:
+        connection, worker_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=loader_worker, args=(worker_connection, self.max_tasks), daemon=True)
+        process.start()
+        worker_connection.close()
+        return {"process": process, "connection": connection, "task": None, "file": None, "started": 0.0, "tasks": 0, "ready": False}
+
+    def replace_worker(self, worker: Dict) -> None:
+        if worker["process"].is_alive():
+            worker["process"].kill()
+        worker["connection"].close()
+        worker["process"].join()
+        self.workers[self.workers.index(worker)] = self.start_worker()
+
+    def abandon(self, worker: Dict, timed_out: bool, emit: Callable, backlog: deque) -> None:
+        """Report the file a worker is stuck on or crashed on, and queue the rest of its task again."""
+        task = worker["task"]
+        if not worker["ready"]:
+            self.failed_starts += 1
+            if self.failed_starts > self.processes:
+                raise RuntimeError("The loader processes keep exiting before loading any file")
+        if worker["file"] is not None:
+            seconds = time.perf_counter() - worker["started"]
+            if timed_out:
+                log_message = f"Timed out loading file {worker['file']} after {seconds:.0f}s, its loader process was replaced"
+            else:
+                log_message = f"The loader process crashed on file {worker['file']} and was replaced"
+            print(log_message)
+            logging.error(log_message)
+            emit((worker["file"], 0, [], seconds, timed_out))
+            task = task[1:]
+        if task:
+            backlog.appendleft(task)
+        self.replace_worker(worker)
+
+    def handle(self, worker: Dict, emit: Callable, backlog: deque) -> None:
+        try:
+            message = worker["connection"].recv()
+        except (EOFError, OSError):
+            self.abandon(worker, False, emit, backlog)
+            return
+        worker["ready"] = True
+        self.failed_starts = 0
+        if message[0] == "start":
+            worker["file"], worker["started"] = message[1], time.perf_counter()
+        elif message[0] == "file":
+            worker["file"] = None
+            worker["task"] = worker["task"][1:]
+            emit((*message[1:], False))
+        elif message[0] == "done":
+            worker["task"] = None
+            worker["tasks"] += 1
+            if self.max_tasks and worker["tasks"] >= self.max_tasks:
+                # The worker exits on its own after its last task
+                self.replace_worker(worker)
+
+    def run(self, tasks: Iterable[List[str]], max_pending: int, consumed: Callable[[], int],
+            emit: Callable, stopped: threading.Event) -> None:
+        """
+        Load the tasks and emit (file path, documents, chunks, seconds, timed out) for every file.
+        New tasks are only sent while fewer than max_pending emitted files wait for the consumer.
+        """
+        tasks = iter(tasks)
+        backlog = deque()
+        next_task = None
+        exhausted = False
+        dispatched = 0
+        self.workers = [self.start_worker() for _ in range(self.processes)]
+        try:
+            while not stopped.is_set():
+                for worker in list(self.workers):
+                    if worker["task"] is not None:
+                        continue
+                    if backlog:
+                        task = backlog.popleft()
+                    else:
+                        if next_task is None and not exhausted:
+                            next_task = next(tasks, None)
+                            exhausted = next_task is None
+                        in_flight = dispatched - consumed()
+                        if next_task is None or (in_flight and in_flight + len(next_task) > max_pending):
+                            break
+                        task, next_task = next_task, None
+                        dispatched += len(task)
+                    worker["task"] = task
+                    try:
+                        worker["connection"].send(task)
+                    except OSError:
+                        self.abandon(worker, False, emit, backlog)
+                busy = [worker for worker in self.workers if worker["task"] is not None]
+                if not busy and exhausted and next_task is None and not backlog:
+                    return
+                ready = multiprocessing.connection.wait([worker["connection"] for worker in busy], timeout=0.1) if busy else []
+                if not busy:
+                    # Waiting for the consumer to catch up
+                    time.sleep(0.05)
+                for worker in busy:
+                    if worker["connection"] in ready:
+                        self.handle(worker, emit, backlog)
+                    elif (self.file_timeout > 0 and worker["file"] is not None
+                          and time.perf_counter() - worker["started"] > self.file_timeout):
+                        self.abandon(worker, True, emit, backlog)
+        finally:
+            for worker in self.workers:
+                if worker["process"].is_alive():
+                    worker["process"].kill()
+                worker["connection"].close()
+                worker["process"].join()
+            self.workers = []
+
 def load_single_document(file_path: str) -> List[UnstructuredFileLoader]:
     ext = "." + file_path.rsplit(".", 1)[-1]
     if ext in LOADER_MAPPING:
-        if not validate_file(file_path):
-            log_message = f"Skipped the loading of invalid file: {file_path}"
-            print(log_message)
-            logging.warning(log_message)  
-            return []
-        
-        loader_class, loader_args = LOADER_MAPPING[ext]
-        try:
-            loader = loader_class(file_path, **loader_args)
-            return loader.load()
-        except Exception as e:
-            log_message = f"Error loading file {file_path}: {e}"
-            print(log_message)
-            logging.error(log_message, exc_info=True)  
-            return []  
+        # Files were validated by the discovery walk
+        loaders = [LOADER_MAPPING[ext]]
+        if ext in UNSTRUCTURED_LOADER_MAPPING and UNSTRUCTURED_LOADER_MAPPING[ext][0] is not loaders[0][0]:
+            # A fast loader falls back to the unstructured loader of its extension
+            loaders.append(UNSTRUCTURED_LOADER_MAPPING[ext])
+        for loader_class, loader_args in loaders:
+            try:
+                loader = loader_class(file_path, **loader_args)
+                return loader.load()
+            except Exception as e:
+                error = e
+                logging.warning(f"{loader_class.__name__} failed on {file_path}: {e}")
+        log_message = f"Error loading file {file_path}: {error}"
+        print(log_message)
+        logging.error(log_message, exc_info=error)
+        return []
 
     log_message = f"Unsupported file extension '{ext}' for file: {file_path}"
     print(log_message)
     logging.warning(log_message)  
     return []
 
-def load_documents(source_dir: str, ignored_files: List[str] = []) -> List[UnstructuredFileLoader]:
-    all_files = []
-    for ext in LOADER_MAPPING:
-        all_files.extend(
-            glob.glob(os.path.join(source_dir, f"**/*{ext}"), recursive=True)
-        )
-    filtered_files = [file_path for file_path in all_files if file_path not in ignored_files]
+def load_ignore_patterns(source_dir: str) -> List[Tuple[str, bool, bool, bool]]:
+    """
+    Read the .vaultignore file of the source directory, a subset of the .gitignore syntax:
+    glob patterns, "#" comments, "!" negation, a trailing "/" for directories only and
+    patterns containing a "/" matched against the path relative to the source directory.
+    """
+    patterns = []
+    try:
+        with open(os.path.join(source_dir, ignore_file_name), encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return patterns
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        negate = line.startswith('!')
+        line = line.lstrip('!')
+        directory_only = line.endswith('/')
+        line = line.strip('/')
+        if line:
+            patterns.append((line, negate, directory_only, '/' in line))
+    return patterns
+
+def is_ignored(relative_path: str, is_directory: bool, patterns: List[Tuple[str, bool, bool, bool]]) -> bool:
+    # The last matching pattern wins, as in .gitignore
+    ignored = False
+    name = relative_path.rsplit('/', 1)[-1]
+    for pattern, negate, directory_only, anchored in patterns:
+        if directory_only and not is_directory:
+            continue
+        if fnmatch.fnmatchcase(relative_path if anchored else name, pattern):
+            ignored = not negate
+    return ignored
+
+def walk_source_files(source_dir: str) -> Iterator[Tuple[str, os.stat_result]]:
+    """
+    Walk the source directory once with os.scandir and yield every supported and valid
+    file with its stat result, as soon as it is found. Hidden entries are skipped
+    and directories matching the .vaultignore patterns are pruned without being read.
+    """
+    patterns = load_ignore_patterns(source_dir)
+    directories = [source_dir]
+    while directories:
+        directory = directories.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError as e:
+            logging.warning(f"Cannot read directory {directory}: {e}")
+            continue
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            relative_path = os.path.relpath(entry.path, source_dir).replace(os.sep, '/')
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if not is_ignored(relative_path, True, patterns):
+                        directories.append(entry.path)
+                    continue
+                if os.path.splitext(entry.name)[1] not in LOADER_MAPPING or is_ignored(relative_path, False, patterns):
+                    continue
+                stat_result = entry.stat()
+            except OSError as e:
+                logging.warning(f"Cannot stat {entry.path}: {e}")
+                continue
+            if validate_file(entry.path, stat_result):
+                yield entry.path, stat_result
+
+def listed_source_files(list_path: str) -> Iterator[Tuple[str, os.stat_result]]:
+    """Yield the files of a shard file list written by ingest_shards with their stat result."""
+    with open(list_path, encoding='utf-8') as f:
+        file_paths = json.load(f)
+    for file_path in file_paths:
+        try:
+            stat_result = os.stat(file_path)
+        except OSError as e:
+            logging.warning(f"Cannot stat {file_path}: {e}")
+            continue
+        yield file_path, stat_result
+
+def discover_files(source_dir: str) -> List[str]:
+    return [file_path for file_path, _ in walk_source_files(source_dir)]
+
+def file_digest(file_path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def file_fingerprint(file_path: str, stat_result: os.stat_result = None) -> Dict:
+    stat_result = stat_result or os.stat(file_path)
+    return {"size": stat_result.st_size, "mtime": stat_result.st_mtime_ns, "sha256": file_digest(file_path)}
+
+def load_manifest(path: str = manifest_path) -> Dict[str, Dict]:
+    """
+    Load the ingestion manifest, keyed by source path with size, mtime and content hash
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable manifest {path}: {e}")
+        return {}
 
+def save_manifest(manifest: Dict[str, Dict], path: str = manifest_path) -> None:
+    # Write to a temporary file first, a killed run must never leave half a manifest behind
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+def chunk_id(source: str, index: int, content: str) -> str:
+    """Deterministic id of the index-th chunk of a source, the same chunk always gets the same id"""
+    content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    return hashlib.sha256(f"{source}\0{index}\0{content_hash}".encode('utf-8')).hexdigest()[:32]
+
+def load_checkpoint(path: str = checkpoint_path) -> Dict[str, Dict]:
+    """
+    Progress of an interrupted run: the fingerprint of each source it started to store
+    and whether all its chunks were stored. The last line of a killed write is dropped.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if not data.endswith(b'\n'):
+            data = data[:data.rfind(b'\n') + 1]
+            f.truncate(len(data))
+    checkpoint = {}
+    for line in data.decode('utf-8').splitlines():
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        checkpoint[entry.pop('source')] = entry
+    return checkpoint
+
+def append_checkpoint(entries: Dict[str, Dict], path: str = checkpoint_path) -> None:
+    # Appended and synced per batch, a restart resumes from the last batch on disk
+    if not entries:
+        return
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a', encoding='utf-8') as f:
+        for source, entry in entries.items():
+            f.write(json.dumps({"source": source, **entry}, separators=(',', ':')) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def same_version(entry: Dict, fingerprint: Dict) -> bool:
+    return bool(entry) and bool(fingerprint) and entry["sha256"] == fingerprint["sha256"]
+
+def scan_changed_files(files: Iterable[Tuple[str, os.stat_result]], manifest: Dict[str, Dict],
+                       fingerprints: Dict[str, Dict], seen: Set[str]) -> Iterator[Tuple[str, int]]:
+    """
+    Compare files on disk with the manifest and yield the files to ingest, with their size, as they are found.
+    The fingerprints of the files to ingest are recorded in fingerprints and every file
+    found in seen, the manifest sources missing from seen were removed from disk.
+    Content is only hashed when size or mtime differ from the manifest.
+    """
+    for file_path, stat_result in files:
+        if file_path in seen:
+            continue
+        seen.add(file_path)
+        entry = manifest.get(file_path)
+        if entry and entry["size"] == stat_result.st_size and entry["mtime"] == stat_result.st_mtime_ns:
+            continue
+        try:
+            fingerprint = file_fingerprint(file_path, stat_result)
+        except OSError as e:
+            logging.warning(f"Cannot read {file_path}: {e}")
+            continue
+        if entry and entry["sha256"] == fingerprint["sha256"]:
+            # Touched but not edited, refresh the stat data only
+            manifest[file_path] = fingerprint
+            continue
+        fingerprints[file_path] = fingerprint
+        yield file_path, stat_result.st_size
+
+def get_num_processes() -> int:
     # keep track of the definition source
     process_source = ""
 
@@ -176,47 +578,338 @@ def load_documents(source_dir: str, ignored_files: List[str] = []) -> List[Unstr
 
     # Display the number of processes used and their definition source
     print(f"Number of processes used: {num_processes} (defined by {process_source})")
+    return num_processes
+
+def schedule_tasks(files: Iterable[Tuple[str, int]], window: int = schedule_window,
+                   small_bytes: int = small_file_bytes, files_per_task: int = small_files_per_task) -> Iterator[List[str]]:
+    """
+    Order the files largest first within a lookahead window of tasks, so the longest
+    parses start early instead of running alone at the tail (longest-processing-time first).
+    Small files are grouped into a single task to save inter-process round trips.
+    """
+    heap = []
+    sequence = 0
+    small_task, small_task_bytes = [], 0
 
-    # Create a Pool with the determined number of processes
-    with Pool(processes=num_processes) as pool:
-        results = []
-        with tqdm(total=len(filtered_files), desc='Loading new documents', ncols=80) as pbar:
-            for i, docs in enumerate(pool.imap_unordered(load_single_document, filtered_files)):
-                results.extend(docs)
+    def push(task: List[str], task_bytes: int) -> Iterator[List[str]]:
+        nonlocal sequence
+        heapq.heappush(heap, (-task_bytes, sequence, task))
+        sequence += 1
+        if len(heap) > window:
+            yield heapq.heappop(heap)[2]
+
+    for file_path, size in files:
+        if size >= small_bytes or files_per_task <= 1:
+            yield from push([file_path], size)
+            continue
+        small_task.append(file_path)
+        small_task_bytes += size
+        if len(small_task) >= files_per_task:
+            yield from push(small_task, small_task_bytes)
+            small_task, small_task_bytes = [], 0
+    if small_task:
+        yield from push(small_task, small_task_bytes)
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+def load_documents(files: Iterable[Tuple[str, int]], max_pending: int = documents_batch_size,
+                   retry: Dict[str, Dict] = None) -> Iterator[Tuple[int, List[UnstructuredFileLoader]]]:
+    """
+    Stream the number of documents and the chunks of each file as soon as a worker has loaded and split it.
+    At most max_pending files are loaded ahead of the consumer, so the
+    workers pause while the embedding stage catches up.
+    Files that timed out, produced no documents or were slow are recorded in retry.
+    """
+    max_pending = max(1, max_pending)
+    results = queue.Queue()
+    consumed = 0
+    stopped = threading.Event()
+    # Workers are replaced when a file times out and regularly to release the memory leaked by the parsers
+    pool = LoaderPool(get_num_processes(), file_timeout_seconds, max_tasks_per_worker)
+    # Download the tokenizer of the structured chunker once, before the workers read it
+    create_text_splitter()
+
+    def feed():
+        try:
+            pool.run(schedule_tasks(files, files_per_task=min(small_files_per_task, max_pending)),
+                     max_pending, lambda: consumed, results.put, stopped)
+            results.put(None)
+        except BaseException as e:
+            results.put(e)
+
+    # The pool runs in a thread, so the workers keep loading while the consumer embeds a batch
+    feeder = threading.Thread(target=feed, name="vaultchat-loader-pool", daemon=True)
+    feeder.start()
+    try:
+        with tqdm(desc='Loading new documents', ncols=80) as pbar:
+            while True:
+                result = results.get()
+                if result is None:
+                    break
+                if isinstance(result, BaseException):
+                    raise result
+                file_path, num_documents, chunks, seconds, timed_out = result
                 pbar.update()
+                if retry is not None and (timed_out or not chunks or seconds >= slow_file_seconds):
+                    reason = "timeout" if timed_out else "no documents" if not chunks else "slow"
+                    retry[file_path] = {"reason": reason, "seconds": round(seconds, 2)}
+                yield num_documents, chunks
+                consumed += 1
+    finally:
+        # Stops the workers, also when the consumer stopped early
+        stopped.set()
+        feeder.join()
 
-    return results
+def create_text_splitter(local_files_only: bool = False):
+    """
+    The structured chunker sizes chunks in tokens of the embedding model and follows the
+    markdown structure, the recursive splitter counts characters.
+    With local_files_only, the tokenizer is only read from the Hugging Face cache.
+    """
+    if chunker_name == 'recursive':
+        # The start index lets vaultChat.py merge adjacent chunks of a source
+        return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True)
+    return StructuredChunker(embeddings_model_name, chunk_size, chunk_overlap, local_files_only)
 
-def process_documents(ignored_files: List[str] = []) -> List[UnstructuredFileLoader]:
+def process_documents(files: Iterable[Tuple[str, int]], batch_size: int = embeddings_batch_size,
+                      retry: Dict[str, Dict] = None) -> Iterator[List[UnstructuredFileLoader]]:
     """
-    Load documents and split in chunks
+    Load documents and split in chunks, yielding batches of chunks ready for embedding.
+    Both happen in the loader workers.
     """
     print(f"Loading documents from {source_directory}")
-    documents = load_documents(source_directory, ignored_files)
-    if not documents:
+    num_documents = 0
+    num_chunks = 0
+    batch = []
+    for file_documents, texts in load_documents(files, retry=retry):
+        if not texts:
+            continue
+        num_documents += file_documents
+        num_chunks += len(texts)
+        # The position of a chunk in its file is part of its id
+        for index, text in enumerate(texts):
+            text.metadata['chunk_index'] = index
+        batch.extend(texts)
+        while len(batch) >= batch_size:
+            yield batch[:batch_size]
+            batch = batch[batch_size:]
+    if batch:
+        yield batch
+
+    if not num_documents:
         print("No new documents to load")
-        exit(0)
-    print(f"Loaded {len(documents)} new documents from {source_directory}")
-    
-  # Adjust as needed
-    document_batches = [documents[i:i+documents_batch_size] for i in range(0, len(documents), documents_batch_size)]
-
-    # Process each batch of documents
-    processed_texts = []
-    for batch in tqdm(document_batches, desc='Processing document batches', ncols=80):
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-        texts = text_splitter.split_documents(batch)
-        processed_texts.extend(texts)
-    
-    print(f"Split into {len(processed_texts)} chunks of text (max. {chunk_size} tokens each)")
-    return processed_texts
+        return
+    print(f"Loaded {num_documents} new documents from {source_directory}")
+    print(f"Split into {num_chunks} chunks of text (max. {chunk_size} tokens each)")
+
+def save_retry_list(retry: Dict[str, Dict], path: str = retry_list_path) -> None:
+    """
+    Record the files of the last run that timed out, failed or were slow.
+    Files without documents are not in the manifest and are loaded again on the next run.
+    """
+    if not retry:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(retry, f, indent=1, sort_keys=True)
+    counts = {}
+    for entry in retry.values():
+        counts[entry["reason"]] = counts.get(entry["reason"], 0) + 1
+    print(f"Files to check: {', '.join(f'{count} {reason}' for reason, count in sorted(counts.items()))}, listed in {path}")
+
+def seed_manifest(db: VectorStore) -> Dict[str, Dict]:
+    """
+    Build a manifest for a vectorstore created before manifests existed,
+    so its files are not embedded a second time
+    """
+    print(f"No ingestion manifest found, indexing sources already in {persist_directory}")
+    sources = {metadata['source'] for metadata in db.get(include=['metadatas'])['metadatas']}
+    manifest = {}
+    for source in tqdm(sources, desc='Indexing stored sources', ncols=80):
+        try:
+            manifest[source] = file_fingerprint(source)
+        except OSError:
+            # Gone from disk, its chunks are purged below
+            manifest[source] = {"size": -1, "mtime": -1, "sha256": ""}
+    return manifest
+
+def purge_sources(db: VectorStore, sources: List[str], batch_size: int = 500) -> List[str]:
+    """
+    Delete every stored chunk of the given sources and return their ids
+    """
+    purged_ids = []
+    for i in tqdm(range(0, len(sources), batch_size), desc='Purging stale chunks', ncols=80):
+        batch = sources[i:i+batch_size]
+        ids = db.get(where={"source": {"$in": batch}}, include=[])['ids']
+        if ids:
+            db.delete(ids)
+            purged_ids.extend(ids)
+    return purged_ids
+
+def backfill_lexical_index(db: VectorStore, lexical_index: LexicalIndex, batch_size: int = embeddings_batch_size) -> None:
+    """
+    Index the chunks of a vectorstore created before the lexical index existed
+    """
+    print(f"Building the lexical index of the chunks already in {persist_directory}")
+    offset = 0
+    while True:
+        stored = db.get(include=['documents'], limit=batch_size, offset=offset)
+        if not stored['ids']:
+            break
+        lexical_index.add(stored['ids'], stored['documents'])
+        offset += len(stored['ids'])
+    lexical_index.flush()
+
+# Embedding model of each embedding worker process, loaded once by init_embedding_worker
+worker_embeddings = None
+
+def init_embedding_worker(model_name: str, num_threads: int) -> None:
+    global worker_embeddings
+    import torch
+    # Share the cores between workers instead of every worker grabbing all of them
+    torch.set_num_threads(num_threads)
+    worker_embeddings = HuggingFaceEmbeddings(model_name=model_name)
+
+def embed_in_worker(texts: List[str]) -> List[List[float]]:
+    # Each shard is encoded as a single batch, it was sized for it
+    worker_embeddings.encode_kwargs['batch_size'] = len(texts)
+    return worker_embeddings.embed_documents(texts)
+
+def estimate_tokens(text: str) -> int:
+    # Roughly 4 characters per token for English text with WordPiece tokenizers
+    return len(text) // 4 + 2
+
+def adaptive_batch_tokens(num_workers: int) -> int:
+    """
+    Tokens per encoder batch, sized by the memory available to each worker.
+    Budgets about 256KB of activations per padded token for small sentence-transformers models.
+    """
+    if embedding_batch_tokens > 0:
+        return embedding_batch_tokens
+    available_per_worker = psutil.virtual_memory().available // max(1, num_workers)
+    return max(2048, min(65536, available_per_worker // (256 * 1024)))
+
+class ParallelEmbeddings(Embeddings):
+    """
+    Shard chunk batches across embedding worker processes.
+    Texts are sorted by length so each shard pads little, and shards
+    are sized by padded tokens instead of a fixed number of texts.
+    """
+
+    def __init__(self, model_name: str, num_workers: int):
+        self.num_workers = num_workers
+        self.batch_tokens = adaptive_batch_tokens(num_workers)
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        self.pool = Pool(processes=num_workers, initializer=init_embedding_worker, initargs=(model_name, num_threads))
+
+    def make_shards(self, texts: List[str]) -> List[List[int]]:
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        shards = []
+        shard = []
+        for i in order:
+            # Sorted ascending, the current text is the longest of its shard and sets the padded length
+            if shard and estimate_tokens(texts[i]) * (len(shard) + 1) > self.batch_tokens:
+                shards.append(shard)
+                shard = []
+            shard.append(i)
+        if shard:
+            shards.append(shard)
+        return shards
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        shards = self.make_shards(texts)
+        vectors = [None] * len(texts)
+        shard_vectors = self.pool.imap(embed_in_worker, ([texts[i] for i in shard] for shard in shards))
+        for shard, embedded in zip(shards, shard_vectors):
+            for i, vector in zip(shard, embedded):
+                vectors[i] = vector
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.pool.apply(embed_in_worker, ([text],))[0]
 
-# check if Chroma store exists
+    def close(self) -> None:
+        self.pool.close()
+        self.pool.join()
+
+def create_embeddings() -> Embeddings:
+    if embedding_workers > 1:
+        print(f"Number of embedding workers: {embedding_workers}")
+        return ParallelEmbeddings(embeddings_model_name, embedding_workers)
+    return HuggingFaceEmbeddings(model_name=embeddings_model_name)
+
+# check if the vectorstore selected by VECTOR_STORE exists
 def does_vectorstore_exist(persist_directory: str) -> bool:
-    return os.path.exists(os.path.join(persist_directory, 'chroma.sqlite3'))
+    return vector_store_exists(vector_store_kind, persist_directory)
+
+def open_vectorstore(embeddings: Embeddings) -> VectorStore:
+    return open_vector_store(vector_store_kind, persist_directory, embeddings, vector_quantization, vector_probes)
+
+def ingest_shards(shards: Dict[str, Dict[str, str]]) -> None:
+    """
+    Ingest every shard in a docs_loader.py process of its own, into its own vectorstore,
+    SHARD_PARALLELISM shards at a time sharing the loader processes. Each shard keeps its
+    manifest and embeddings cache, and writes its output to the ingest.log of its directory.
+    """
+    parallelism = max(1, min(shard_parallelism, len(shards)))
+    processes_per_shard = max(1, get_num_processes() // parallelism)
+    print(f"Ingesting {len(shards)} shards, {parallelism} at a time with {processes_per_shard} loader processes each")
+    start = time.perf_counter()
+    # Hash shards share one source directory, it is walked once here and each shard gets its files
+    file_lists = {}
+    hash_shards = {name: shard for name, shard in shards.items() if shard["hash"]}
+    if hash_shards:
+        hash_source_directory = next(iter(hash_shards.values()))["source_directory"]
+        count = int(next(iter(hash_shards.values()))["hash"].split("/")[1])
+        buckets = partition_files((file_path for file_path, _ in walk_source_files(hash_source_directory)),
+                                  hash_source_directory, count)
+        for name, shard in hash_shards.items():
+            directory = shard_directory(persist_directory, name)
+            os.makedirs(directory, exist_ok=True)
+            file_lists[name] = os.path.join(directory, 'source_files.json')
+            with open(file_lists[name], 'w', encoding='utf-8') as f:
+                json.dump(buckets[int(shard["hash"].split("/")[0])], f)
+        print(f"Found {sum(len(bucket) for bucket in buckets)} files for {len(hash_shards)} hash shards "
+              f"in {time.perf_counter() - start:.1f}s")
+    pending = list(shards.items())
+    running = {}
+    failed = []
+    while pending or running:
+        while pending and len(running) < parallelism:
+            name, shard = pending.pop(0)
+            directory = shard_directory(persist_directory, name)
+            os.makedirs(directory, exist_ok=True)
+            env = dict(os.environ, SHARD_NAME=name, SHARD_FILE_LIST=file_lists.get(name, ""), PERSISTENT_DATABASE=directory,
+                       SOURCE_DIRECTORY=shard["source_directory"], DEFAULT_NUM_PROCESSES=str(processes_per_shard),
+                       EMBEDDINGS_CACHE_DIRECTORY=os.path.join(embeddings_cache_directory, 'shards', name))
+            log_path = os.path.join(directory, 'ingest.log')
+            log = open(log_path, 'w', encoding='utf-8')
+            process = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env, stdout=log, stderr=subprocess.STDOUT)
+            running[name] = (process, log, log_path, time.perf_counter())
+            bucket = f", hash bucket {shard['hash']}" if shard["hash"] else ""
+            print(f"Shard {name}: ingesting {shard['source_directory']}{bucket}")
+        time.sleep(0.2)
+        for name, (process, log, log_path, shard_start) in list(running.items()):
+            if process.poll() is None:
+                continue
+            log.close()
+            del running[name]
+            if process.returncode:
+                failed.append(name)
+                print(f"Shard {name}: failed after {time.perf_counter() - shard_start:.1f}s, see {log_path}")
+            else:
+                print(f"Shard {name}: done in {time.perf_counter() - shard_start:.1f}s")
+    print(f"Ingested {len(shards) - len(failed)} of {len(shards)} shards in {time.perf_counter() - start:.1f}s")
+    if failed:
+        exit(1)
 
 def main():
-    
+    if shards_setting and not shard_name:
+        ingest_shards(parse_shards(shards_setting, source_directory))
+        return
+
     # Check if the source_directory exists and is accessible
     if not os.path.isdir(source_directory):
         logging.error(f"source_directory does not exist: {source_directory}")
@@ -227,44 +920,149 @@ def main():
         print(f"Error: Documents directory is not accessible: {source_directory}")
         exit(1)
                          
-    # Create embeddings
-    embeddings = HuggingFaceEmbeddings(model_name=embeddings_model_name)
+    # Create embeddings, previously embedded chunk texts are served from the cache
+    model_embeddings = create_embeddings()
+    embeddings = cached_embeddings(model_embeddings, embeddings_model_name,
+                                   embeddings_cache_directory, embeddings_cache_max_entries)
 
+    db = None
+    manifest = {}
+    checkpoint = {}
     if does_vectorstore_exist(persist_directory):
         # Update and store locally vectorstore
         print(f"Appending existing vectorstore to {persist_directory}")
-        
-        db = Chroma(persist_directory=persist_directory, embedding_function=embeddings)
-        collection = db.get()
-        texts = process_documents([metadata['source'] for metadata in collection['metadatas']])
-        print(f"Creating embeddings. Please wait...")
-        
-        # Calculate the total number of batches
-        total_batches = (len(texts) + embeddings_batch_size - 1) // embeddings_batch_size
-        
-        # Process texts in batches with tqdm for progress tracking
-        for i in tqdm(range(total_batches), desc="Creating embeddings", ncols=80):
-            batch_texts = texts[i*embeddings_batch_size : (i+1)*embeddings_batch_size]
-            db.add_documents(batch_texts)
+        db = open_vectorstore(embeddings)
+        manifest = load_manifest() if os.path.exists(manifest_path) else seed_manifest(db)
+        checkpoint = load_checkpoint()
     else:
         # Create and store locally vectorstore
         print(f"Creating new vectorstore in {persist_directory}")
-        texts = process_documents()
-        print(f"Creating embeddings. Please wait...")
-        
-        # Calculate the total number of batches
-        total_batches = (len(texts) + embeddings_batch_size - 1) // embeddings_batch_size
-        
-        # Initialize db outside of the loop to avoid reinitializing it for each batch
-        db = None
-
-        # Process texts in batches with tqdm for progress tracking
-        for i in tqdm(range(total_batches), desc="Creating embeddings", ncols=80):
-            batch_texts = texts[i*embeddings_batch_size : (i+1)*embeddings_batch_size]
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+    # Only an existing manifest can be left untouched, a new or seeded one is always written
+    stored_manifest = {source: dict(entry) for source, entry in manifest.items()} if os.path.exists(manifest_path) else None
+
+    # Files fully stored by an interrupted run are up to date, partly stored files are loaded
+    # again and only their chunks missing from the vectorstore are embedded
+    for source, entry in checkpoint.items():
+        if entry["complete"]:
+            manifest[source] = {key: entry[key] for key in ("size", "mtime", "sha256")}
+        else:
+            manifest.pop(source, None)
+    if checkpoint:
+        print(f"Resuming an interrupted run, {sum(entry['complete'] for entry in checkpoint.values())} "
+              f"of {len(checkpoint)} files were fully stored")
+
+    # The lexical index for hybrid search shares the chunk ids of the vectorstore
+    lexical_index = LexicalIndex(lexical_index_directory) if hybrid_search else None
+    if lexical_index is not None and db is not None and not lexical_index.segments:
+        backfill_lexical_index(db, lexical_index)
+
+    def purge(sources: List[str]) -> None:
+        purged_ids = purge_sources(db, sources)
+        if lexical_index is not None:
+            lexical_index.delete(purged_ids)
+
+    # Files stream from a single discovery walk through the change detection into the loader Pool,
+    # the walk runs in the loader pool thread so the manifest is only read here once it is done
+    previous_sources = set(manifest)
+    fingerprints = {}
+    seen = set()
+    source_files = listed_source_files(shard_file_list) if shard_file_list else walk_source_files(source_directory)
+    changed_files = scan_changed_files(source_files, manifest, fingerprints, seen)
+
+    # Chunks flow from the loaders through the splitter into the vectorstore batch by batch,
+    # the loader Pool keeps parsing while a batch is being embedded
+    stored_sources = set()
+    purged_sources = set()
+    print(f"Creating embeddings. Please wait...")
+    total_chunks = 0
+    skipped_chunks = 0
+    embedding_time = 0.0
+    retry = {}
+    last_source = None
+    for batch_texts in process_documents(changed_files, retry=retry):
+        start = time.perf_counter()
+        batch_sources = list(dict.fromkeys(text.metadata['source'] for text in batch_texts))
+        resumed_sources = {source for source in batch_sources if source in checkpoint and not checkpoint[source]["complete"]
+                           and same_version(checkpoint[source], fingerprints.get(source))}
+        # The previous chunks of a changed file are purged before its first new chunks are stored
+        stale_sources = {source for source in batch_sources if source in previous_sources or source in checkpoint}
+        stale_sources -= purged_sources | resumed_sources
+        if db is not None and stale_sources:
+            purge(sorted(stale_sources))
+        purged_sources.update(stale_sources | resumed_sources)
+        # Recorded before the write, a restart then knows these files may have stored chunks
+        append_checkpoint({source: {**fingerprints[source], "complete": False}
+                           for source in batch_sources if source not in stored_sources})
+
+        ids = [chunk_id(text.metadata['source'], text.metadata['chunk_index'], text.page_content) for text in batch_texts]
+        new_chunks = list(range(len(batch_texts)))
+        if db is not None and resumed_sources:
+            resumed_ids = [ids[i] for i, text in enumerate(batch_texts) if text.metadata['source'] in resumed_sources]
+            stored_ids = set(db.get(ids=resumed_ids, include=[])['ids'])
+            new_chunks = [i for i in new_chunks if ids[i] not in stored_ids]
+            skipped_chunks += len(batch_texts) - len(new_chunks)
+        if new_chunks:
+            texts = [batch_texts[i].page_content for i in new_chunks]
+            vectors = embeddings.embed_documents(texts)
             if db is None:
-                db = Chroma.from_documents(batch_texts, embeddings, persist_directory=persist_directory)
-            else:
-                db.add_documents(batch_texts)
+                db = open_vectorstore(embeddings)
+            submit_embeddings_in_batches(vectors, texts, [batch_texts[i].metadata for i in new_chunks],
+                                         [ids[i] for i in new_chunks], db)
+        if lexical_index is not None:
+            # Indexing a chunk id again replaces it, so resumed files are indexed whole
+            lexical_index.add(ids, [text.page_content for text in batch_texts])
+            lexical_index.flush()
+        # Chunks of a file are contiguous, every file of the batch but the last one is complete
+        append_checkpoint({source: {**fingerprints[source], "complete": True} for source in batch_sources[:-1]})
+        last_source = batch_sources[-1]
+
+        elapsed = max(time.perf_counter() - start, 1e-6)
+        embedding_time += elapsed
+        total_chunks += len(new_chunks)
+        stored_sources.update(batch_sources)
+        print(f"Embedded {len(new_chunks)} chunks in {elapsed:.2f}s ({len(new_chunks) / elapsed:.1f} chunks/sec), "
+              f"{total_chunks} chunks so far")
+    if last_source is not None:
+        append_checkpoint({last_source: {**fingerprints[last_source], "complete": True}})
+    if total_chunks:
+        print(f"Embedded {total_chunks} chunks in {embedding_time:.2f}s ({total_chunks / embedding_time:.1f} chunks/sec)")
+    if skipped_chunks:
+        print(f"Skipped {skipped_chunks} chunks already stored by the interrupted run")
+
+    save_retry_list(retry)
+
+    removed_sources = [source for source in previous_sources | set(checkpoint) if source not in seen]
+    print(f"Found {len(fingerprints)} new or changed and {len(removed_sources)} removed files")
+    if db is not None and removed_sources:
+        purge(removed_sources)
+    for source in removed_sources:
+        manifest.pop(source, None)
+
+    if isinstance(model_embeddings, ParallelEmbeddings):
+        model_embeddings.close()
+    if lexical_index is not None:
+        lexical_index.merge()
+        lexical_index.close()
+    if isinstance(db, MmapVectorStore):
+        # The IVF lists are rebuilt once per run, chunks added since are scanned at query time
+        db.build_index()
+        db.close()
+
+    # Only files that produced chunks are recorded, failed files are retried on the next run
+    for source in stored_sources:
+        if source in fingerprints:
+            manifest[source] = fingerprints[source]
+    # Rewrite the manifest only when something changed, its modification time marks a new corpus version
+    if db is not None and manifest != stored_manifest:
+        save_manifest(manifest)
+    # The manifest now covers the progress of this run
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    if cache_stats(embeddings):
+        print(cache_stats(embeddings))
                 
     print(f"Documents are ready! You can now run vaultChat.py to query your model with your private documents")
 
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import logging
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+def normalize_text(text: str) -> str:
+    # Whitespace differences don't change the meaning of a chunk, collapse them
+    return " ".join(text.split())
+
+
+def text_key(text: str) -> str:
+    return hashlib.blake2b(normalize_text(text).encode('utf-8'), digest_size=16).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    On-disk embedding cache for one embeddings model.
+    Vectors live in a memory-mapped float32 array, a SQLite index maps
+    chunk text hashes to rows and tracks usage for LRU eviction.
+    """
+
+    def __init__(self, cache_directory: str, model_name: str, max_entries: int = 1_000_000):
+        self.directory = os.path.join(cache_directory, re.sub(r'[^\w.-]+', '_', model_name))
+        os.makedirs(self.directory, exist_ok=True)
+        self.vectors_path = os.path.join(self.directory, 'vectors.f32')
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.index = sqlite3.connect(os.path.join(self.directory, 'index.sqlite3'))
+        self.index.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, row INTEGER NOT NULL, last_used REAL NOT NULL)")
+        self.index.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self.index.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.index.commit()
+
+        meta = dict(self.index.execute("SELECT name, value FROM meta"))
+        self.dimension = meta.get('dimension')
+        self.next_row = meta.get('next_row', 0)
+        self.capacity = 0
+        self.vectors = None
+        self.free_rows = []
+        if self.dimension:
+            self._open_vectors()
+            count = self.index.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            if count < self.next_row:
+                used_rows = {row for (row,) in self.index.execute("SELECT row FROM entries")}
+                self.free_rows = [row for row in range(self.next_row) if row not in used_rows]
+
+    def _open_vectors(self) -> None:
+        size = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+        self.capacity = size // (4 * self.dimension)
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+', shape=(self.capacity, self.dimension)) if self.capacity else None
+
+    def _grow(self, rows_needed: int) -> None:
+        if rows_needed <= self.capacity:
+            return
+        capacity = max(1024, self.capacity)
+        while capacity < rows_needed:
+            capacity *= 2
+        capacity = max(rows_needed, min(capacity, self.max_entries))
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.vectors = None
+        with open(self.vectors_path, 'ab') as f:
+            f.truncate(capacity * self.dimension * 4)
+        self._open_vectors()
+
+    def _set_meta(self, name: str, value: int) -> None:
+        self.index.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, value))
+
+    def __len__(self) -> int:
+        return self.index.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        found = {}
+        if self.vectors is None or not keys:
+            return found
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i+500]
+            placeholders = ",".join("?" * len(batch))
+            for key, row in self.index.execute(f"SELECT key, row FROM entries WHERE key IN ({placeholders})", batch):
+                found[key] = np.array(self.vectors[row])
+        if found:
+            now = time.time()
+            self.index.executemany("UPDATE entries SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+            self.index.commit()
+        return found
+
+    def _evict(self, count: int) -> None:
+        victims = self.index.execute("SELECT key, row FROM entries ORDER BY last_used LIMIT ?", (count,)).fetchall()
+        self.index.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in victims])
+        self.free_rows.extend(row for _, row in victims)
+        self.evictions += len(victims)
+
+    def put_many(self, keys: List[str], vectors: List[List[float]]) -> None:
+        if not keys or self.max_entries <= 0:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.dimension is None:
+            self.dimension = int(vectors.shape[1])
+            self._set_meta('dimension', self.dimension)
+        elif vectors.shape[1] != self.dimension:
+            logging.warning(f"Embedding cache dimension mismatch in {self.directory}, not caching")
+            return
+
+        # Keep the newest vectors when a single batch is larger than the cache
+        keys, vectors = keys[-self.max_entries:], vectors[-self.max_entries:]
+        overflow = len(self) + len(keys) - self.max_entries
+        if overflow > 0:
+            self._evict(overflow)
+
+        rows = []
+        for _ in keys:
+            if self.free_rows:
+                rows.append(self.free_rows.pop())
+            else:
+                rows.append(self.next_row)
+                self.next_row += 1
+        self._grow(self.next_row)
+        self.vectors[rows] = vectors
+        self.vectors.flush()
+
+        now = time.time()
+        self.index.executemany("INSERT OR REPLACE INTO entries (key, row, last_used) VALUES (?, ?, ?)",
+                               [(key, row, now) for key, row in zip(keys, rows)])
+        self._set_meta('next_row', self.next_row)
+        self.index.commit()
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = 100 * self.hits / lookups if lookups else 0
+        return (f"Embedding cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), "
+                f"{self.evictions} evictions, {len(self)} entries")
+
+    def close(self) -> None:
+        if self.vectors is not None:
+            self.vectors.flush()
+        self.index.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that only sends cache misses to the model,
+    identical chunks within a batch are embedded once.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache):
+        self.embeddings = embeddings
+        self.cache = cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [text_key(text) for text in texts]
+        found = self.cache.get_many(list(set(keys)))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        self.cache.hits += len(keys) - len(missing)
+        self.cache.misses += len(missing)
+
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            self.cache.put_many(list(missing), vectors)
+            found.update(zip(missing, (np.asarray(vector, dtype=np.float32) for vector in vectors)))
+
+        return [found[key].tolist() for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        # Queries are rarely repeated and some models embed them differently, skip the cache
+        return self.embeddings.embed_query(text)
+
+
+def cached_embeddings(embeddings: Embeddings, model_name: str, cache_directory: str, max_entries: int) -> Embeddings:
+    """
+    Wrap embeddings with the on-disk cache, unless the cache is disabled with max_entries 0
+    """
+    if max_entries <= 0:
+        return embeddings
+    return CachedEmbeddings(embeddings, EmbeddingCache(cache_directory, model_name, max_entries))
+
+
+def cache_stats(embeddings: Embeddings) -> Optional[str]:
+    return embeddings.cache.stats() if isinstance(embeddings, CachedEmbeddings) else None
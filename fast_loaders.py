@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+import re
+import csv
+from email import policy
+from email.parser import BytesParser
+from html.parser import HTMLParser
+from typing import Iterator, List
+
+from langchain_core.document_loaders import BaseLoader
+from langchain_core.documents import Document
+
+# Loaders of the "fast" tier of docs_loader.py, plain text formats parsed with the
+# standard library instead of the unstructured partition stack
+
+BLOCK_TAGS = {"address", "article", "aside", "blockquote", "br", "dd", "div", "dl", "dt", "fieldset",
+              "figcaption", "figure", "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6", "header",
+              "hr", "li", "main", "nav", "ol", "p", "pre", "section", "table", "td", "th", "tr", "ul"}
+SKIPPED_TAGS = {"script", "style", "noscript", "template", "svg", "head"}
+
+MARKDOWN_IMAGE = re.compile(r"!\[([^\]]*)\]\([^)]*\)")
+MARKDOWN_LINK = re.compile(r"\[([^\]]+)\]\([^)]*\)")
+MARKDOWN_REFERENCE = re.compile(r"^\s*\[[^\]]+\]:\s*\S+.*$", re.MULTILINE)
+MARKDOWN_EMPHASIS = re.compile(r"(\*\*|__|~~)(?=\S)(.+?)(?<=\S)\1")
+HTML_TAG = re.compile(r"</?[A-Za-z][^>]*>")
+
+
+def read_text(file_path: str, encoding: str = "utf-8") -> str:
+    with open(file_path, "rb") as f:
+        data = f.read()
+    try:
+        return data.decode(encoding)
+    except UnicodeDecodeError:
+        return data.decode("cp1252", errors="replace")
+
+
+class HTMLTextExtractor(HTMLParser):
+    """Collect the visible text of an HTML page, one line per block element."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts: List[str] = []
+        self.skipped_depth = 0
+        self.title = ""
+        self.in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "title":
+            self.in_title = True
+        elif tag in SKIPPED_TAGS:
+            self.skipped_depth += 1
+        elif tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag == "title":
+            self.in_title = False
+        elif tag in SKIPPED_TAGS:
+            self.skipped_depth = max(0, self.skipped_depth - 1)
+        elif tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title += data
+        elif not self.skipped_depth:
+            self.parts.append(data)
+
+    def text(self) -> str:
+        lines = (" ".join(line.split()) for line in "".join(self.parts).splitlines())
+        return "\n".join(line for line in lines if line)
+
+
+def html_to_text(html: str) -> str:
+    extractor = HTMLTextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    text = extractor.text()
+    # A page without body text, such as a bare title, still says something
+    return text or " ".join(extractor.title.split())
+
+
+class FastMarkdownLoader(BaseLoader):
+    """
+    Markdown without its inline markup: links, images, emphasis and HTML tags.
+    Headings, lists, tables and code blocks are kept as written.
+    """
+
+    def __init__(self, file_path: str, encoding: str = "utf-8"):
+        self.file_path = file_path
+        self.encoding = encoding
+
+    def lazy_load(self) -> Iterator[Document]:
+        text = read_text(self.file_path, self.encoding)
+        text = MARKDOWN_REFERENCE.sub("", text)
+        text = MARKDOWN_IMAGE.sub(r"\1", text)
+        text = MARKDOWN_LINK.sub(r"\1", text)
+        text = MARKDOWN_EMPHASIS.sub(r"\2", text)
+        text = HTML_TAG.sub("", text)
+        yield Document(page_content=text.strip(), metadata={"source": self.file_path})
+
+
+class FastHTMLLoader(BaseLoader):
+    """Visible text of an HTML page, scripts and styles are dropped."""
+
+    def __init__(self, file_path: str, encoding: str = "utf-8"):
+        self.file_path = file_path
+        self.encoding = encoding
+
+    def lazy_load(self) -> Iterator[Document]:
+        yield Document(page_content=html_to_text(read_text(self.file_path, self.encoding)),
+                       metadata={"source": self.file_path})
+
+
+class FastCSVLoader(BaseLoader):
+    """One document per row, streamed, in the "column: value" format of the langchain CSVLoader."""
+
+    def __init__(self, file_path: str, encoding: str = "utf-8-sig"):
+        self.file_path = file_path
+        self.encoding = encoding
+
+    def lazy_load(self) -> Iterator[Document]:
+        with open(self.file_path, newline="", encoding=self.encoding, errors="replace") as f:
+            for row_number, row in enumerate(csv.DictReader(f)):
+                lines = []
+                for column, value in row.items():
+                    # Extra cells without a header are collected in a list under None
+                    value = ", ".join(v or "" for v in value) if isinstance(value, list) else value or ""
+                    lines.append(f"{(column or '').strip()}: {value.strip()}")
+                yield Document(page_content="\n".join(lines), metadata={"source": self.file_path, "row": row_number})
+
+
+class FastEmailLoader(BaseLoader):
+    """The subject, participants and body of an email, the plain text part is preferred over HTML."""
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+
+    def lazy_load(self) -> Iterator[Document]:
+        with open(self.file_path, "rb") as f:
+            message = BytesParser(policy=policy.default).parse(f)
+        header = "\n".join(f"{name}: {message[name]}" for name in ("Subject", "From", "To", "Date") if message[name])
+        body = ""
+        part = message.get_body(preferencelist=("plain", "html"))
+        if part is not None:
+            try:
+                body = part.get_content()
+            except (LookupError, UnicodeDecodeError):
+                body = part.get_payload(decode=True).decode("utf-8", errors="replace")
+            if part.get_content_type() == "text/html":
+                body = html_to_text(body)
+        yield Document(page_content=f"{header}\n\n{body.strip()}".strip(), metadata={"source": self.file_path})
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+import os
+import re
+import sqlite3
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"\w+(?:[-./:]\w+)*")
+WORD_PATTERN = re.compile(r"\w+")
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercase words, compound identifiers such as invoice numbers or error codes
+    are kept whole in addition to their parts so exact identifiers score high
+    """
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(text.lower()):
+        token = match.group()
+        parts = WORD_PATTERN.findall(token)
+        tokens.extend(parts)
+        if len(parts) > 1:
+            tokens.append(token)
+    return tokens
+
+
+class LexicalIndex:
+    """
+    Inverted index over chunk ids for BM25 search.
+    Every ingestion run adds an immutable segment: the postings of each term are
+    contiguous slices of a doc number array and a term frequency array, memory-mapped
+    at query time, and a SQLite table locates them. Deleted chunks are tombstoned
+    and dropped when the segments are merged. Every commit bumps a generation, an
+    index opened by another process reloads before its next search.
+    """
+
+    def __init__(self, directory: str, max_pending_docs: int = 100000):
+        self.directory = directory
+        self.max_pending_docs = max_pending_docs
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, 'index.sqlite3'), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS segments (name TEXT PRIMARY KEY)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS terms (term TEXT NOT NULL, segment TEXT NOT NULL, "
+                        "offset INTEGER NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (term, segment))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS docs (doc INTEGER PRIMARY KEY, chunk_id TEXT NOT NULL UNIQUE, "
+                        "length INTEGER NOT NULL, deleted INTEGER NOT NULL DEFAULT 0)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.db.commit()
+        # Held while the statistics are loaded again or used, the query threads of a process share them
+        self.lock = threading.RLock()
+        self.lengths_path = os.path.join(directory, 'lengths.u32')
+        self.pending: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        self.pending_docs: List[Tuple[int, str, int]] = []
+        self.reload()
+
+    def reload(self) -> None:
+        """Refresh the statistics and tombstones used for scoring."""
+        with self.lock:
+            # One read transaction, a commit of another process lands before or after all of it
+            started = not self.db.in_transaction
+            if started:
+                self.db.execute("BEGIN")
+            try:
+                self.generation = self.stored_generation()
+                self.segments = [name for (name,) in self.db.execute("SELECT name FROM segments ORDER BY name")]
+                self.num_docs, total_length = self.db.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs WHERE deleted = 0").fetchone()
+                self.deleted = np.array([doc for (doc,) in self.db.execute("SELECT doc FROM docs WHERE deleted = 1")], dtype=np.int64)
+                # Doc numbers index the lengths array and are never reused, the lengths are written before the commit
+                size = os.path.getsize(self.lengths_path) if os.path.exists(self.lengths_path) else 0
+            finally:
+                if started:
+                    self.db.rollback()
+            self.next_segment = int(self.segments[-1][len("seg_"):]) + 1 if self.segments else 0
+            self.average_length = total_length / self.num_docs if self.num_docs else 0.0
+            self.segment_arrays = {}
+            self.lengths = np.memmap(self.lengths_path, dtype=np.uint32, mode='r', shape=(size // 4,)) if size >= 4 else np.zeros(0, dtype=np.uint32)
+            self.next_doc = len(self.lengths)
+
+    def stored_generation(self) -> int:
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        return row[0] if row else 0
+
+    def commit(self) -> None:
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', "
+                        "COALESCE((SELECT value FROM meta WHERE key = 'generation'), 0) + 1)")
+        self.db.commit()
+
+    def __len__(self) -> int:
+        return self.num_docs
+
+    def segment_path(self, name: str, kind: str) -> str:
+        return os.path.join(self.directory, f"{name}.{kind}.npy")
+
+    def postings(self, name: str) -> Tuple[np.ndarray, np.ndarray]:
+        if name not in self.segment_arrays:
+            self.segment_arrays[name] = (np.load(self.segment_path(name, 'docs'), mmap_mode='r'),
+                                         np.load(self.segment_path(name, 'tfs'), mmap_mode='r'))
+        return self.segment_arrays[name]
+
+    # Writing, used by docs_loader.py
+
+    def add(self, chunk_ids: List[str], texts: List[str]) -> None:
+        for chunk_id, text in zip(chunk_ids, texts):
+            term_counts = Counter(tokenize(text))
+            doc = self.next_doc
+            self.next_doc += 1
+            self.pending_docs.append((doc, chunk_id, sum(term_counts.values())))
+            for term, count in term_counts.items():
+                self.pending[term].append((doc, min(count, 65535)))
+        # Bound the memory of a large ingestion run
+        if len(self.pending_docs) >= self.max_pending_docs:
+            self.flush()
+
+    def delete(self, chunk_ids: Iterable[str]) -> None:
+        chunk_ids = list(chunk_ids)
+        for i in range(0, len(chunk_ids), 500):
+            batch = chunk_ids[i:i+500]
+            self.db.execute(f"UPDATE docs SET deleted = 1 WHERE chunk_id IN ({','.join('?' * len(batch))})", batch)
+        self.commit()
+        self.reload()
+
+    def write_segment(self, postings: Dict[str, Tuple[np.ndarray, np.ndarray]]) -> None:
+        name = f"seg_{self.next_segment:08d}"
+        self.next_segment += 1
+        terms = []
+        offset = 0
+        for term in sorted(postings):
+            count = len(postings[term][0])
+            if count:
+                terms.append((term, name, offset, count))
+                offset += count
+        docs = np.concatenate([postings[term][0] for term, _, _, _ in terms]) if terms else np.zeros(0)
+        tfs = np.concatenate([postings[term][1] for term, _, _, _ in terms]) if terms else np.zeros(0)
+        np.save(self.segment_path(name, 'docs'), docs.astype(np.int32))
+        np.save(self.segment_path(name, 'tfs'), tfs.astype(np.uint16))
+        self.db.executemany("INSERT INTO terms (term, segment, offset, count) VALUES (?, ?, ?, ?)", terms)
+        self.db.execute("INSERT INTO segments (name) VALUES (?)", (name,))
+        self.segments.append(name)
+
+    def flush(self) -> None:
+        """Write the pending chunks as a new segment."""
+        if not self.pending_docs:
+            return
+        self.write_segment({term: (np.array([doc for doc, _ in term_postings]), np.array([tf for _, tf in term_postings]))
+                            for term, term_postings in self.pending.items()})
+        # A chunk id indexed again replaces its previous version, which keeps its doc number as a tombstone
+        self.db.executemany("UPDATE docs SET deleted = 1, chunk_id = '#' || doc WHERE chunk_id = ?",
+                            [(chunk_id,) for _, chunk_id, _ in self.pending_docs])
+        self.db.executemany("INSERT OR REPLACE INTO docs (doc, chunk_id, length, deleted) VALUES (?, ?, ?, 0)", self.pending_docs)
+        with open(self.lengths_path, 'ab') as f:
+            f.write(np.array([length for _, _, length in self.pending_docs], dtype=np.uint32).tobytes())
+        self.commit()
+        self.pending = defaultdict(list)
+        self.pending_docs = []
+        # Searches of this process see the new segment
+        self.reload()
+
+    def merge(self, max_segments: int = 8) -> None:
+        """Merge all segments into one and drop tombstoned chunks, once there are too many of either."""
+        self.flush()
+        self.reload()
+        if len(self.segments) <= max_segments and len(self.deleted) <= self.num_docs // 4:
+            return
+        merged = {}
+        rows = self.db.execute("SELECT term, segment, offset, count FROM terms ORDER BY term, segment").fetchall()
+        for term, segment, offset, count in rows:
+            docs, tfs = self.postings(segment)
+            docs, tfs = docs[offset:offset+count], tfs[offset:offset+count]
+            if term in merged:
+                docs, tfs = np.concatenate([merged[term][0], docs]), np.concatenate([merged[term][1], tfs])
+            merged[term] = (docs, tfs)
+        if len(self.deleted):
+            for term, (docs, tfs) in merged.items():
+                alive = ~np.isin(docs, self.deleted)
+                merged[term] = (docs[alive], tfs[alive])
+
+        old_segments = list(self.segments)
+        self.db.execute("DELETE FROM terms")
+        self.db.execute("DELETE FROM segments")
+        self.db.execute("DELETE FROM docs WHERE deleted = 1")
+        self.write_segment(merged)
+        self.commit()
+        merged = None
+        self.segment_arrays = {}
+        for segment in old_segments:
+            for kind in ('docs', 'tfs'):
+                os.remove(self.segment_path(segment, kind))
+        self.reload()
+
+    # Searching, used by vaultChat.py
+
+    def search(self, query: str, k: int) -> List[Tuple[str, float]]:
+        """Return the chunk ids and BM25 scores of the k best matching chunks."""
+        with self.lock:
+            if self.stored_generation() != self.generation:
+                self.reload()
+            try:
+                return self.score(query, k)
+            except (IndexError, FileNotFoundError):
+                # Another process committed between the generation check and the postings lookup
+                self.reload()
+                return self.score(query, k)
+
+    def score(self, query: str, k: int) -> List[Tuple[str, float]]:
+        terms = set(tokenize(query))
+        if not terms or not self.num_docs:
+            return []
+        scores = np.zeros(len(self.lengths), dtype=np.float32)
+        alive = np.ones(len(self.lengths), dtype=bool)
+        alive[self.deleted] = False
+        placeholders = ",".join("?" * len(terms))
+        locations = defaultdict(list)
+        for term, segment, offset, count in self.db.execute(
+                f"SELECT term, segment, offset, count FROM terms WHERE term IN ({placeholders})", list(terms)):
+            locations[term].append((segment, offset, count))
+
+        for term, term_locations in locations.items():
+            postings = []
+            for segment, offset, count in term_locations:
+                docs, tfs = self.postings(segment)
+                postings.append((np.asarray(docs[offset:offset+count]), np.asarray(tfs[offset:offset+count], dtype=np.float32)))
+            # Tombstoned and replaced chunks are not counted, like in num_docs
+            document_frequency = sum(int(np.count_nonzero(alive[docs])) for docs, _ in postings)
+            idf = max(0.0, float(np.log(1 + (self.num_docs - document_frequency + 0.5) / (document_frequency + 0.5))))
+            for docs, tfs in postings:
+                norm = K1 * (1 - B + B * self.lengths[docs].astype(np.float32) / max(self.average_length, 1e-9))
+                scores[docs] += idf * tfs * (K1 + 1) / (tfs + norm)
+
+        if len(self.deleted):
+            scores[self.deleted] = 0
+        candidates = np.flatnonzero(scores > 0)
+        if not len(candidates):
+            return []
+        best = candidates[np.argsort(-scores[candidates], kind='stable')[:k]]
+        placeholders = ",".join("?" * len(best))
+        chunk_ids = dict(self.db.execute(f"SELECT doc, chunk_id FROM docs WHERE doc IN ({placeholders})", best.tolist()))
+        return [(chunk_ids[doc], float(scores[doc])) for doc in best.tolist() if doc in chunk_ids]
+
+    def close(self) -> None:
+        self.flush()
+        self.db.close()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+import os
+import re
+import json
+import time
+import inspect
+import shutil
+import logging
+import tempfile
+from typing import Dict, List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+QUERY_ENCODERS = ("torch", "onnx", "onnx-int8")
+
+# Questions and passages compared between the exported and the original model
+VERIFICATION_TEXTS = [
+    "what is the notice period in the lease agreement",
+    "who signed the contract and when",
+    "summarize the main findings of the report",
+    "how do I reset my password",
+    "The invoice was paid on the 3rd of March after two reminders.",
+    "Quarterly revenue grew by 12% while operating costs stayed flat.",
+    "Für die Kündigung gilt eine Frist von drei Monaten.",
+    "a",
+]
+
+
+def encoder_directory(cache_directory: str, model_name: str, backend: str) -> str:
+    return os.path.join(cache_directory, re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name), backend)
+
+
+class OnnxQueryEncoder(Embeddings):
+    """
+    Sentence embeddings of an exported ONNX model, run with onnxruntime and the
+    tokenizers library only, so neither torch nor transformers are imported.
+    """
+
+    def __init__(self, directory: str, num_threads: int = 0, batch_size: int = 32):
+        import onnxruntime
+        from tokenizers import Tokenizer
+        with open(os.path.join(directory, "export.json"), encoding="utf-8") as f:
+            self.info = json.load(f)
+        self.batch_size = batch_size
+        self.tokenizer = Tokenizer.from_file(os.path.join(directory, "tokenizer.json"))
+        self.tokenizer.enable_truncation(self.info["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=self.info["pad_token_id"], pad_token=self.info["pad_token"])
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(os.path.join(directory, "model.onnx"), options,
+                                                    providers=["CPUExecutionProvider"])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        features = {
+            "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            "attention_mask": np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64),
+            "token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64),
+        }
+        return self.session.run(None, {name: features[name] for name in self.input_names})[0]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = [self.encode(texts[i:i+self.batch_size]) for i in range(0, len(texts), self.batch_size)]
+        return np.concatenate(vectors).tolist() if vectors else []
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.encode([text])[0].tolist()
+
+
+def mean_query_milliseconds(encode, texts: List[str], repeat: int = 5) -> float:
+    encode(texts[:1])
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            encode([text])
+    return (time.perf_counter() - start) * 1000 / (repeat * len(texts))
+
+
+def export_query_encoder(model_name: str, directory: str, backend: str, tolerance: float) -> Dict:
+    """
+    Export the sentence-transformers model, pooling and normalization included, to ONNX,
+    dynamically quantized to int8 weights for onnx-int8, then compare its embeddings with
+    the original model. The export is written to a temporary directory and moved in place.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    print(f"Exporting the {backend} query encoder of {model_name}, done once")
+    model = SentenceTransformer(model_name, device="cpu")
+    model.eval()
+    tokenizer = model.tokenizer
+    parent = os.path.dirname(directory)
+    os.makedirs(parent, exist_ok=True)
+    work = tempfile.mkdtemp(dir=parent, prefix=".export_")
+    try:
+        tokenizer.save_pretrained(work)
+        features = tokenizer(VERIFICATION_TEXTS[:2], padding=True, truncation=True,
+                             max_length=model.max_seq_length, return_tensors="pt")
+        input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in features]
+
+        class SentenceEmbedding(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.model = model
+
+            def forward(self, *inputs):
+                return self.model(dict(zip(input_names, inputs)))["sentence_embedding"]
+
+        export_options = {}
+        if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+            # The TorchScript exporter handles the dynamic batch and sequence axes without onnxscript
+            export_options["dynamo"] = False
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+        dynamic_axes["sentence_embedding"] = {0: "batch"}
+        fp32_path = os.path.join(work, "model_fp32.onnx")
+        with torch.no_grad():
+            torch.onnx.export(SentenceEmbedding(), tuple(features[name] for name in input_names), fp32_path,
+                              input_names=input_names, output_names=["sentence_embedding"],
+                              dynamic_axes=dynamic_axes, opset_version=14, **export_options)
+        if backend == "onnx-int8":
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            quantize_dynamic(fp32_path, os.path.join(work, "model.onnx"), weight_type=QuantType.QInt8)
+            os.remove(fp32_path)
+        else:
+            os.replace(fp32_path, os.path.join(work, "model.onnx"))
+
+        info = {"model_name": model_name, "backend": backend, "max_seq_length": model.max_seq_length,
+                "pad_token": tokenizer.pad_token, "pad_token_id": tokenizer.pad_token_id}
+        with open(os.path.join(work, "export.json"), "w", encoding="utf-8") as f:
+            json.dump(info, f)
+
+        # Queries are compared with document embeddings of the original model, the two must agree
+        expected = model.encode(VERIFICATION_TEXTS, convert_to_numpy=True)
+        encoder = OnnxQueryEncoder(work)
+        actual = encoder.encode(VERIFICATION_TEXTS)
+        cosines = np.sum(expected * actual, axis=1) / (np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1))
+        info["min_cosine"] = float(cosines.min())
+        info["tolerance"] = tolerance
+        info["verified"] = bool(info["min_cosine"] >= 1 - tolerance)
+        info["torch_query_ms"] = mean_query_milliseconds(lambda texts: model.encode(texts), VERIFICATION_TEXTS[:4])
+        info["onnx_query_ms"] = mean_query_milliseconds(encoder.encode, VERIFICATION_TEXTS[:4])
+        with open(os.path.join(work, "export.json"), "w", encoding="utf-8") as f:
+            json.dump(info, f, indent=1)
+        del encoder
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.replace(work, directory)
+    finally:
+        if os.path.exists(work):
+            shutil.rmtree(work)
+    print(f"Query encoder {backend}: minimum cosine similarity {info['min_cosine']:.5f} to the original model, "
+          f"{info['onnx_query_ms']:.1f} ms per query instead of {info['torch_query_ms']:.1f} ms")
+    return info
+
+
+def create_query_encoder(model_name: str, backend: str = "torch", cache_directory: str = "query_encoder_cache",
+                         tolerance: float = 0.01) -> Embeddings:
+    """
+    The embeddings used for questions. onnx and onnx-int8 run an export of the model cached
+    in cache_directory, the original torch model is used when the export is missing, fails
+    or embeds further than the tolerance from it.
+    """
+    if backend not in QUERY_ENCODERS:
+        raise ValueError(f"Unknown QUERY_ENCODER: {backend}")
+    if backend != "torch":
+        directory = encoder_directory(cache_directory, model_name, backend)
+        try:
+            if os.path.exists(os.path.join(directory, "export.json")):
+                with open(os.path.join(directory, "export.json"), encoding="utf-8") as f:
+                    info = json.load(f)
+            else:
+                info = export_query_encoder(model_name, directory, backend, tolerance)
+            if info.get("min_cosine", -1) >= 1 - tolerance:
+                return OnnxQueryEncoder(directory)
+            logging.warning(f"The {backend} query encoder differs from {model_name} (minimum cosine similarity "
+                            f"{info.get('min_cosine')}), using the original model")
+        except Exception as e:
+            logging.warning(f"The {backend} query encoder is unavailable, using the original model: {e}")
+    from langchain_huggingface import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(model_name=model_name)
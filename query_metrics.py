@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import json
+import math
+import time
+import logging
+import threading
+import contextvars
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+# vaultChat.py imports this module at startup, the langchain hooks are in query_tracing.py
+
+# Latency histogram buckets in seconds, from a cached answer to a slow local generation
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160]
+
+# Ollama counters reported in the generation info of the last streamed chunk
+OLLAMA_COUNTERS = ["prompt_eval_count", "prompt_eval_duration", "eval_count", "eval_duration", "load_duration", "total_duration"]
+
+current_trace: contextvars.ContextVar = contextvars.ContextVar("current_trace", default=None)
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile, q between 0 and 100."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    # q * n first, q / 100 * n is inexact in floating point, e.g. 7 / 100 * 100 > 7
+    rank = max(1, math.ceil(q * len(ordered) / 100))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class QueryTrace:
+    """Stage latencies and counters of one question."""
+
+    def __init__(self, query: str):
+        self.query = query
+        self.started = time.time()
+        self.stages: Dict[str, float] = defaultdict(float)
+        self.counters: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def add_stage(self, name: str, seconds: float) -> None:
+        with self.lock:
+            self.stages[name] += seconds
+
+    def set_counter(self, name: str, value: float) -> None:
+        with self.lock:
+            self.counters[name] = value
+
+    def to_dict(self) -> Dict:
+        return {"timestamp": self.started, "query": self.query,
+                "stages": {name: round(seconds, 6) for name, seconds in self.stages.items()},
+                "counters": dict(self.counters)}
+
+
+@contextmanager
+def stage(name: str):
+    """Time a stage of the current question, a no-op outside a traced question."""
+    trace = current_trace.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if trace is not None:
+            trace.add_stage(name, time.perf_counter() - start)
+
+
+def count(name: str, value: float) -> None:
+    trace = current_trace.get()
+    if trace is not None:
+        trace.set_counter(name, value)
+
+
+class QueryMetrics:
+    """
+    Per-stage latency histograms and counters of the answered questions,
+    rendered for the /stats command, the JSON-lines trace file and Prometheus.
+    """
+
+    def __init__(self, trace_file: Optional[str] = None, window: int = 1000):
+        self.trace_file = trace_file
+        self.lock = threading.Lock()
+        self.questions = 0
+        self.bucket_counts: Dict[str, List[int]] = defaultdict(lambda: [0] * len(BUCKETS))
+        self.sums: Dict[str, float] = defaultdict(float)
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.counter_totals: Dict[str, float] = defaultdict(float)
+        # Recent samples for the percentiles of /stats
+        self.recent: Dict[str, deque] = defaultdict(lambda: deque(maxlen=window))
+
+    def start(self, query: str) -> QueryTrace:
+        return QueryTrace(query)
+
+    def record(self, trace: QueryTrace) -> None:
+        with self.lock:
+            self.questions += 1
+            for name, seconds in trace.stages.items():
+                for i, bound in enumerate(BUCKETS):
+                    if seconds <= bound:
+                        self.bucket_counts[name][i] += 1
+                self.sums[name] += seconds
+                self.counts[name] += 1
+                self.recent[name].append(seconds)
+            for name, value in trace.counters.items():
+                if isinstance(value, (int, float)):
+                    self.counter_totals[name] += value
+        if self.trace_file:
+            try:
+                with open(self.trace_file, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(trace.to_dict()) + "\n")
+            except OSError as e:
+                logging.warning(f"Failed to write the query trace: {e}")
+
+    def summary(self) -> str:
+        with self.lock:
+            lines = [f"Questions answered: {self.questions}",
+                     f"{'stage':<20}{'count':>7}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}  (seconds)"]
+            for name in sorted(self.counts):
+                samples = list(self.recent[name])
+                lines.append(f"{name:<20}{self.counts[name]:>7}{self.sums[name] / self.counts[name]:>9.3f}"
+                             f"{percentile(samples, 50):>9.3f}{percentile(samples, 95):>9.3f}{percentile(samples, 99):>9.3f}")
+            for name in sorted(self.counter_totals):
+                lines.append(f"{name}: {self.counter_totals[name]:g} total")
+            return "\n".join(lines)
+
+    def prometheus(self) -> str:
+        """Render the metrics in the Prometheus text exposition format."""
+        with self.lock:
+            lines = ["# HELP vaultchat_questions_total Questions answered.",
+                     "# TYPE vaultchat_questions_total counter",
+                     f"vaultchat_questions_total {self.questions}",
+                     "# HELP vaultchat_stage_seconds Latency of each stage of the query path.",
+                     "# TYPE vaultchat_stage_seconds histogram"]
+            for name in sorted(self.counts):
+                for bound, bucket_count in zip(BUCKETS, self.bucket_counts[name]):
+                    lines.append(f'vaultchat_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {bucket_count}')
+                lines.append(f'vaultchat_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {self.counts[name]}')
+                lines.append(f'vaultchat_stage_seconds_sum{{stage="{name}"}} {self.sums[name]:.6f}')
+                lines.append(f'vaultchat_stage_seconds_count{{stage="{name}"}} {self.counts[name]}')
+            for name in sorted(self.counter_totals):
+                lines.append(f"# TYPE vaultchat_{name}_total counter")
+                lines.append(f"vaultchat_{name}_total {self.counter_totals[name]:g}")
+            return "\n".join(lines) + "\n"
+
+
+# Metrics of this process, the trace file is set by vaultChat.py
+metrics = QueryMetrics()
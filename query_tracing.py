@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+from typing import List
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.embeddings import Embeddings
+
+from query_metrics import OLLAMA_COUNTERS, QueryTrace, stage
+
+
+class TracedEmbeddings(Embeddings):
+    """Time the query embedding of the current question."""
+
+    def __init__(self, embeddings: Embeddings):
+        self.embeddings = embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        with stage("query_embedding"):
+            return self.embeddings.embed_query(text)
+
+
+class OllamaStatsHandler(BaseCallbackHandler):
+    """Copy the Ollama prompt-eval and eval counters of a generation into a trace."""
+
+    def __init__(self, trace: QueryTrace):
+        self.trace = trace
+
+    def on_llm_end(self, response, **kwargs) -> None:
+        for generations in response.generations:
+            for generation in generations:
+                info = generation.generation_info or {}
+                for name in OLLAMA_COUNTERS:
+                    if info.get(name) is not None:
+                        self.trace.set_counter(f"ollama_{name}", info[name])
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Tuple
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from query_metrics import count, stage
+
+
+class CrossEncoderReranker:
+    """
+    Score (question, chunk) pairs with a cross-encoder on the CPU, all the candidates of a
+    question in one batched pass. Scores are kept in a least recently used cache so the
+    chunks of repeated or follow-up questions are not scored again.
+    """
+
+    def __init__(self, model_name: str, batch_size: int = 32, cache_size: int = 10000, device: str = "cpu"):
+        from sentence_transformers import CrossEncoder
+        self.model = CrossEncoder(model_name, device=device)
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.cache: "OrderedDict[Tuple[str, bytes], float]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(query: str, document: Document) -> Tuple[str, bytes]:
+        return query, hashlib.blake2b(document.page_content.encode('utf-8'), digest_size=16).digest()
+
+    def score(self, query: str, documents: List[Document]) -> List[float]:
+        keys = [self.key(query, document) for document in documents]
+        scores = {}
+        with self.lock:
+            for key in keys:
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    scores[key] = self.cache[key]
+        missing = {key: document for key, document in zip(keys, documents) if key not in scores}
+        count("rerank_cache_hits", len(documents) - len(missing))
+        if missing:
+            pairs = [(query, document.page_content) for document in missing.values()]
+            computed = self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False)
+            scores.update(zip(missing, (float(value) for value in computed)))
+            with self.lock:
+                for key in missing:
+                    self.cache[key] = scores[key]
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return [scores[key] for key in keys]
+
+
+class RerankingRetriever(BaseRetriever):
+    """Over-fetch candidates with the base retriever and keep the top_n chunks of the cross-encoder."""
+
+    base_retriever: BaseRetriever
+    reranker: CrossEncoderReranker
+    top_n: int = 5
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        candidates = self.base_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        if not candidates:
+            return []
+        with stage("rerank"):
+            scores = self.reranker.score(query, candidates)
+        ranked = sorted(zip(candidates, scores), key=lambda ranked_document: ranked_document[1], reverse=True)
+        count("rerank_candidates", len(candidates))
+        logging.info(f"Rerank: {len(candidates)} candidates -> {min(self.top_n, len(candidates))} chunks")
+        return [document for document, _ in ranked[:self.top_n]]
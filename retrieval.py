@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+import os
+import hashlib
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, FrozenSet, List, Tuple, Union
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+
+from lexical_index import LexicalIndex
+from query_metrics import count, stage
+
+
+def document_key(document: Document) -> Tuple[str, str]:
+    return document.metadata.get('source', ''), document.page_content
+
+
+def reciprocal_rank_fusion(rankings: List[List[Document]], k: int, rrf_k: int = 60) -> List[Document]:
+    """Fuse ranked lists of documents, each document scores 1 / (rrf_k + rank) in every list it appears in."""
+    scores: Dict[Tuple[str, str], float] = {}
+    documents: Dict[Tuple[str, str], Document] = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking):
+            key = document_key(document)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank + 1)
+            documents.setdefault(key, document)
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [documents[key] for key in best]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Run BM25 over the lexical index and the vector search in parallel,
+    then fuse both rankings with reciprocal rank fusion.
+    """
+
+    vectorstore: VectorStore
+    lexical_index: Any
+    k: int = 5
+    fetch_k: int = 20
+    rrf_k: int = 60
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def vector_search(self, query: str) -> List[Document]:
+        with stage("vector_search"):
+            return self.vectorstore.similarity_search(query, k=self.fetch_k)
+
+    def lexical_search(self, query: str) -> List[Document]:
+        with stage("lexical_search"):
+            return self.lexical_search_documents(query)
+
+    def lexical_search_documents(self, query: str) -> List[Document]:
+        matches = self.lexical_index.search(query, self.fetch_k)
+        if not matches:
+            return []
+        ids = [chunk_id for chunk_id, _ in matches]
+        stored = self.vectorstore.get(ids=ids, include=['documents', 'metadatas'])
+        by_id = {chunk_id: Document(page_content=text, metadata=metadata or {})
+                 for chunk_id, text, metadata in zip(stored['ids'], stored['documents'], stored['metadatas'])}
+        # Chroma returns the chunks in storage order, restore the BM25 order
+        return [by_id[chunk_id] for chunk_id in ids if chunk_id in by_id]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            # Each search runs in a copy of the caller context so its stages land in the current query trace
+            vector_future = executor.submit(contextvars.copy_context().run, self.vector_search, query)
+            lexical_future = executor.submit(contextvars.copy_context().run, self.lexical_search, query)
+            vector_documents = vector_future.result()
+            try:
+                lexical_documents = lexical_future.result()
+            except Exception as e:
+                logging.warning(f"Lexical search failed, using the vector search only: {e}")
+                lexical_documents = []
+        return reciprocal_rank_fusion([vector_documents, lexical_documents], self.k, self.rrf_k)
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly 4 characters per token, close enough to compare context sizes
+    return len(text) // 4 + 1
+
+
+def shingles(text: str, size: int = 3) -> FrozenSet[int]:
+    words = text.lower().split()
+    if len(words) <= size:
+        return frozenset([hash(" ".join(words))])
+    return frozenset(hash(" ".join(words[i:i+size])) for i in range(len(words) - size + 1))
+
+
+def jaccard(a: FrozenSet[int], b: FrozenSet[int]) -> float:
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+
+# Metadata telling apart the documents a loader makes of one file: the pages of a PDF, the rows of a CSV
+LOADED_DOCUMENT_KEYS = ('source', 'page', 'page_number', 'row')
+
+
+def loaded_document(document: Document) -> Tuple:
+    """The loaded document a chunk was split from, its start_index counts from the start of it."""
+    return tuple(document.metadata.get(key) for key in LOADED_DOCUMENT_KEYS)
+
+
+def merge_adjacent(documents: List[Document], max_gap: int = 4) -> List[Document]:
+    """
+    Merge chunks of the same loaded document that overlap or follow each other in it,
+    using the start_index recorded by docs_loader.py. The merged chunk keeps the best rank.
+    A repeated table header, prefix_length characters, is not part of the source text.
+    """
+    merged: List[Document] = []
+    for document in documents:
+        start = document.metadata.get('start_index')
+        for i, kept in enumerate(merged):
+            kept_start = kept.metadata.get('start_index')
+            if start is None or kept_start is None or loaded_document(kept) != loaded_document(document):
+                continue
+            first, second = (kept, document) if kept_start <= start else (document, kept)
+            first_start, second_start = first.metadata['start_index'], second.metadata['start_index']
+            first_end = first_start + len(first.page_content) - first.metadata.get('prefix_length', 0)
+            second_text = second.page_content[second.metadata.get('prefix_length', 0):]
+            if second_start - first_end > max_gap:
+                continue
+            if second_start + len(second_text) <= first_end:
+                text = first.page_content
+            elif second_start >= first_end:
+                text = first.page_content + "\n" + second_text
+            else:
+                text = first.page_content + second_text[first_end - second_start:]
+            metadata = {**kept.metadata, 'start_index': first_start}
+            metadata.pop('prefix_length', None)
+            if first.metadata.get('prefix_length'):
+                metadata['prefix_length'] = first.metadata['prefix_length']
+            merged[i] = Document(page_content=text, metadata=metadata)
+            break
+        else:
+            merged.append(document)
+    return merged
+
+
+def pack_context(documents: List[Document], token_budget: int, dedup_similarity: float = 0.8,
+                 mmr_lambda: float = 0.7) -> List[Document]:
+    """
+    Drop duplicate and near-duplicate chunks, merge adjacent chunks of the same source,
+    then select chunks by maximal marginal relevance until the token budget is spent.
+    Relevance comes from the retrieval rank, redundancy from word shingle overlap.
+    """
+    unique: List[Document] = []
+    unique_shingles: List[FrozenSet[int]] = []
+    seen_hashes = set()
+    for document in documents:
+        digest = hashlib.blake2b(" ".join(document.page_content.split()).encode('utf-8'), digest_size=16).digest()
+        if digest in seen_hashes:
+            continue
+        document_shingles = shingles(document.page_content)
+        if any(jaccard(document_shingles, kept) >= dedup_similarity for kept in unique_shingles):
+            continue
+        seen_hashes.add(digest)
+        unique.append(document)
+        unique_shingles.append(document_shingles)
+
+    candidates = merge_adjacent(unique)
+    candidate_shingles = [shingles(document.page_content) for document in candidates]
+    relevance = [1.0 - rank / len(candidates) for rank in range(len(candidates))]
+
+    selected: List[int] = []
+    used_tokens = 0
+    remaining = list(range(len(candidates)))
+    while remaining:
+        def mmr(i):
+            redundancy = max((jaccard(candidate_shingles[i], candidate_shingles[j]) for j in selected), default=0.0)
+            return mmr_lambda * relevance[i] - (1 - mmr_lambda) * redundancy
+        best = max(remaining, key=mmr)
+        remaining.remove(best)
+        tokens = estimate_tokens(candidates[best].page_content)
+        if used_tokens + tokens > token_budget and selected:
+            continue
+        selected.append(best)
+        used_tokens += tokens
+    return [candidates[i] for i in selected]
+
+
+class ContextPackingRetriever(BaseRetriever):
+    """Post-process the retrieved chunks to fit the prompt of the "stuff" chain in a token budget."""
+
+    base_retriever: BaseRetriever
+    token_budget: int = 2000
+    dedup_similarity: float = 0.8
+    mmr_lambda: float = 0.7
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        documents = self.base_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        with stage("context_packing"):
+            packed = pack_context(documents, self.token_budget, self.dedup_similarity, self.mmr_lambda)
+        count("chunks_retrieved", len(documents))
+        tokens_before = sum(estimate_tokens(document.page_content) for document in documents)
+        tokens_after = sum(estimate_tokens(document.page_content) for document in packed)
+        logging.info(f"Context packing: {len(documents)} chunks, ~{tokens_before} tokens -> {len(packed)} chunks, "
+                     f"~{tokens_after} tokens ({tokens_before - tokens_after} tokens saved)")
+        return packed
+
+
+def build_retriever(db: VectorStore, k: int, hybrid: bool, lexical_index_directory: Union[str, Dict[str, str]],
+                    fetch_k: int, token_budget: int = 0, dedup_similarity: float = 0.8,
+                    mmr_lambda: float = 0.7, reranker: Any = None, rerank_candidates: int = 50) -> BaseRetriever:
+    """
+    Hybrid retriever when the lexical index was built by docs_loader.py, plain vector search otherwise,
+    then the cross-encoder reranking of rerank_candidates chunks down to k when a reranker is given,
+    followed by the context packing when a token budget is set. Sharded stores pass the lexical
+    index directory of each shard by name.
+    """
+    top_n = k
+    if reranker is not None:
+        # The first stage over-fetches, the reranker keeps the best k
+        k = max(k, rerank_candidates)
+    retriever = None
+    if isinstance(lexical_index_directory, dict):
+        from shards import ShardedLexicalIndex
+        indexes = {name: LexicalIndex(directory) for name, directory in lexical_index_directory.items()
+                   if os.path.isdir(directory)} if hybrid else {}
+        lexical_index = ShardedLexicalIndex(indexes) if indexes else None
+        lexical_index_directory = ", ".join(lexical_index_directory.values())
+    else:
+        lexical_index = LexicalIndex(lexical_index_directory) if hybrid and os.path.isdir(lexical_index_directory) else None
+    if lexical_index is not None:
+        if len(lexical_index):
+            retriever = HybridRetriever(vectorstore=db, lexical_index=lexical_index, k=k, fetch_k=max(fetch_k, k))
+    if retriever is None:
+        if hybrid:
+            logging.warning(f"No lexical index in {lexical_index_directory}, run docs_loader.py to enable hybrid search")
+        retriever = db.as_retriever(search_kwargs={"k": k})
+    if reranker is not None:
+        from reranker import RerankingRetriever
+        retriever = RerankingRetriever(base_retriever=retriever, reranker=reranker, top_n=top_n)
+    if token_budget > 0:
+        retriever = ContextPackingRetriever(base_retriever=retriever, token_budget=token_budget,
+                                            dedup_similarity=dedup_similarity, mmr_lambda=mmr_lambda)
+    return retriever
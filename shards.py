@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+import os
+import time
+import hashlib
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from query_metrics import stage
+from vector_store import MmapVectorStore
+
+
+def parse_shards(setting: str, source_directory: str) -> Dict[str, Dict[str, str]]:
+    """
+    Shards of the SHARDS setting, by directory: "legal=private_documents/legal, hr=private_documents/hr",
+    or by a hash of the source path under SOURCE_DIRECTORY: "hash:4", named shard-0 to shard-3.
+    Each shard has its source directory and, for hash shards, its "index/count" hash bucket.
+    """
+    setting = setting.strip()
+    if not setting:
+        return {}
+    if setting.startswith("hash:"):
+        count = int(setting[len("hash:"):])
+        if count < 1:
+            raise ValueError(f"Invalid SHARDS: {setting}")
+        return {f"shard-{i}": {"source_directory": source_directory, "hash": f"{i}/{count}"} for i in range(count)}
+    shards = {}
+    for item in setting.split(","):
+        name, separator, directory = item.partition("=")
+        if not separator or not name.strip() or not directory.strip():
+            raise ValueError(f"Invalid SHARDS entry, expected name=directory: {item.strip()}")
+        shards[name.strip()] = {"source_directory": directory.strip(), "hash": ""}
+    return shards
+
+
+def shard_directory(persist_directory: str, name: str) -> str:
+    return os.path.join(persist_directory, "shards", name)
+
+
+def hash_bucket(relative_path: str, count: int) -> int:
+    """Hash bucket of a source path among count buckets, stable across runs and machines."""
+    digest = hashlib.sha1(relative_path.replace(os.sep, "/").encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+
+def partition_files(file_paths: Iterable[str], source_directory: str, count: int) -> List[List[str]]:
+    """Split the files found by a single walk of source_directory into count hash buckets."""
+    buckets: List[List[str]] = [[] for _ in range(count)]
+    for file_path in file_paths:
+        buckets[hash_bucket(os.path.relpath(file_path, source_directory), count)].append(file_path)
+    return buckets
+
+
+def select_shards(shards: Dict[str, Dict[str, str]], names: str) -> List[str]:
+    """The shard names of a comma-separated selection, all shards when empty."""
+    selected = [name.strip() for name in (names or "").split(",") if name.strip()] or list(shards)
+    unknown = [name for name in selected if name not in shards]
+    if unknown:
+        raise ValueError(f"Unknown shards: {', '.join(unknown)}, configured shards: {', '.join(shards)}")
+    return selected
+
+
+def search_by_vector(store: VectorStore, embedding: List[float], k: int) -> List[Tuple[Document, float]]:
+    """Documents with a score where higher is more similar, comparable between shards of the same backend."""
+    if isinstance(store, MmapVectorStore):
+        return store.similarity_search_by_vector_with_score(embedding, k)
+    # Chroma returns distances
+    return [(document, -distance) for document, distance in store.similarity_search_by_vector_with_relevance_scores(embedding, k)]
+
+
+class ShardedVectorStore(VectorStore):
+    """
+    Fan-out over the vector stores of several shards. The query is embedded once, the
+    shards are searched concurrently and their top k results merged by score. The search
+    time of each shard is recorded as the shard_<name> stage of the query trace.
+    """
+
+    def __init__(self, stores: Dict[str, VectorStore], embedding_function: Embeddings):
+        self.stores = stores
+        self.embedding_function = embedding_function
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(stores)), thread_name_prefix="vaultchat-shard")
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding_function
+
+    def search_shard(self, name: str, embedding: List[float], k: int) -> List[Tuple[Document, float]]:
+        start = time.perf_counter()
+        with stage(f"shard_{name}"):
+            results = search_by_vector(self.stores[name], embedding, k)
+        logging.debug(f"Shard {name}: {len(results)} chunks in {time.perf_counter() - start:.3f}s")
+        return results
+
+    def similarity_search_by_vector_with_score(self, embedding: List[float], k: int = 4) -> List[Tuple[Document, float]]:
+        futures = [self.executor.submit(contextvars.copy_context().run, self.search_shard, name, embedding, k)
+                   for name in self.stores]
+        results = []
+        for name, future in zip(self.stores, futures):
+            try:
+                results.extend(future.result())
+            except Exception as e:
+                logging.warning(f"Search of shard {name} failed: {e}")
+        return sorted(results, key=lambda result: result[1], reverse=True)[:k]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self.embedding_function.embed_query(query), k)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_with_score(query, k)]
+
+    def get(self, **kwargs: Any) -> Dict[str, List]:
+        """Chroma-style get over all shards, chunk ids are unique across shards."""
+        merged: Dict[str, List] = {}
+        for store in self.stores.values():
+            for key, values in store.get(**kwargs).items():
+                if isinstance(values, list):
+                    merged.setdefault(key, []).extend(values)
+        return merged
+
+    def add_texts(self, texts, metadatas: Optional[List[Dict]] = None, **kwargs: Any) -> List[str]:
+        raise NotImplementedError("Shards are written by docs_loader.py, one shard at a time")
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError("Shards are written by docs_loader.py, one shard at a time")
+
+
+class ShardedLexicalIndex:
+    """
+    BM25 search over the lexical indexes of several shards, searched concurrently.
+    BM25 scores depend on the document frequencies of each shard and cannot be compared
+    between shards, so the rankings are merged with reciprocal rank fusion.
+    """
+
+    def __init__(self, indexes: Dict[str, Any], rrf_k: int = 60):
+        self.indexes = indexes
+        self.rrf_k = rrf_k
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(indexes)), thread_name_prefix="vaultchat-lexical-shard")
+
+    def __len__(self) -> int:
+        return sum(len(index) for index in self.indexes.values())
+
+    def search_shard(self, name: str, query: str, k: int) -> List[Tuple[str, float]]:
+        with stage(f"shard_{name}_lexical"):
+            return self.indexes[name].search(query, k)
+
+    def search(self, query: str, k: int) -> List[Tuple[str, float]]:
+        """The top k chunk ids of all shards with their fused score."""
+        futures = [self.executor.submit(contextvars.copy_context().run, self.search_shard, name, query, k)
+                   for name in self.indexes]
+        scores: Dict[str, float] = {}
+        for name, future in zip(self.indexes, futures):
+            try:
+                results = future.result()
+            except Exception as e:
+                logging.warning(f"Lexical search of shard {name} failed: {e}")
+                continue
+            for rank, (chunk_id, _) in enumerate(results):
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+        return sorted(scores.items(), key=lambda result: result[1], reverse=True)[:k]
@@ -0,0 +1,68 @@
+import os
+import time
+
+from langchain_core.documents import Document
+
+from answer_cache import AnswerCache
+
+VECTORS = {"how do I reset my password": [1.0, 0.0, 0.0],
+           "how can I reset my password": [0.99, 0.1, 0.0],
+           "where is the office": [0.0, 1.0, 0.0],
+           "who signed the contract": [0.0, 0.0, 1.0]}
+
+
+def cache(tmp_path, **settings):
+    manifest = tmp_path / "ingest_manifest.json"
+    if not manifest.exists():
+        manifest.write_text("{}", encoding="utf-8")
+    return AnswerCache(str(tmp_path / "answers.sqlite3"), str(manifest), "config", VECTORS.__getitem__, **settings)
+
+
+def answer(query):
+    return {"query": query, "result": f"answer to {query}",
+            "source_documents": [Document(page_content="context", metadata={"source": "doc.md"})]}
+
+
+def test_exact_and_similar_questions_hit(tmp_path):
+    answers = cache(tmp_path)
+    assert answers.lookup("how do I reset my password")[0] is None
+    answers.store("how do I reset my password", answer("how do I reset my password"))
+    exact, _ = answers.lookup("how do I reset my password")
+    assert exact["cache_hit"] == "exact" and exact["source_documents"][0].metadata == {"source": "doc.md"}
+    similar, _ = answers.lookup("how can I reset my password")
+    assert similar["cache_hit"] == "similar" and similar["result"] == "answer to how do I reset my password"
+    assert answers.lookup("where is the office")[0] is None
+
+
+def test_answer_without_sources_does_not_serve_a_question_needing_them(tmp_path):
+    answers = cache(tmp_path)
+    answers.store("where is the office", {"query": "where is the office", "result": "upstairs"})
+    assert answers.lookup("where is the office", need_sources=True)[0] is None
+    assert answers.lookup("where is the office", need_sources=False)[0]["result"] == "upstairs"
+
+
+def test_new_ingestion_invalidates_the_answers(tmp_path):
+    answers = cache(tmp_path)
+    answers.store("where is the office", answer("where is the office"))
+    manifest = tmp_path / "ingest_manifest.json"
+    manifest.write_text('{"doc.md": {}}', encoding="utf-8")
+    os.utime(manifest, ns=(time.time_ns() + 10**9, time.time_ns() + 10**9))
+    assert answers.lookup("where is the office")[0] is None
+
+
+def test_least_recently_used_answers_are_evicted(tmp_path):
+    answers = cache(tmp_path, max_entries=2)
+    answers.store("where is the office", answer("where is the office"))
+    answers.store("who signed the contract", answer("who signed the contract"))
+    time.sleep(0.01)
+    assert answers.lookup("where is the office")[0] is not None
+    answers.store("how do I reset my password", answer("how do I reset my password"))
+    assert answers.lookup("who signed the contract")[0] is None
+    assert answers.lookup("where is the office")[0] is not None
+
+
+def test_expired_answers_are_not_served(tmp_path):
+    answers = cache(tmp_path, ttl_seconds=0.01)
+    answers.store("where is the office", answer("where is the office"))
+    time.sleep(0.05)
+    assert answers.lookup("where is the office")[0] is None
@@ -0,0 +1,32 @@
+import json
+
+from docs_loader import append_checkpoint, chunk_id, load_checkpoint
+
+
+def test_chunk_id_is_deterministic():
+    assert chunk_id("doc.md", 0, "text") == chunk_id("doc.md", 0, "text")
+    assert len({chunk_id("doc.md", 0, "text"), chunk_id("doc.md", 1, "text"),
+                chunk_id("other.md", 0, "text"), chunk_id("doc.md", 0, "changed")}) == 4
+
+
+def test_checkpoint_round_trip_keeps_the_last_entry_of_a_source(tmp_path):
+    path = str(tmp_path / "ingest_checkpoint.jsonl")
+    fingerprint = {"size": 10, "mtime": 1.0, "sha256": "abc"}
+    append_checkpoint({"a.md": {**fingerprint, "complete": False}, "b.md": {**fingerprint, "complete": True}}, path)
+    append_checkpoint({"a.md": {**fingerprint, "complete": True}}, path)
+    assert load_checkpoint(path) == {"a.md": {**fingerprint, "complete": True}, "b.md": {**fingerprint, "complete": True}}
+
+
+def test_truncated_last_line_is_dropped(tmp_path):
+    path = tmp_path / "ingest_checkpoint.jsonl"
+    complete = json.dumps({"source": "a.md", "size": 1, "mtime": 1.0, "sha256": "abc", "complete": True})
+    path.write_text(complete + "\n" + '{"source": "b.md", "si', encoding="utf-8")
+    assert list(load_checkpoint(str(path))) == ["a.md"]
+    # The partial line is removed so the next append starts on a new line
+    assert path.read_text(encoding="utf-8") == complete + "\n"
+    append_checkpoint({"b.md": {"size": 2, "mtime": 2.0, "sha256": "def", "complete": False}}, str(path))
+    assert list(load_checkpoint(str(path))) == ["a.md", "b.md"]
+
+
+def test_missing_checkpoint(tmp_path):
+    assert load_checkpoint(str(tmp_path / "missing.jsonl")) == {}
@@ -0,0 +1,60 @@
+from langchain_core.documents import Document
+
+from chunker import StructuredChunker
+from retrieval import merge_adjacent
+
+
+def chunker(chunk_size=40, chunk_overlap=3):
+    # Without a cached tokenizer, chunk sizes are estimated at 4 characters per token
+    return StructuredChunker("vaultchat-tests/missing-model", chunk_size, chunk_overlap, local_files_only=True)
+
+
+def split(text, **settings):
+    return chunker(**settings).split_documents([Document(page_content=text, metadata={"source": "doc.md"})])
+
+
+def source_text(text, chunk):
+    prefix_length = chunk.metadata.get("prefix_length", 0)
+    start = chunk.metadata["start_index"]
+    return text[start:start + len(chunk.page_content) - prefix_length]
+
+
+PARAGRAPHS = "# Title\n\n" + "\n\n".join(f"Paragraph {i} " + "word " * 15 + "end." for i in range(4))
+TABLE = "| a | b |\n|---|---|\n" + "".join(f"| r{i} | " + "x " * 10 + "|\n" for i in range(10))
+
+
+def test_chunks_of_a_section_overlap():
+    chunks = split(PARAGRAPHS)
+    assert len(chunks) > 1
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk.metadata["start_index"] < previous.metadata["start_index"] + len(previous.page_content)
+        assert previous.page_content.endswith(chunk.page_content.split("\n\n")[0])
+
+
+def test_no_overlap_after_a_heading():
+    text = "# One\n\n" + "alpha " * 20 + "\n\n# Two\n\n" + "beta " * 20
+    chunks = split(text)
+    assert [chunk.page_content.split("\n")[0] for chunk in chunks] == ["# One", "# Two"]
+
+
+def test_no_overlap_when_disabled():
+    chunks = split(PARAGRAPHS, chunk_overlap=0)
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk.metadata["start_index"] >= previous.metadata["start_index"] + len(previous.page_content)
+
+
+def test_table_pieces_keep_their_start_index():
+    text = "# Table\n\n" + TABLE
+    chunks = split(text)
+    repeated = [chunk for chunk in chunks if chunk.metadata.get("prefix_length")]
+    assert repeated
+    for chunk in chunks:
+        assert chunk.page_content.endswith(source_text(text, chunk))
+    for chunk in repeated:
+        assert chunk.page_content.startswith("| a | b |\n|---|---|\n")
+
+
+def test_merged_table_pieces_repeat_no_header():
+    text = TABLE
+    merged = merge_adjacent(split(text))
+    assert [chunk.page_content for chunk in merged] == [text.rstrip()]
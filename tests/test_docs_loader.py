@@ -0,0 +1,65 @@
+import os
+import time
+import threading
+
+import pytest
+
+from langchain_core.documents import Document
+
+import docs_loader
+from docs_loader import LoaderPool
+
+
+class PassThroughSplitter:
+    def __init__(self, local_files_only=False):
+        pass
+
+    def split_documents(self, documents):
+        return documents
+
+
+def fake_load_single_document(file_path):
+    if "stuck" in file_path:
+        time.sleep(60)
+    if "crash" in file_path:
+        os._exit(1)
+    return [Document(page_content=file_path, metadata={"source": file_path})]
+
+
+def run_pool(monkeypatch, tasks, file_timeout=1.0, max_tasks=0):
+    # The workers are forked, so they inherit the patched loader
+    monkeypatch.setattr(docs_loader, "load_single_document", fake_load_single_document)
+    monkeypatch.setattr(docs_loader, "create_text_splitter", PassThroughSplitter)
+    results = []
+    pool = LoaderPool(2, file_timeout=file_timeout, max_tasks=max_tasks)
+    pool.run(tasks, max_pending=100, consumed=lambda: len(results), emit=results.append, stopped=threading.Event())
+    return {file_path: (num_documents, chunks, timed_out) for file_path, num_documents, chunks, _, timed_out in results}
+
+
+def test_stuck_worker_is_killed_and_the_rest_of_its_task_is_loaded(monkeypatch):
+    start = time.perf_counter()
+    results = run_pool(monkeypatch, [["a.txt", "stuck.txt", "b.txt"], ["c.txt"], ["d.txt"]])
+    assert time.perf_counter() - start < 30
+    assert results["stuck.txt"] == (0, [], True)
+    assert sorted(path for path, (num_documents, _, _) in results.items() if num_documents) == ["a.txt", "b.txt", "c.txt", "d.txt"]
+
+
+def test_crashed_worker_is_replaced(monkeypatch):
+    results = run_pool(monkeypatch, [["crash.txt", "a.txt"], ["b.txt"]])
+    assert results["crash.txt"] == (0, [], False)
+    assert results["a.txt"][0] == 1 and results["b.txt"][0] == 1
+
+
+def test_workers_are_recycled_after_max_tasks(monkeypatch):
+    tasks = [[f"{index}.txt"] for index in range(7)]
+    results = run_pool(monkeypatch, tasks, max_tasks=2)
+    assert all(results[task[0]][0] == 1 for task in tasks)
+
+
+def test_broken_loader_setup_ends_the_run(monkeypatch):
+    def broken_splitter(local_files_only=False):
+        raise ImportError("missing parser")
+
+    monkeypatch.setattr(docs_loader, "create_text_splitter", broken_splitter)
+    with pytest.raises(RuntimeError):
+        LoaderPool(2).run([["a.txt"]], max_pending=100, consumed=lambda: 0, emit=lambda result: None, stopped=threading.Event())
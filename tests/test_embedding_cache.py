@@ -0,0 +1,49 @@
+import time
+
+from embedding_cache import CachedEmbeddings, EmbeddingCache, text_key
+
+
+class CountingEmbeddings:
+    def __init__(self):
+        self.embedded = []
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return [[float(len(text)), float(text.count("a")), 1.0] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def test_misses_are_embedded_once(tmp_path):
+    model = CountingEmbeddings()
+    embeddings = CachedEmbeddings(model, EmbeddingCache(str(tmp_path), "test/model"))
+    first = embeddings.embed_documents(["alpha", "beta", "alpha"])
+    assert model.embedded == ["alpha", "beta"]
+    # Whitespace differences share an entry
+    second = embeddings.embed_documents(["beta", " alpha\n"])
+    assert model.embedded == ["alpha", "beta"]
+    assert second == [first[1], first[0]]
+    assert (embeddings.cache.hits, embeddings.cache.misses) == (3, 2)
+
+
+def test_cache_persists_across_runs(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "test/model")
+    CachedEmbeddings(CountingEmbeddings(), cache).embed_documents(["alpha"])
+    cache.close()
+    model = CountingEmbeddings()
+    assert CachedEmbeddings(model, EmbeddingCache(str(tmp_path), "test/model")).embed_documents(["alpha"]) == [[5.0, 2.0, 1.0]]
+    assert model.embedded == []
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "test/model", max_entries=3)
+    cache.put_many([text_key(text) for text in ("a", "b", "c")], [[1.0, 0.0], [2.0, 0.0], [3.0, 0.0]])
+    time.sleep(0.01)
+    cache.get_many([text_key("a")])
+    cache.put_many([text_key("d"), text_key("e")], [[4.0, 0.0], [5.0, 0.0]])
+    assert len(cache) == 3 and cache.evictions == 2
+    found = cache.get_many([text_key(text) for text in ("a", "b", "c", "d", "e")])
+    assert sorted(vector[0] for vector in found.values()) == [1.0, 4.0, 5.0]
+    # Evicted rows are reused, the vectors file does not grow past the cache size
+    assert cache.capacity == 3
@@ -0,0 +1,64 @@
+from lexical_index import LexicalIndex, tokenize
+
+
+def test_tokenize_keeps_compound_identifiers():
+    assert tokenize("Invoice INV-2024/07 paid") == ["invoice", "inv", "2024", "07", "inv-2024/07", "paid"]
+
+
+def test_search_right_after_flush(tmp_path):
+    index = LexicalIndex(str(tmp_path))
+    index.add(["a", "b"], ["the lease notice period", "quarterly revenue report"])
+    index.flush()
+    assert [chunk_id for chunk_id, _ in index.search("lease", 5)] == ["a"]
+
+
+def test_scores_stay_positive_after_delete_and_readd(tmp_path):
+    index = LexicalIndex(str(tmp_path))
+    index.add(["a", "b", "c"], ["apple apple apple pear", "apple pear", "plum"])
+    index.flush()
+    index.delete(["a", "b"])
+    index.add(["a", "b"], ["apple apple apple pear", "apple pear"])
+    index.flush()
+    results = index.search("apple", 5)
+    assert [chunk_id for chunk_id, _ in results] == ["a", "b"]
+    assert all(score > 0 for _, score in results)
+
+
+def test_deleted_chunks_are_not_returned(tmp_path):
+    index = LexicalIndex(str(tmp_path))
+    index.add(["a", "b"], ["contract signed", "contract draft"])
+    index.flush()
+    index.delete(["a"])
+    assert [chunk_id for chunk_id, _ in index.search("contract", 5)] == ["b"]
+
+
+def test_merge_drops_tombstones(tmp_path):
+    index = LexicalIndex(str(tmp_path))
+    for i in range(10):
+        index.add([f"c{i}"], [f"word{i} common"])
+        index.flush()
+    index.delete(["c0", "c1", "c2", "c3"])
+    index.merge(max_segments=2)
+    assert len(index.segments) == 1
+    assert len(index) == 6
+    assert not len(index.deleted)
+    reopened = LexicalIndex(str(tmp_path))
+    assert sorted(chunk_id for chunk_id, _ in reopened.search("common", 10)) == [f"c{i}" for i in range(4, 10)]
+
+
+def test_open_reader_sees_the_writes_of_another_instance(tmp_path):
+    writer = LexicalIndex(str(tmp_path))
+    writer.add(["a", "b"], ["contract signed", "contract draft"])
+    writer.flush()
+    reader = LexicalIndex(str(tmp_path))
+    assert {chunk_id for chunk_id, _ in reader.search("contract", 5)} == {"a", "b"}
+    # A new ingestion run adds doc numbers past the lengths the reader had loaded
+    writer.add(["c"], ["contract renewal"])
+    writer.flush()
+    assert [chunk_id for chunk_id, _ in reader.search("renewal", 5)] == ["c"]
+    writer.delete(["a"])
+    assert {chunk_id for chunk_id, _ in reader.search("contract", 5)} == {"b", "c"}
+    writer.merge(max_segments=1)
+    assert {chunk_id for chunk_id, _ in reader.search("contract", 5)} == {"b", "c"}
+    reader.close()
+    writer.close()
@@ -0,0 +1,48 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+from query_metrics import QueryMetrics, metrics, percentile, stage
+
+REPOSITORY_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+@pytest.mark.parametrize("values, q, expected", [
+    ([1, 2], 50, 1),
+    (list(range(1, 7)), 50, 3),
+    (list(range(1, 101)), 95, 95),
+    (list(range(1, 101)), 99, 99),
+    (list(range(1, 101)), 7, 7),
+    (list(range(1, 101)), 100, 100),
+    ([5], 50, 5),
+    ([3, 1, 2], 0, 1),
+])
+def test_nearest_rank_percentile(values, q, expected):
+    assert percentile(values, q) == expected
+
+
+def test_percentile_of_no_values():
+    assert percentile([], 50) is None
+
+
+def test_stages_are_recorded_in_the_current_trace():
+    from query_metrics import current_trace
+    recorder = QueryMetrics()
+    trace = metrics.start("question")
+    token = current_trace.set(trace)
+    try:
+        with stage("retrieval"):
+            pass
+    finally:
+        current_trace.reset(token)
+    recorder.record(trace)
+    assert recorder.counts["retrieval"] == 1
+    assert "retrieval" in recorder.summary()
+
+
+def test_vaultchat_starts_without_importing_langchain():
+    code = "import sys, vaultChat; print(sorted(name for name in sys.modules if name.startswith(('langchain', 'chromadb'))))"
+    result = subprocess.run([sys.executable, "-c", code], cwd=REPOSITORY_ROOT, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "[]"
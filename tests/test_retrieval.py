@@ -0,0 +1,38 @@
+from langchain_core.documents import Document
+
+from retrieval import merge_adjacent, pack_context, reciprocal_rank_fusion
+
+
+def chunk(text, source="doc.pdf", start=0, **metadata):
+    return Document(page_content=text, metadata={"source": source, "start_index": start, **metadata})
+
+
+def test_merge_adjacent_chunks_of_a_document():
+    merged = merge_adjacent([chunk("hello world", start=0), chunk("world again", start=6)])
+    assert [document.page_content for document in merged] == ["hello world again"]
+
+
+def test_merge_keeps_chunks_of_different_pdf_pages():
+    pages = [chunk("page three text", page=3), chunk("page seven text", page=7)]
+    assert [document.page_content for document in merge_adjacent(pages)] == ["page three text", "page seven text"]
+
+
+def test_merge_keeps_chunks_of_different_csv_rows():
+    rows = [chunk("name: a", source="data.csv", row=0), chunk("name: b", source="data.csv", row=5)]
+    assert [document.page_content for document in merge_adjacent(rows)] == ["name: a", "name: b"]
+
+
+def test_pack_context_keeps_every_pdf_page():
+    pages = [chunk(f"distinct content of page {page} " + "word " * page, page=page) for page in range(4)]
+    packed = pack_context(pages, token_budget=2000)
+    assert sorted(document.metadata["page"] for document in packed) == [0, 1, 2, 3]
+
+
+def test_pack_context_drops_duplicates():
+    packed = pack_context([chunk("same text here", page=1), chunk("same  text here", page=2)], token_budget=2000)
+    assert len(packed) == 1
+
+
+def test_reciprocal_rank_fusion_prefers_documents_in_both_rankings():
+    a, b, c = chunk("a", start=None), chunk("b", start=None), chunk("c", start=None)
+    assert reciprocal_rank_fusion([[a, b], [c, b]], k=1) == [b]
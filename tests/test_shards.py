@@ -0,0 +1,45 @@
+import os
+
+from shards import ShardedLexicalIndex, hash_bucket, partition_files, parse_shards
+
+
+class FakeIndex:
+    def __init__(self, results):
+        self.results = results
+
+    def __len__(self):
+        return len(self.results)
+
+    def search(self, query, k):
+        return self.results[:k]
+
+
+def test_lexical_shards_are_fused_by_rank_not_raw_score():
+    # BM25 scores of a small shard are much higher than those of a large one
+    index = ShardedLexicalIndex({"small": FakeIndex([("s1", 40.0), ("s2", 35.0), ("s3", 30.0)]),
+                                 "large": FakeIndex([("l1", 4.0), ("l2", 3.0), ("l3", 2.0)])})
+    assert [chunk_id for chunk_id, _ in index.search("query", 4)] == ["s1", "l1", "s2", "l2"]
+
+
+def test_failed_shard_is_skipped():
+    class BrokenIndex(FakeIndex):
+        def search(self, query, k):
+            raise OSError("index missing")
+
+    index = ShardedLexicalIndex({"ok": FakeIndex([("a", 1.0)]), "broken": BrokenIndex([])})
+    assert [chunk_id for chunk_id, _ in index.search("query", 5)] == ["a"]
+
+
+def test_partition_puts_every_file_in_its_hash_bucket():
+    source_directory = os.path.join("vault", "docs")
+    files = [os.path.join(source_directory, f"folder{i % 3}", f"file{i}.md") for i in range(50)]
+    buckets = partition_files(files, source_directory, 4)
+    assert sorted(sum(buckets, [])) == sorted(files)
+    for index, bucket in enumerate(buckets):
+        assert all(hash_bucket(os.path.relpath(file_path, source_directory), 4) == index for file_path in bucket)
+
+
+def test_hash_shards():
+    shards = parse_shards("hash:3", "vault")
+    assert list(shards) == ["shard-0", "shard-1", "shard-2"]
+    assert shards["shard-2"] == {"source_directory": "vault", "hash": "2/3"}
@@ -0,0 +1,54 @@
+import json
+import time
+import asyncio
+
+from langchain_core.documents import Document
+
+from vault_server import VaultServer
+
+
+def slow_stream_answer(qa, query):
+    yield "sources", [Document(page_content="context", metadata={"source": "doc.md"})]
+    for word in ("first", "second", "third"):
+        time.sleep(0.02)
+        yield "token", f"{query}-{word} "
+    yield "done", {}
+
+
+async def ask(port, question, session):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    body = json.dumps({"question": question, "session": session}).encode()
+    writer.write(f"POST /ask HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return response.decode()
+
+
+def test_questions_of_a_session_do_not_interleave():
+    async def run():
+        vault = VaultServer(None, slow_stream_answer, workers=4)
+        server = await asyncio.start_server(vault.handle_connection, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            await asyncio.gather(ask(port, "a", "s"), ask(port, "b", "s"))
+        return vault.sessions["s"].history
+
+    history = asyncio.run(run())
+    assert len(history) == 2
+    for turn in history:
+        question = turn.split("### Question: ")[1][0]
+        assert f"{question}-first {question}-second {question}-third" in turn
+
+
+def test_sessions_are_capped_and_expire():
+    vault = VaultServer(None, slow_stream_answer, max_sessions=3, session_ttl_seconds=60)
+    for name in ("a", "b", "c", "d"):
+        vault.session(name)
+    assert list(vault.sessions) == ["b", "c", "d"]
+    vault.session("b")
+    vault.session("e")
+    assert list(vault.sessions) == ["d", "b", "e"]
+    vault.sessions["d"].last_used -= 120
+    vault.session("b")
+    assert list(vault.sessions) == ["e", "b"]
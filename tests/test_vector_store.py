@@ -0,0 +1,148 @@
+import os
+
+import numpy as np
+import pytest
+
+import vector_store
+from vector_store import MmapVectorStore
+
+
+def random_vectors(count, dimension=16, seed=0):
+    return np.random.default_rng(seed).normal(size=(count, dimension)).astype(np.float32)
+
+
+def add(store, vectors, prefix="chunk", start=0):
+    ids = [f"{prefix}-{start + i}" for i in range(len(vectors))]
+    store.add_embeddings(ids, [f"text {chunk_id}" for chunk_id in ids],
+                         [{"source": f"doc{(start + i) % 5}.md"} for i in range(len(vectors))], vectors)
+    return ids
+
+
+@pytest.fixture(params=["int8", "float16", "none"])
+def store(request, tmp_path):
+    store = MmapVectorStore(str(tmp_path / "vectors"), None, quantization=request.param)
+    yield store
+    store.close()
+
+
+def test_search_finds_the_stored_vector(store):
+    vectors = random_vectors(200)
+    ids = add(store, vectors)
+    for i in (0, 57, 199):
+        document, score = store.similarity_search_by_vector_with_score(vectors[i].tolist(), k=1)[0]
+        assert document.page_content == f"text {ids[i]}"
+        assert score == pytest.approx(1.0, abs=1e-4)
+
+
+def test_stored_id_is_replaced(store):
+    vectors = random_vectors(10)
+    add(store, vectors)
+    store.add_embeddings(["chunk-3"], ["new text"], [{"source": "doc3.md"}], random_vectors(1, seed=1))
+    assert len(store) == 10
+    assert store.get(ids=["chunk-3"])["documents"] == ["new text"]
+
+
+def test_deleted_chunks_are_not_returned_and_compaction_keeps_the_rest(store):
+    vectors = random_vectors(100)
+    ids = add(store, vectors)
+    store.delete(ids[:60])
+    assert len(store) == 40
+    assert store.similarity_search_by_vector(vectors[10].tolist(), k=1)[0].page_content != f"text {ids[10]}"
+    store.compact()
+    assert store.count == 40 and len(store.deleted) == 0
+    assert store.get()["ids"] == ids[60:]
+    for i in (60, 99):
+        assert store.similarity_search_by_vector(vectors[i].tolist(), k=1)[0].page_content == f"text {ids[i]}"
+
+
+def test_rows_of_an_interrupted_write_are_ignored(tmp_path):
+    store = MmapVectorStore(str(tmp_path / "vectors"), None)
+    add(store, random_vectors(5))
+    # Vectors appended without their side table rows, as by a killed run
+    with open(store.path("vectors.f32"), "ab") as f:
+        f.write(random_vectors(3, seed=2).tobytes())
+    store.close()
+    store = MmapVectorStore(str(tmp_path / "vectors"), None)
+    assert len(store) == 5 and len(store.vectors) == 5
+    vectors = random_vectors(2, seed=3)
+    add(store, vectors, start=5)
+    assert len(store.vectors) == 7
+    assert store.similarity_search_by_vector(vectors[1].tolist(), k=1)[0].page_content == "text chunk-6"
+    store.close()
+
+
+def test_ivf_index_recall(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_store, "MIN_IVF_VECTORS", 500)
+    # Clustered vectors, like the embeddings of related chunks
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(20, 16))
+    vectors = (centers[rng.integers(0, 20, 3000)] + 0.3 * rng.normal(size=(3000, 16))).astype(np.float32)
+    store = MmapVectorStore(str(tmp_path / "vectors"), None, probes=8)
+    ids = add(store, vectors)
+    store.build_index()
+    assert store.ivf_rows is not None and store.indexed_count == 3000
+    queries = rng.choice(3000, 100, replace=False)
+    found = sum(store.similarity_search_by_vector(vectors[i].tolist(), k=1)[0].page_content == f"text {ids[i]}"
+                for i in queries)
+    assert found >= 95
+    # Chunks added after the index was built are scanned until the next build
+    added = random_vectors(5, seed=4)
+    add(store, added, start=3000)
+    assert store.similarity_search_by_vector(added[2].tolist(), k=1)[0].page_content == "text chunk-3002"
+    store.close()
+
+
+def test_build_index_compacts_many_deleted_rows(tmp_path):
+    store = MmapVectorStore(str(tmp_path / "vectors"), None)
+    ids = add(store, random_vectors(40))
+    store.delete(ids[:20])
+    store.build_index()
+    assert store.count == 20 and store.get()["ids"] == ids[20:]
+    store.close()
+
+
+def test_open_reader_follows_the_writes_and_compaction_of_another_instance(tmp_path):
+    writer = MmapVectorStore(str(tmp_path / "vectors"), None)
+    vectors = random_vectors(40)
+    ids = add(writer, vectors)
+    reader = MmapVectorStore(str(tmp_path / "vectors"), None)
+    assert reader.similarity_search_by_vector(vectors[15].tolist(), k=1)[0].page_content == f"text {ids[15]}"
+    writer.delete(ids[:20])
+    writer.build_index()
+    assert writer.count == 20
+    for i in (20, 30, 39):
+        assert reader.similarity_search_by_vector(vectors[i].tolist(), k=1)[0].page_content == f"text {ids[i]}"
+    assert all(document.page_content not in {f"text {chunk_id}" for chunk_id in ids[:20]}
+               for document in reader.similarity_search_by_vector(vectors[15].tolist(), k=5))
+    added = random_vectors(3, seed=5)
+    add(writer, added, start=40)
+    assert reader.similarity_search_by_vector(added[1].tolist(), k=1)[0].page_content == "text chunk-41"
+    reader.close()
+    writer.close()
+
+
+def test_interrupted_compaction_leaves_the_store_unchanged(tmp_path, monkeypatch):
+    store = MmapVectorStore(str(tmp_path / "vectors"), None)
+    vectors = random_vectors(30)
+    ids = add(store, vectors)
+    store.delete(ids[:10])
+
+    def crash(files=None):
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr(store, "commit", crash)
+    with pytest.raises(KeyboardInterrupt):
+        store.compact()
+    # The process dies, its uncommitted renumbering is lost
+    store.db.rollback()
+    store.db.close()
+    store = MmapVectorStore(str(tmp_path / "vectors"), None)
+    assert store.count == 30 and len(store) == 20
+    for i in (10, 29):
+        assert store.similarity_search_by_vector(vectors[i].tolist(), k=1)[0].page_content == f"text {ids[i]}"
+    # The next compaction replaces the files left by the interrupted one
+    store.compact()
+    assert store.count == 20
+    assert sorted(os.listdir(tmp_path / "vectors")) == sorted(["chunks.sqlite3", "scales.npy", store.files["vectors.f32"], store.files["vectors.q"]])
+    assert store.similarity_search_by_vector(vectors[29].tolist(), k=1)[0].page_content == f"text {ids[29]}"
+    store.close()
@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import zipfile
+import argparse
+import tempfile
+import contextlib
+import platform
+import threading
+import subprocess
+from collections import defaultdict
+from multiprocessing import Pool
+
+import psutil
+
+# docs_loader.py lives in the repository root
+REPOSITORY_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, REPOSITORY_ROOT)
+
+FILE_TYPES = ["txt", "md", "html", "csv", "eml", "epub", "pdf"]
+
+
+# Synthetic corpus
+
+def make_vocabulary(rng, size=5000):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(2, 10))) for _ in range(size)]
+
+
+def make_paragraphs(rng, vocabulary, target_bytes):
+    paragraphs = []
+    size = 0
+    while size < target_bytes:
+        sentences = []
+        for _ in range(rng.randint(2, 6)):
+            words = rng.choices(vocabulary, k=rng.randint(6, 20))
+            sentences.append(" ".join(words).capitalize() + ".")
+        paragraph = " ".join(sentences)
+        paragraphs.append(paragraph)
+        size += len(paragraph) + 2
+    return paragraphs
+
+
+def html_escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def write_txt(path, title, paragraphs):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(title + "\n\n" + "\n\n".join(paragraphs) + "\n")
+
+
+def write_md(path, title, paragraphs):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"# {title}\n\n")
+        for i, paragraph in enumerate(paragraphs):
+            if i and i % 5 == 0:
+                f.write(f"## Section {i // 5}\n\n")
+            f.write(paragraph + "\n\n")
+
+
+def html_body(title, paragraphs):
+    return f"<h1>{html_escape(title)}</h1>\n" + "\n".join(f"<p>{html_escape(paragraph)}</p>" for paragraph in paragraphs)
+
+
+def write_html(path, title, paragraphs):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"<!DOCTYPE html>\n<html><head><title>{html_escape(title)}</title></head>\n"
+                f"<body>\n{html_body(title, paragraphs)}\n</body></html>\n")
+
+
+def write_csv(path, title, paragraphs):
+    import csv
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "title", "text"])
+        for i, paragraph in enumerate(paragraphs):
+            writer.writerow([i, title, paragraph])
+
+
+def write_eml(path, title, paragraphs):
+    from email.message import EmailMessage
+    message = EmailMessage()
+    message["From"] = "sender@example.com"
+    message["To"] = "vault@example.com"
+    message["Subject"] = title
+    message["Date"] = "Mon, 01 Jan 2024 09:00:00 +0000"
+    message.set_content("\n\n".join(paragraphs))
+    message.add_alternative(f"<html><body>{html_body(title, paragraphs)}</body></html>", subtype="html")
+    with open(path, "wb") as f:
+        f.write(message.as_bytes())
+
+
+def write_epub(path, title, paragraphs):
+    chapters = [paragraphs[i:i + 10] for i in range(0, len(paragraphs), 10)] or [[]]
+    manifest = "\n".join(f'<item id="c{i}" href="c{i}.xhtml" media-type="application/xhtml+xml"/>' for i in range(len(chapters)))
+    spine = "\n".join(f'<itemref idref="c{i}"/>' for i in range(len(chapters)))
+    with zipfile.ZipFile(path, "w") as epub:
+        # The mimetype must be the first entry and stored uncompressed
+        epub.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        epub.writestr("META-INF/container.xml",
+                      '<?xml version="1.0"?>\n<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                      '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+                      '</rootfiles></container>', compress_type=zipfile.ZIP_DEFLATED)
+        epub.writestr("OEBPS/content.opf",
+                      f'<?xml version="1.0"?>\n<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">'
+                      f'<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:identifier id="id">{hashlib.sha1(title.encode()).hexdigest()}'
+                      f'</dc:identifier><dc:title>{html_escape(title)}</dc:title><dc:language>en</dc:language></metadata>'
+                      f'<manifest>{manifest}</manifest><spine>{spine}</spine></package>', compress_type=zipfile.ZIP_DEFLATED)
+        for i, chapter in enumerate(chapters):
+            epub.writestr(f"OEBPS/c{i}.xhtml",
+                          f'<?xml version="1.0" encoding="utf-8"?>\n<html xmlns="http://www.w3.org/1999/xhtml"><head><title>'
+                          f'{html_escape(title)}</title></head><body>{html_body(f"{title} {i}", chapter)}</body></html>',
+                          compress_type=zipfile.ZIP_DEFLATED)
+
+
+def write_pdf(path, title, paragraphs, lines_per_page=50, line_width=90):
+    """Write a minimal text PDF with the standard Helvetica font, no PDF library needed."""
+    lines = [title, ""]
+    for paragraph in paragraphs:
+        words = paragraph.split()
+        line = ""
+        for word in words:
+            if len(line) + len(word) + 1 > line_width:
+                lines.append(line)
+                line = word
+            else:
+                line = f"{line} {word}".strip()
+        lines.extend([line, ""])
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)]
+
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for page in pages:
+        escaped = [line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") for line in page]
+        stream = "BT /F1 10 Tf 12 TL 50 800 Td " + " ".join(f"({line}) Tj T*" for line in escaped) + " ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> "
+                       f"/Contents {len(objects)} 0 R >>")
+        page_ids.append(len(objects))
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{i} 0 R' for i in page_ids)}] /Count {len(page_ids)} >>"
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    output += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode("latin-1")
+    output += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    with open(path, "wb") as f:
+        f.write(output)
+
+
+WRITERS = {"txt": write_txt, "md": write_md, "html": write_html, "csv": write_csv,
+           "eml": write_eml, "epub": write_epub, "pdf": write_pdf}
+
+
+def generate_corpus(directory, files_per_type, file_kb, types, seed=42):
+    """Generate the same corpus for the same arguments, spread over nested directories."""
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng)
+    count = 0
+    for file_type in types:
+        for i in range(files_per_type):
+            subdirectory = os.path.join(directory, f"dir_{i % 10}", file_type)
+            os.makedirs(subdirectory, exist_ok=True)
+            title = " ".join(rng.choices(vocabulary, k=4)).title()
+            # Vary the sizes around the target, real vaults are not uniform
+            paragraphs = make_paragraphs(rng, vocabulary, int(file_kb * 1024 * rng.uniform(0.5, 1.5)))
+            WRITERS[file_type](os.path.join(subdirectory, f"{file_type}_{i:05d}.{file_type}"), title, paragraphs)
+            count += 1
+    return count
+
+
+# Deterministic embedder stand-in
+
+def hash_embeddings_class():
+    from langchain_core.embeddings import Embeddings
+
+    class HashEmbeddings(Embeddings):
+        """Feature-hashing embeddings, deterministic and instant, no model download."""
+
+        def __init__(self, dimension=384):
+            self.dimension = dimension
+
+        def embed_text(self, text):
+            vector = [0.0] * self.dimension
+            for word in text.lower().split():
+                digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+                vector[int.from_bytes(digest[:4], "little") % self.dimension] += 1.0 if digest[4] & 1 else -1.0
+            norm = sum(value * value for value in vector) ** 0.5 or 1.0
+            return [value / norm for value in vector]
+
+        def embed_documents(self, texts):
+            return [self.embed_text(text) for text in texts]
+
+        def embed_query(self, text):
+            return self.embed_text(text)
+
+    return HashEmbeddings
+
+
+class TimedEmbeddings:
+    """Measure the time spent computing the embeddings missing from the embeddings cache."""
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self.seconds = 0.0
+        self.texts = 0
+
+    def embed_documents(self, texts):
+        start = time.perf_counter()
+        try:
+            return self.embeddings.embed_documents(texts)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.texts += len(texts)
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
+
+
+# Measurement
+
+class PeakMemory:
+    """Sample the resident memory of this process and its children while a stage runs."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+
+    def sample(self):
+        process = psutil.Process()
+        total = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except psutil.Error:
+                pass
+        self.peak = max(self.peak, total)
+
+    def run(self):
+        while self.running:
+            self.sample()
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.running = True
+        self.sample()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.running = False
+        self.thread.join()
+        self.sample()
+
+
+def stage_result(seconds, items, unit, peak):
+    return {"seconds": round(seconds, 4), unit: items,
+            f"{unit}_per_second": round(items / seconds, 2) if seconds > 0 else None,
+            "peak_rss_mb": round(peak.peak / 1024 / 1024, 1)}
+
+
+def set_loader_tier(tier):
+    """Pool initializer, load the files with the loaders of a tier."""
+    import docs_loader
+    docs_loader.LOADER_MAPPING = docs_loader.loader_mapping(tier)
+
+
+def timed_load(file_path):
+    """Load one file in a Pool worker and report how long its loader took."""
+    import docs_loader
+    ext = os.path.splitext(file_path)[1].lower()
+    loader_name = docs_loader.LOADER_MAPPING[ext][0].__name__ if ext in docs_loader.LOADER_MAPPING else "unsupported"
+    start = time.perf_counter()
+    documents = docs_loader.load_single_document(file_path)
+    return loader_name, time.perf_counter() - start, os.path.getsize(file_path), documents
+
+
+def parse_files(files, num_processes, tier):
+    """Load the files with the loaders of a tier, return the documents, the wall time and the stats of each loader."""
+    documents = []
+    loaders = defaultdict(lambda: {"files": 0, "bytes": 0, "worker_seconds": 0.0, "documents": 0})
+    start = time.perf_counter()
+    with Pool(processes=num_processes, initializer=set_loader_tier, initargs=(tier,)) as pool:
+        for loader_name, seconds, size, file_documents in pool.imap_unordered(timed_load, files):
+            loaders[loader_name]["files"] += 1
+            loaders[loader_name]["bytes"] += size
+            loaders[loader_name]["worker_seconds"] += seconds
+            loaders[loader_name]["documents"] += len(file_documents)
+            documents.extend(file_documents)
+    seconds = time.perf_counter() - start
+    for stats in loaders.values():
+        stats["files_per_worker_second"] = round(stats["files"] / stats["worker_seconds"], 2) if stats["worker_seconds"] else None
+        stats["worker_seconds"] = round(stats["worker_seconds"], 4)
+    return documents, seconds, dict(loaders)
+
+
+def run_ingestion(embedder):
+    """
+    Run docs_loader.main as is, loading and splitting in the loader workers, with the embeddings
+    cache, the configured VECTOR_STORE and the upsert of the chunks under their ids, and time
+    the embedding and the vectorstore writes inside it.
+    """
+    import docs_loader
+
+    timed_embeddings = TimedEmbeddings(embedder)
+    writes = {"seconds": 0.0, "chunks": 0}
+    submit_embeddings_in_batches = docs_loader.submit_embeddings_in_batches
+
+    def timed_submit(embeddings, texts, metadatas, ids, vectorstore, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return submit_embeddings_in_batches(embeddings, texts, metadatas, ids, vectorstore, *args, **kwargs)
+        finally:
+            writes["seconds"] += time.perf_counter() - start
+            writes["chunks"] += len(ids)
+
+    docs_loader.create_embeddings = lambda: timed_embeddings
+    docs_loader.submit_embeddings_in_batches = timed_submit
+    start = time.perf_counter()
+    docs_loader.main()
+    return time.perf_counter() - start, timed_embeddings, writes
+
+
+def run_benchmark(source_directory, embedder, num_processes, tiers):
+    import docs_loader
+
+    stages = {}
+
+    with PeakMemory() as peak:
+        start = time.perf_counter()
+        files = docs_loader.discover_files(source_directory)
+        stages["discovery"] = stage_result(time.perf_counter() - start, len(files), "files", peak)
+
+    # Loading alone, the ingestion below loads and splits in the same workers
+    with PeakMemory() as peak:
+        documents, seconds, loaders = parse_files(files, num_processes, docs_loader.loader_tier)
+        stages["parsing"] = stage_result(seconds, len(files), "files", peak)
+    stages["parsing"]["tier"] = docs_loader.loader_tier
+    stages["parsing"]["loaders"] = loaders
+
+    # Splitting the parsed documents with the configured CHUNKER, in this process only,
+    # the ingestion splits in every loader worker
+    with PeakMemory() as peak:
+        start = time.perf_counter()
+        text_splitter = docs_loader.create_text_splitter()
+        setup_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        chunks = text_splitter.split_documents(documents)
+        stages["splitting"] = stage_result(time.perf_counter() - start, len(documents), "documents", peak)
+    stages["splitting"]["chunks"] = len(chunks)
+    stages["splitting"]["chunker"] = docs_loader.chunker_name
+    stages["splitting"]["setup_seconds"] = round(setup_seconds, 4)
+    documents = len(documents)
+    chunks = None
+
+    # Parse the corpus again with the other tiers to compare their throughput
+    if tiers:
+        stages["parsing"]["tiers"] = {}
+    for tier in tiers:
+        if tier == docs_loader.loader_tier:
+            tier_seconds, tier_loaders, tier_documents = seconds, loaders, documents
+        else:
+            tier_documents, tier_seconds, tier_loaders = parse_files(files, num_processes, tier)
+            tier_documents = len(tier_documents)
+        stages["parsing"]["tiers"][tier] = {
+            "seconds": round(tier_seconds, 4),
+            "documents": tier_documents,
+            "files_per_second": round(len(files) / tier_seconds, 2) if tier_seconds > 0 else None,
+            "loaders": tier_loaders,
+        }
+
+    with PeakMemory() as peak:
+        seconds, timed_embeddings, writes = run_ingestion(embedder)
+    stages["ingestion"] = stage_result(seconds, len(files), "files", peak)
+    stages["ingestion"]["chunks"] = writes["chunks"]
+    # The stages overlap, the loader workers keep parsing and splitting while a batch is embedded
+    stages["embedding"] = stage_result(timed_embeddings.seconds, timed_embeddings.texts, "chunks", peak)
+    stages["vectorstore_write"] = stage_result(writes["seconds"], writes["chunks"], "chunks", peak)
+    stages["total_seconds"] = round(stages["discovery"]["seconds"] + seconds, 4)
+    return stages
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPOSITORY_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the VaultChat ingestion pipeline on a synthetic corpus.")
+    parser.add_argument("--corpus", help="Directory of the synthetic corpus, generated when missing or empty. A temporary directory by default.")
+    parser.add_argument("--files-per-type", type=int, default=20, help="Number of files generated per file type.")
+    parser.add_argument("--file-kb", type=float, default=16, help="Average size of a generated file in KB.")
+    parser.add_argument("--types", default=",".join(FILE_TYPES), help="Comma separated file types to generate.")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the corpus generator.")
+    parser.add_argument("--embedder", choices=["hash", "model"], default="hash",
+                        help="hash: deterministic stand-in without model download, model: EMBEDDINGS_MODEL_NAME as configured.")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="Override a .env setting for this run, e.g. --set CHUNK_SIZE=1000. Can be repeated.")
+    parser.add_argument("--tiers", default="fast,unstructured",
+                        help="Comma separated loader tiers whose parsing throughput is compared, empty to skip the comparison.")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of the standard output.")
+    args = parser.parse_args()
+
+    corpus = args.corpus or tempfile.mkdtemp(prefix="vaultchat_bench_corpus_")
+    work_directory = tempfile.mkdtemp(prefix="vaultchat_bench_")
+    types = [file_type.strip() for file_type in args.types.split(",") if file_type.strip()]
+
+    # docs_loader.py reads its settings when imported, the vectorstore and the
+    # embeddings cache of the run are written to a temporary directory
+    overrides = dict(item.split("=", 1) for item in args.set)
+    os.environ.update({"SOURCE_DIRECTORY": corpus,
+                       "PERSISTENT_DATABASE": os.path.join(work_directory, "db"),
+                       "EMBEDDINGS_CACHE_DIRECTORY": os.path.join(work_directory, "embeddings_cache"),
+                       # Shards would be ingested by docs_loader.py subprocesses, out of reach of the measurements
+                       "SHARDS": ""})
+    os.environ.update(overrides)
+    import docs_loader
+
+    embedder = None
+    try:
+        if not os.path.isdir(corpus) or not os.listdir(corpus):
+            start = time.perf_counter()
+            count = generate_corpus(corpus, args.files_per_type, args.file_kb, types, args.seed)
+            print(f"Generated {count} files in {corpus} in {time.perf_counter() - start:.2f}s", file=sys.stderr)
+
+        # Keep the standard output for the JSON results
+        with contextlib.redirect_stdout(sys.stderr):
+            embedder = hash_embeddings_class()() if args.embedder == "hash" else docs_loader.create_embeddings()
+            num_processes = docs_loader.get_num_processes()
+            tiers = [tier.strip() for tier in args.tiers.split(",") if tier.strip()]
+            stages = run_benchmark(corpus, embedder, num_processes, tiers)
+    finally:
+        # The embedding worker Pool of EMBEDDING_WORKERS
+        if isinstance(embedder, docs_loader.ParallelEmbeddings):
+            embedder.close()
+        shutil.rmtree(work_directory, ignore_errors=True)
+        if not args.corpus:
+            shutil.rmtree(corpus, ignore_errors=True)
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "corpus": {"files_per_type": args.files_per_type, "file_kb": args.file_kb, "types": types, "seed": args.seed},
+        "embedder": args.embedder,
+        "settings": {
+            "DEFAULT_NUM_PROCESSES": num_processes,
+            "DOCUMENTS_BATCH_SIZE": docs_loader.documents_batch_size,
+            "BATCH_SIZE": docs_loader.embeddings_batch_size,
+            "CHUNK_SIZE": docs_loader.chunk_size,
+            "CHUNK_OVERLAP": docs_loader.chunk_overlap,
+            "CHUNKER": docs_loader.chunker_name,
+            "EMBEDDING_WORKERS": docs_loader.embedding_workers,
+            "LOADER_TIER": docs_loader.loader_tier,
+            "VECTOR_STORE": docs_loader.vector_store_kind,
+            "EMBEDDINGS_CACHE_MAX_ENTRIES": docs_loader.embeddings_cache_max_entries,
+        },
+        "overrides": overrides,
+        "stages": stages,
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+        print(f"Results saved to: {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
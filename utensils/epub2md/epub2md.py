@@ -2,7 +2,9 @@
 
 import sys
 import os
+import glob
 import argparse
+from multiprocessing import Pool
 import ebooklib
 from ebooklib import epub
 import html2text
@@ -13,45 +15,88 @@ def convert_html_to_markdown(html_content):
     h.ignore_links = False
     return h.handle(html_content)
 
-def epub_to_md(epub_path):
+def find_input_files(inputs, extension):
+    """Expand the files, directories and glob patterns given on the command line."""
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            matches = glob.glob(os.path.join(item, "**", f"*{extension}"), recursive=True)
+        else:
+            matches = glob.glob(item, recursive=True) or [item]
+        files.extend(match for match in sorted(matches) if match.lower().endswith(extension) and os.path.isfile(match))
+    return list(dict.fromkeys(files))
+
+def markdown_path(epub_path, input_root, output_dir):
+    md_name = os.path.splitext(os.path.relpath(epub_path, input_root) if output_dir else epub_path)[0] + ".md"
+    return os.path.join(output_dir, md_name) if output_dir else md_name
+
+def is_up_to_date(epub_path, md_path):
+    return os.path.exists(md_path) and os.path.getmtime(md_path) >= os.path.getmtime(epub_path)
+
+def epub_to_md(epub_path, md_path=None):
+    """Convert an EPUB file section by section, each section is written as soon as it is converted."""
     try:
         # Load the EPUB file
         book = epub.read_epub(epub_path)
     except Exception as e:
-        print(f"Failed to read EPUB file: {e}")
-        return
-
-    # Initialize Markdown content
-    md_content = ""
-
-    # check each item in the EPUB book
-    for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
-        # Convert HTML to Markdown
-        html_content = item.content.decode("utf-8")
-        md_content += convert_html_to_markdown(html_content) + "\n\n"
-
-
-    if not md_content:
-        print("No readable document items found in the EPUB file.")
-        return
+        return f"Failed to read EPUB file {epub_path}: {e}"
 
     # Generate output file path
-    md_path = os.path.splitext(epub_path)[0] + ".md"
-    
+    md_path = md_path or os.path.splitext(epub_path)[0] + ".md"
+    tmp_path = md_path + ".tmp"
+    written = False
     try:
-        # Write to Markdown file
-        with open(md_path, "w", encoding="utf-8") as md_file:
-            md_file.write(md_content)
-        print(f"Markdown file saved to: {md_path}")
+        os.makedirs(os.path.dirname(md_path) or ".", exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as md_file:
+            # check each item in the EPUB book
+            for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
+                # Convert HTML to Markdown
+                html_content = item.content.decode("utf-8")
+                section = convert_html_to_markdown(html_content)
+                md_file.write(section + "\n\n")
+                written = written or bool(section.strip())
+        if not written:
+            os.remove(tmp_path)
+            return f"No readable document items found in the EPUB file {epub_path}"
+        # The previous Markdown file is replaced only by a complete conversion
+        os.replace(tmp_path, md_path)
+        return f"Markdown file saved to: {md_path}"
     except Exception as e:
-        print(f"Failed to write Markdown file: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return f"Failed to write Markdown file {md_path}: {e}"
+
+def convert_task(task):
+    return epub_to_md(*task)
 
 def main():
-    parser = argparse.ArgumentParser(description="Convert an EPUB file to Markdown format.")
-    parser.add_argument("epub_file_path", help="Path to the EPUB file to be converted.")
+    parser = argparse.ArgumentParser(description="Convert EPUB files to Markdown format.")
+    parser.add_argument("inputs", nargs="+", help="EPUB files, directories searched recursively or glob patterns.")
+    parser.add_argument("--output-dir", help="Directory of the Markdown files, keeping the input directory structure. Next to each EPUB file by default.")
+    parser.add_argument("--processes", type=int, default=None, help="Number of conversion processes, all cores by default.")
+    parser.add_argument("--force", action="store_true", help="Convert again the files whose Markdown file is up to date.")
     args = parser.parse_args()
 
-    epub_to_md(args.epub_file_path)
+    epub_paths = find_input_files(args.inputs, ".epub")
+    if not epub_paths:
+        print("No EPUB files found.")
+        sys.exit(1)
+    input_root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in epub_paths])
+
+    tasks = []
+    for epub_path in epub_paths:
+        epub_path = os.path.abspath(epub_path) if args.output_dir else epub_path
+        md_path = markdown_path(epub_path, input_root, args.output_dir)
+        if not args.force and is_up_to_date(epub_path, md_path):
+            print(f"Up to date: {md_path}")
+            continue
+        tasks.append((epub_path, md_path))
+
+    # The largest books first, so no long conversion is left running alone at the end
+    tasks.sort(key=lambda task: os.path.getsize(task[0]), reverse=True)
+    with Pool(processes=args.processes) as pool:
+        for message in pool.imap_unordered(convert_task, tasks):
+            print(message)
 
 if __name__ == "__main__":
     main()
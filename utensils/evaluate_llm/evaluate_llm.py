@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import argparse
+import urllib.request
+
+from dotenv import load_dotenv
+
+# vaultChat.py lives in the repository root
+REPOSITORY_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, REPOSITORY_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_embeddings(values, default_model, default_persist_directory):
+    """(model, persist directory) of each --embeddings MODEL[=PERSIST_DIRECTORY] option."""
+    combinations = []
+    for value in values or [default_model]:
+        model, separator, persist_directory = value.partition("=")
+        combinations.append((model.strip(), persist_directory.strip() if separator else default_persist_directory))
+    return combinations
+
+
+def retrieve_contexts(questions, embeddings_model, persist_directory):
+    """
+    Run the VaultChat retrieval of every question once with the embeddings model and its
+    vectorstore, and build the prompts the "stuff" chain would send, reused for every LLM.
+    """
+    import vaultChat
+
+    vaultChat.EMBEDDINGS_MODEL_NAME = embeddings_model
+    vaultChat.PERSIST_DIRECTORY = persist_directory
+    # Cached answers would skip the retrieval
+    vaultChat.ANSWER_CACHE_MAX_ENTRIES = 0
+    qa = vaultChat.build_qa(return_source_documents=True)
+    contexts = []
+    for query in questions:
+        start = time.perf_counter()
+        documents = qa.retriever.invoke(query)
+        retrieval_seconds = time.perf_counter() - start
+        contexts.append({"question": query,
+                         "prompt": vaultChat.build_prompt(qa, query, documents),
+                         "sources": [document.metadata.get("source") for document in documents],
+                         "retrieval_seconds": retrieval_seconds})
+        print(f"Retrieved {len(documents)} chunks for \"{query}\" in {retrieval_seconds:.2f}s", file=sys.stderr)
+    return contexts
+
+
+def generate(url, model, prompt, timeout):
+    """
+    Stream an answer from /api/generate. The time to the first token and the total latency are
+    measured by the client, the token rates come from the statistics of the last chunk.
+    """
+    request = urllib.request.Request(f"{url}/api/generate", data=json.dumps({"model": model, "prompt": prompt, "stream": True}).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    first_token = None
+    answer = []
+    final = {}
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        for line in response:
+            if not line.strip():
+                continue
+            chunk = json.loads(line)
+            if chunk.get("error"):
+                raise RuntimeError(chunk["error"])
+            if chunk.get("response"):
+                if first_token is None:
+                    first_token = time.perf_counter()
+                answer.append(chunk["response"])
+            if chunk.get("done"):
+                final = chunk
+    end = time.perf_counter()
+
+    def rate(count, duration):
+        return final[count] / (final[duration] / 1e9) if final.get(count) and final.get(duration) else None
+
+    return {"answer": "".join(answer),
+            "first_token_seconds": (first_token or end) - start,
+            "total_seconds": end - start,
+            "load_seconds": final.get("load_duration", 0) / 1e9,
+            "prompt_eval_count": final.get("prompt_eval_count"),
+            "prompt_eval_tokens_per_second": rate("prompt_eval_count", "prompt_eval_duration"),
+            "eval_count": final.get("eval_count"),
+            "eval_tokens_per_second": rate("eval_count", "eval_duration")}
+
+
+def load_model(url, model, timeout):
+    """Load the model with an empty prompt, so the first question does not measure the load time."""
+    request = urllib.request.Request(f"{url}/api/generate", data=json.dumps({"model": model, "prompt": "", "stream": False}).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+def summarize(answers):
+    from query_metrics import percentile
+
+    def values(name):
+        return [answer[name] for answer in answers if answer.get(name) is not None]
+
+    def mean(name):
+        samples = values(name)
+        return sum(samples) / len(samples) if samples else None
+
+    return {"answered": len(values("answer")),
+            "errors": sum(1 for answer in answers if "error" in answer),
+            "retrieval_seconds": mean("retrieval_seconds"),
+            "prompt_eval_count": mean("prompt_eval_count"),
+            "first_token_p50": percentile(values("first_token_seconds"), 50),
+            "first_token_p95": percentile(values("first_token_seconds"), 95),
+            "total_p50": percentile(values("total_seconds"), 50),
+            "total_p95": percentile(values("total_seconds"), 95),
+            "prompt_eval_tokens_per_second": mean("prompt_eval_tokens_per_second"),
+            "eval_tokens_per_second": mean("eval_tokens_per_second")}
+
+
+def evaluate(questions, models, embeddings, url, retrieval=True, timeout=600):
+    results = []
+    for embeddings_model, persist_directory in embeddings:
+        if retrieval:
+            contexts = retrieve_contexts(questions, embeddings_model, persist_directory)
+        else:
+            contexts = [{"question": query, "prompt": query, "sources": [], "retrieval_seconds": None} for query in questions]
+        for model in models:
+            result = {"llm": model, "embeddings": embeddings_model if retrieval else None,
+                      "persist_directory": persist_directory if retrieval else None}
+            try:
+                result["load_seconds"] = load_model(url, model, timeout)
+            except Exception as e:
+                print(f"Failed to load {model}, skipping it: {e}", file=sys.stderr)
+                result.update(error=str(e), summary=summarize([]), answers=[])
+                results.append(result)
+                continue
+            answers = []
+            for context in contexts:
+                answer = {"question": context["question"], "sources": context["sources"],
+                          "retrieval_seconds": context["retrieval_seconds"]}
+                try:
+                    answer.update(generate(url, model, context["prompt"], timeout))
+                    print(f"[{model}] {context['question']} ({answer['total_seconds']:.2f}s)", file=sys.stderr)
+                except Exception as e:
+                    print(f"[{model}] {context['question']} failed: {e}", file=sys.stderr)
+                    answer["error"] = str(e)
+                answers.append(answer)
+            result["summary"] = summarize(answers)
+            result["answers"] = answers
+            results.append(result)
+        if not retrieval:
+            break
+    return results
+
+
+def print_table(results):
+    def number(value, width, precision):
+        return f"{value:>{width}.{precision}f}" if value is not None else f"{'-':>{width}}"
+
+    print(f"\n{'llm':<24} {'embeddings':<40} {'ok':>4} {'err':>4} {'retr s':>7} {'prompt':>7} {'ttft p50':>9} "
+          f"{'ttft p95':>9} {'total p50':>10} {'total p95':>10} {'pe tok/s':>9} {'tok/s':>7}")
+    for result in results:
+        summary = result["summary"]
+        print(f"{result['llm']:<24} {(result['embeddings'] or '-'):<40} {summary['answered']:>4} {summary['errors']:>4} "
+              f"{number(summary['retrieval_seconds'], 7, 2)} {number(summary['prompt_eval_count'], 7, 0)} "
+              f"{number(summary['first_token_p50'], 9, 2)} {number(summary['first_token_p95'], 9, 2)} "
+              f"{number(summary['total_p50'], 10, 2)} {number(summary['total_p95'], 10, 2)} "
+              f"{number(summary['prompt_eval_tokens_per_second'], 9, 1)} {number(summary['eval_tokens_per_second'], 7, 1)}")
+
+
+def main():
+    load_dotenv(os.path.join(REPOSITORY_ROOT, ".env"))
+    ollama_url = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+    if "://" not in ollama_url:
+        ollama_url = f"http://{ollama_url}"
+    parser = argparse.ArgumentParser(description="Compare LLM and embeddings models on the VaultChat retrieval and generation path.")
+    parser.add_argument("questions", help="Text file with one question per line.")
+    parser.add_argument("--models", default=os.getenv("LLM_MODEL_NAME", "mistral"), help="Comma-separated Ollama models, LLM_MODEL_NAME by default.")
+    parser.add_argument("--embeddings", action="append", metavar="MODEL[=PERSIST_DIRECTORY]",
+                        help="Embeddings model and the vectorstore built with it, repeat to compare several. "
+                             "EMBEDDINGS_MODEL_NAME and PERSISTENT_DATABASE by default.")
+    parser.add_argument("--no-retrieval", action="store_true", help="Send the questions as they are, without retrieving documents.")
+    parser.add_argument("--ollama-url", default=ollama_url, help="Address of the Ollama server.")
+    parser.add_argument("--mock", action="store_true", help="Answer with a local stand-in for the Ollama API instead of Ollama.")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for an answer.")
+    parser.add_argument("--output", help="Save the results and the answers as JSON.")
+    args = parser.parse_args()
+
+    from batch_qa import read_questions
+    questions = read_questions(args.questions)
+    if not questions:
+        sys.exit(f"No questions found in {args.questions}")
+    models = [model.strip() for model in args.models.split(",") if model.strip()]
+    embeddings = parse_embeddings(args.embeddings, os.getenv("EMBEDDINGS_MODEL_NAME", "sentence-transformers/all-MiniLM-L6-v2"),
+                                  os.getenv("PERSISTENT_DATABASE", "chroma_db"))
+    url = args.ollama_url.rstrip("/")
+    if args.mock:
+        from mock_ollama import start_mock_ollama
+        url = start_mock_ollama().url
+        print(f"Using the mock Ollama server at {url}", file=sys.stderr)
+
+    results = evaluate(questions, models, embeddings, url, not args.no_retrieval, args.timeout)
+    print_table(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"questions": questions, "ollama_url": url, "results": results}, f, indent=2)
+        print(f"\nResults and answers saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
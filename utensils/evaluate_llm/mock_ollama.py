@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def estimate_tokens(text):
+    # Roughly 4 characters per token, like VaultChat
+    return len(text) // 4 + 1
+
+
+class MockOllama(ThreadingHTTPServer):
+    """
+    Stand-in for the Ollama HTTP API, /api/generate streams a canned answer at a fixed
+    rate and reports the same statistics as Ollama in its last chunk, so evaluate_llm.py
+    can be checked without models. The first request of each model pays the load time.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, models=None, load_seconds=0.5, prompt_eval_rate=500.0, eval_rate=50.0, answer_tokens=40):
+        super().__init__(address, MockOllamaHandler)
+        self.models = models
+        self.load_seconds = load_seconds
+        self.prompt_eval_rate = prompt_eval_rate
+        self.eval_rate = eval_rate
+        self.answer_tokens = answer_tokens
+        self.loaded = set()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def load(self, model):
+        """Seconds spent loading the model, only for its first request."""
+        with self.lock:
+            if model in self.loaded:
+                return 0.0
+            self.loaded.add(model)
+        time.sleep(self.load_seconds)
+        return self.load_seconds
+
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/api/version":
+            self.send_json(200, {"version": "0.0.0-mock"})
+        elif self.path == "/api/tags":
+            self.send_json(200, {"models": [{"name": model, "model": model} for model in self.server.models or []]})
+        else:
+            self.send_json(404, {"error": f"Not found: {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/api/generate":
+            self.send_json(404, {"error": f"Not found: {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError as e:
+            self.send_json(400, {"error": f"Bad request: {e}"})
+            return
+        model = request.get("model", "")
+        if self.server.models and model not in self.server.models:
+            self.send_json(404, {"error": f"model '{model}' not found"})
+            return
+        start = time.perf_counter()
+        load_seconds = self.server.load(model)
+        prompt = request.get("prompt", "")
+        if not prompt:
+            # An empty prompt only loads the model, as with Ollama
+            self.send_json(200, {"model": model, "response": "", "done": True, "done_reason": "load"})
+            return
+
+        prompt_tokens = estimate_tokens(prompt)
+        prompt_eval_seconds = prompt_tokens / self.server.prompt_eval_rate
+        time.sleep(prompt_eval_seconds)
+        words = [f"{model}" if i == 0 else f"token{i}" for i in range(self.server.answer_tokens)]
+        stream = request.get("stream", True)
+        if stream:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+        eval_start = time.perf_counter()
+        for word in words:
+            time.sleep(1 / self.server.eval_rate)
+            if stream:
+                self.write_chunk({"model": model, "response": word + " ", "done": False})
+        eval_seconds = time.perf_counter() - eval_start
+        final = {"model": model, "response": "" if stream else " ".join(words) + " ", "done": True, "done_reason": "stop",
+                 "total_duration": int((time.perf_counter() - start) * 1e9),
+                 "load_duration": int(load_seconds * 1e9),
+                 "prompt_eval_count": prompt_tokens,
+                 "prompt_eval_duration": int(prompt_eval_seconds * 1e9),
+                 "eval_count": len(words),
+                 "eval_duration": int(eval_seconds * 1e9)}
+        if stream:
+            self.write_chunk(final)
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            self.send_json(200, final)
+
+    def write_chunk(self, payload):
+        data = json.dumps(payload).encode("utf-8") + b"\n"
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+def start_mock_ollama(host="127.0.0.1", port=0, **settings):
+    """Serve a MockOllama in a background thread, port 0 picks a free port."""
+    server = MockOllama((host, port), **settings)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in for the Ollama HTTP API, to test evaluate_llm.py without models.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address the server listens on.")
+    parser.add_argument("--port", type=int, default=11435, help="Port the server listens on.")
+    parser.add_argument("--models", help="Comma-separated models served, any model by default.")
+    parser.add_argument("--load-seconds", type=float, default=0.5, help="Load time of the first request of each model.")
+    parser.add_argument("--prompt-eval-rate", type=float, default=500.0, help="Prompt tokens evaluated per second.")
+    parser.add_argument("--eval-rate", type=float, default=50.0, help="Answer tokens generated per second.")
+    parser.add_argument("--answer-tokens", type=int, default=40, help="Tokens of every answer.")
+    args = parser.parse_args()
+
+    models = [model.strip() for model in args.models.split(",")] if args.models else None
+    server = MockOllama((args.host, args.port), models, args.load_seconds, args.prompt_eval_rate, args.eval_rate, args.answer_tokens)
+    print(f"Mock Ollama listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
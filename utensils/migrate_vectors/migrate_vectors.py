@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+from dotenv import load_dotenv
+
+# vector_store.py lives in the repository root
+REPOSITORY_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, REPOSITORY_ROOT)
+
+from vector_store import MmapVectorStore, normalize, vector_store_directory
+
+
+def open_chroma_collection(persist_directory):
+    import chromadb
+    from chromadb.config import Settings
+    client = chromadb.PersistentClient(path=persist_directory, settings=Settings(anonymized_telemetry=False))
+    # The default collection of the langchain Chroma wrapper
+    return client.get_collection("langchain")
+
+
+def migrate(persist_directory, quantization, probes, batch_size):
+    """Copy the chunks and their embeddings from the Chroma store, nothing is embedded again."""
+    collection = open_chroma_collection(persist_directory)
+    store = MmapVectorStore(vector_store_directory(persist_directory), None, quantization, probes)
+    total = collection.count()
+    start = time.perf_counter()
+    for offset in range(0, total, batch_size):
+        stored = collection.get(include=["embeddings", "documents", "metadatas"], limit=batch_size, offset=offset)
+        if not stored["ids"]:
+            break
+        store.add_embeddings(stored["ids"], stored["documents"], [metadata or {} for metadata in stored["metadatas"]],
+                             np.asarray(stored["embeddings"], dtype=np.float32))
+        print(f"Migrated {min(offset + batch_size, total)}/{total} chunks", end="\r")
+    print()
+    store.build_index()
+    print(f"Migrated {len(store)} chunks to {store.directory} in {time.perf_counter() - start:.1f}s")
+    store.close()
+
+
+def sample_queries(persist_directory, num_queries, questions_file, seed=42):
+    """Embedded questions from a file, or stored chunk embeddings when no questions are given."""
+    if questions_file:
+        from langchain_huggingface import HuggingFaceEmbeddings
+        with open(questions_file, encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip() and not line.startswith("#")][:num_queries]
+        model = HuggingFaceEmbeddings(model_name=os.getenv("EMBEDDINGS_MODEL_NAME", "sentence-transformers/all-MiniLM-L6-v2"))
+        return np.asarray(model.embed_documents(questions), dtype=np.float32)
+    store = MmapVectorStore(vector_store_directory(persist_directory), None)
+    rng = np.random.default_rng(seed)
+    alive = np.setdiff1d(np.arange(store.count), store.deleted)
+    rows = np.sort(rng.choice(alive, min(num_queries, len(alive)), replace=False))
+    return np.asarray(store.vectors[rows])
+
+
+def exact_neighbors(persist_directory, queries, k):
+    """Ids of the exact top k chunks by cosine similarity, the reference of the recall."""
+    store = MmapVectorStore(vector_store_directory(persist_directory), None)
+    ids = dict(store.db.execute("SELECT row, id FROM chunks WHERE deleted = 0"))
+    queries = normalize(queries)
+    scores = np.full((len(queries), store.count), -np.inf, dtype=np.float32)
+    for i in range(0, store.count, 65536):
+        scores[:, i:i + 65536] = queries @ normalize(np.asarray(store.vectors[i:i + 65536])).T
+    if len(store.deleted):
+        scores[:, store.deleted] = -np.inf
+    return [[ids[row] for row in np.argsort(-row_scores)[:k]] for row_scores in scores]
+
+
+def resident_memory_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(task):
+    """Run the queries against one backend, in a process of its own so its memory is measured alone."""
+    backend, persist_directory, queries, k, probes = task
+    baseline = resident_memory_mb()
+    if backend == "chroma":
+        collection = open_chroma_collection(persist_directory)
+        search = lambda query: collection.query(query_embeddings=[query.tolist()], n_results=k, include=[])["ids"][0]
+    else:
+        store = MmapVectorStore(vector_store_directory(persist_directory), None, probes=probes)
+        ids = dict(store.db.execute("SELECT row, id FROM chunks WHERE deleted = 0"))
+        search = lambda query: [ids[row] for row, _ in store.search_by_vector(query, k)]
+    opened = resident_memory_mb()
+    # The first query loads the index, it is not measured
+    search(queries[0])
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(search(query))
+        latencies.append(time.perf_counter() - start)
+    return results, latencies, opened - baseline, resident_memory_mb() - baseline
+
+
+def directory_size_mb(path, exclude=None):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != exclude]
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total / 1024 / 1024
+
+
+def compare(persist_directory, num_queries, questions_file, k, probes):
+    queries = sample_queries(persist_directory, num_queries, questions_file)
+    expected = exact_neighbors(persist_directory, queries, k)
+    mmap_directory = vector_store_directory(persist_directory)
+    report = {"queries": len(queries), "k": k, "backends": {}}
+    context = multiprocessing.get_context("spawn")
+    for backend in ("chroma", "mmap"):
+        with context.Pool(1) as pool:
+            results, latencies, open_mb, query_mb = pool.map(measure, [(backend, persist_directory, queries, k, probes)])[0]
+        recall = np.mean([len(set(found) & set(exact)) / max(1, len(exact)) for found, exact in zip(results, expected)])
+        latencies = np.array(latencies) * 1000
+        disk_mb = directory_size_mb(mmap_directory) if backend == "mmap" else directory_size_mb(persist_directory, exclude=mmap_directory)
+        report["backends"][backend] = {
+            "recall": float(recall),
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+            "p99_ms": float(np.percentile(latencies, 99)),
+            "open_rss_mb": open_mb,
+            "query_rss_mb": query_mb,
+            "disk_mb": disk_mb,
+        }
+    return report
+
+
+def print_report(report):
+    print(f"\n{report['queries']} queries, recall@{report['k']} against the exact cosine neighbors")
+    print(f"{'backend':<8} {'recall':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'open MB':>8} {'query MB':>9} {'disk MB':>8}")
+    for backend, stats in report["backends"].items():
+        print(f"{backend:<8} {stats['recall']:>7.3f} {stats['p50_ms']:>8.2f} {stats['p95_ms']:>8.2f} {stats['p99_ms']:>8.2f} "
+              f"{stats['open_rss_mb']:>8.1f} {stats['query_rss_mb']:>9.1f} {stats['disk_mb']:>8.1f}")
+
+
+def main():
+    load_dotenv(os.path.join(REPOSITORY_ROOT, ".env"))
+    parser = argparse.ArgumentParser(description="Migrate a Chroma store to the memory-mapped vector store and compare them.")
+    parser.add_argument("--persist-directory", default=os.getenv("PERSISTENT_DATABASE", "chroma_db"), help="Directory of the Chroma store, PERSISTENT_DATABASE by default.")
+    parser.add_argument("--quantization", choices=["none", "float16", "int8"], default=os.getenv("VECTOR_QUANTIZATION", "int8"), help="Quantization of the scanned vectors.")
+    parser.add_argument("--probes", type=int, default=int(os.getenv("VECTOR_PROBES", 16)), help="IVF lists searched per query.")
+    parser.add_argument("--batch-size", type=int, default=5000, help="Chunks copied per batch.")
+    parser.add_argument("--skip-migration", action="store_true", help="Only compare, the store was already migrated.")
+    parser.add_argument("--queries", type=int, default=200, help="Number of queries of the comparison, 0 to skip it.")
+    parser.add_argument("--questions", help="File of questions, one per line, embedded as queries. Stored chunks are used by default.")
+    parser.add_argument("-k", type=int, default=10, help="Neighbors retrieved per query.")
+    parser.add_argument("--output", help="Save the comparison as JSON.")
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.persist_directory, "chroma.sqlite3")):
+        print(f"No Chroma store found in {args.persist_directory}")
+        sys.exit(1)
+    if not args.skip_migration:
+        if os.path.exists(vector_store_directory(args.persist_directory)):
+            print(f"{vector_store_directory(args.persist_directory)} already exists, remove it or use --skip-migration")
+            sys.exit(1)
+        migrate(args.persist_directory, args.quantization, args.probes, args.batch_size)
+    if args.queries > 0:
+        report = compare(args.persist_directory, args.queries, args.questions, args.k, args.probes)
+        print_report(report)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+    print("Set VECTOR_STORE=mmap in .env to query the migrated store")
+
+
+if __name__ == "__main__":
+    main()
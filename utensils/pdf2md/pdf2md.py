@@ -2,50 +2,146 @@
 
 import sys
 import os
+import glob
+import shutil
 import argparse
+from multiprocessing import Pool
 import fitz  # PyMuPDF
 
-def convert_pdf_to_markdown(pdf_path):
-    try:
-        # Load the PDF file
-        doc = fitz.open(pdf_path)
-    except Exception as e:
-        print(f"Failed to read PDF file: {e}")
-        return
-
-    # Initialize Markdown content
-    md_content = ""
-
-    # Iterate through each page of the PDF
-    for page_num in range(len(doc)):
-        # Get the page
-        page = doc.load_page(page_num)
-        # Extract text from the page
-        text = page.get_text("text")
-        # Add the text to our Markdown content
-        md_content += text + "\n\n"
-
-    if not md_content:
-        print("No readable document items found in the PDF file.")
-        return
-
-    # Generate output file path
-    md_path = os.path.splitext(pdf_path)[0] + ".md"
-    
+# PDF document opened by this worker process, PyMuPDF documents are not shared between processes
+worker_document = None
+
+def find_input_files(inputs, extension):
+    """Expand the files, directories and glob patterns given on the command line."""
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            matches = glob.glob(os.path.join(item, "**", f"*{extension}"), recursive=True)
+        else:
+            matches = glob.glob(item, recursive=True) or [item]
+        files.extend(match for match in sorted(matches) if match.lower().endswith(extension) and os.path.isfile(match))
+    return list(dict.fromkeys(files))
+
+def markdown_path(pdf_path, input_root, output_dir):
+    md_name = os.path.splitext(os.path.relpath(pdf_path, input_root) if output_dir else pdf_path)[0] + ".md"
+    return os.path.join(output_dir, md_name) if output_dir else md_name
+
+def is_up_to_date(pdf_path, md_path):
+    return os.path.exists(md_path) and os.path.getmtime(md_path) >= os.path.getmtime(pdf_path)
+
+def convert_page_range(task):
+    """Write the text of a range of pages to a part file, page by page."""
+    global worker_document
+    pdf_path, start, end, part_path = task
     try:
-        # Write to Markdown file
-        with open(md_path, "w", encoding="utf-8") as md_file:
-            md_file.write(md_content)
-        print(f"Markdown file saved to: {md_path}")
+        if worker_document is None or worker_document.name != pdf_path:
+            if worker_document is not None:
+                worker_document.close()
+            worker_document = fitz.open(pdf_path)
+        characters = 0
+        with open(part_path, "w", encoding="utf-8") as part_file:
+            for page_num in range(start, end):
+                # Extract text from the page
+                text = worker_document.load_page(page_num).get_text("text")
+                part_file.write(text + "\n\n")
+                characters += len(text.strip())
+        return pdf_path, characters, None
     except Exception as e:
-        print(f"Failed to write Markdown file: {e}")
+        return pdf_path, 0, str(e)
+
+def plan_conversion(pdf_path, md_path, pages_per_part):
+    """Split a PDF in page ranges, each converted by a worker into its own part file."""
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+    tasks = []
+    for index, start in enumerate(range(0, page_count, pages_per_part)):
+        part_path = f"{md_path}.part{index:05d}"
+        tasks.append((pdf_path, start, min(start + pages_per_part, page_count), part_path))
+    return tasks
+
+def assemble_parts(md_path, part_paths):
+    """Concatenate the part files into the Markdown file, replaced at once when complete."""
+    tmp_path = md_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as md_file:
+        for part_path in part_paths:
+            with open(part_path, encoding="utf-8") as part_file:
+                shutil.copyfileobj(part_file, md_file)
+    os.replace(tmp_path, md_path)
+
+def remove_parts(part_paths):
+    for part_path in part_paths:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+def convert_pdfs_to_markdown(pdf_paths, input_root=None, output_dir=None, processes=None, pages_per_part=50, force=False):
+    """Convert PDF files to Markdown, the page ranges of all files are converted in parallel."""
+    parts = {}
+    remaining = {}
+    characters = {}
+    errors = {}
+    tasks = []
+    for pdf_path in pdf_paths:
+        md_path = markdown_path(pdf_path, input_root, output_dir)
+        if not force and is_up_to_date(pdf_path, md_path):
+            print(f"Up to date: {md_path}")
+            continue
+        try:
+            pdf_tasks = plan_conversion(pdf_path, md_path, pages_per_part)
+        except Exception as e:
+            print(f"Failed to read PDF file {pdf_path}: {e}")
+            continue
+        os.makedirs(os.path.dirname(md_path) or ".", exist_ok=True)
+        parts[pdf_path] = (md_path, [task[3] for task in pdf_tasks])
+        remaining[pdf_path] = len(pdf_tasks)
+        characters[pdf_path] = 0
+        tasks.extend(pdf_tasks)
+        if not pdf_tasks:
+            print(f"No pages found in the PDF file {pdf_path}")
+
+    # The largest page ranges first, so no long range is left running alone at the end
+    tasks.sort(key=lambda task: task[2] - task[1], reverse=True)
+    converted = 0
+    with Pool(processes=processes) as pool:
+        for pdf_path, part_characters, error in pool.imap_unordered(convert_page_range, tasks):
+            remaining[pdf_path] -= 1
+            characters[pdf_path] += part_characters
+            if error:
+                errors[pdf_path] = error
+            if remaining[pdf_path]:
+                continue
+            md_path, part_paths = parts[pdf_path]
+            if pdf_path in errors:
+                print(f"Failed to convert PDF file {pdf_path}: {errors[pdf_path]}")
+            elif not characters[pdf_path]:
+                print(f"No readable document items found in the PDF file {pdf_path}")
+            else:
+                try:
+                    assemble_parts(md_path, part_paths)
+                    converted += 1
+                    print(f"Markdown file saved to: {md_path}")
+                except Exception as e:
+                    print(f"Failed to write Markdown file: {e}")
+            remove_parts(part_paths)
+    return converted
 
 def main():
-    parser = argparse.ArgumentParser(description="Convert a PDF file to Markdown format.")
-    parser.add_argument("pdf_file_path", help="Path to the PDF file to be converted.")
+    parser = argparse.ArgumentParser(description="Convert PDF files to Markdown format.")
+    parser.add_argument("inputs", nargs="+", help="PDF files, directories searched recursively or glob patterns.")
+    parser.add_argument("--output-dir", help="Directory of the Markdown files, keeping the input directory structure. Next to each PDF file by default.")
+    parser.add_argument("--processes", type=int, default=None, help="Number of conversion processes, all cores by default.")
+    parser.add_argument("--pages-per-part", type=int, default=50, help="Pages converted by a process at a time, large PDFs are split across processes.")
+    parser.add_argument("--force", action="store_true", help="Convert again the files whose Markdown file is up to date.")
     args = parser.parse_args()
 
-    convert_pdf_to_markdown(args.pdf_file_path)
+    pdf_paths = find_input_files(args.inputs, ".pdf")
+    if not pdf_paths:
+        print("No PDF files found.")
+        sys.exit(1)
+    input_root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in pdf_paths])
+    pdf_paths = [os.path.abspath(path) for path in pdf_paths] if args.output_dir else pdf_paths
+    converted = convert_pdfs_to_markdown(pdf_paths, input_root, args.output_dir, args.processes,
+                                         max(1, args.pages_per_part), args.force)
+    print(f"Converted {converted} of {len(pdf_paths)} PDF files")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from collections import defaultdict
+
+# vaultChat.py lives in the repository root
+REPOSITORY_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, REPOSITORY_ROOT)
+
+
+def read_questions(path):
+    """Questions from a text file, one per line, or from a query trace file written by vaultChat.py."""
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                questions.append(json.loads(line)["query"])
+            else:
+                questions.append(line)
+    return questions
+
+
+def read_traces(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def replay_local(questions, repeat, warmup):
+    """Answer the questions in this process and collect their stage latencies from the query trace file."""
+    import vaultChat
+    from query_metrics import metrics
+
+    qa = vaultChat.build_qa(return_source_documents=True)
+    for query in questions[:warmup]:
+        for _ in vaultChat.stream_answer(qa, query):
+            pass
+
+    trace_file = tempfile.NamedTemporaryFile(prefix="replay_", suffix=".jsonl", delete=False).name
+    metrics.trace_file = trace_file
+    try:
+        for _ in range(repeat):
+            for query in questions:
+                print(f"> {query}", file=sys.stderr)
+                for _ in vaultChat.stream_answer(qa, query):
+                    pass
+        traces = read_traces(trace_file)
+    finally:
+        os.remove(trace_file)
+
+    samples = defaultdict(list)
+    counters = defaultdict(list)
+    for trace in traces:
+        for name, seconds in trace["stages"].items():
+            samples[name].append(seconds)
+        for name, value in trace["counters"].items():
+            if name != "cache_hits":
+                counters[name].append(value)
+        # The trace only records the counter on a hit, its mean is the share of the questions answered from the cache
+        counters["cache_hits"].append(trace["counters"].get("cache_hits", 0))
+    return samples, counters
+
+
+def replay_server(url, questions, repeat, warmup):
+    """Ask a running VaultChat server and measure the latency seen by the client."""
+    import vaultChat
+
+    client = vaultChat.VaultClient(url)
+    samples = defaultdict(list)
+    counters = defaultdict(list)
+    for i, query in enumerate(questions[:warmup] + questions * repeat):
+        start = time.time()
+        stats = {}
+        print(f"> {query}", file=sys.stderr)
+        for _ in vaultChat.client_invoke_streaming(client, query, [], stats):
+            pass
+        if i < warmup:
+            continue
+        samples["total"].append(time.time() - start)
+        if stats.get("first_token_seconds") is not None:
+            samples["first_token"].append(stats["first_token_seconds"])
+            counters["answer_tokens"].append(stats["tokens"])
+        counters["cache_hits"].append(1 if stats.get("cache_hit") else 0)
+    return samples, counters
+
+
+def report(samples, counters, questions):
+    from query_metrics import percentile
+
+    stages = {}
+    for name in sorted(samples):
+        values = samples[name]
+        stages[name] = {"count": len(values),
+                        "mean": sum(values) / len(values),
+                        "p50": percentile(values, 50),
+                        "p95": percentile(values, 95),
+                        "p99": percentile(values, 99),
+                        "max": max(values)}
+    return {"questions": questions,
+            "stages": stages,
+            "counters": {name: {"count": len(values), "mean": sum(values) / len(values)}
+                         for name, values in sorted(counters.items())}}
+
+
+def print_table(result):
+    print(f"{'stage':<20}{'count':>7}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}  (seconds)")
+    for name, stage in result["stages"].items():
+        print(f"{name:<20}{stage['count']:>7}{stage['mean']:>9.3f}{stage['p50']:>9.3f}"
+              f"{stage['p95']:>9.3f}{stage['p99']:>9.3f}{stage['max']:>9.3f}")
+    for name, counter in result["counters"].items():
+        print(f"{name}: mean {counter['mean']:.1f} over {counter['count']} questions")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay questions through VaultChat and report the latency percentiles of each stage.")
+    parser.add_argument("questions", help="Text file with one question per line, or a query trace file written by vaultChat.py")
+    parser.add_argument("--server", metavar="URL", help="Replay against a running VaultChat server, only the client latency is measured")
+    parser.add_argument("--repeat", type=int, default=1, help="Replay the questions this many times")
+    parser.add_argument("--warmup", type=int, default=1, help="Questions answered before the measurement, to load the models")
+    parser.add_argument("--use-cache", action="store_true", help="Keep the answer cache enabled, repeated questions are then cache hits")
+    parser.add_argument("--output", help="Save the results as JSON")
+    args = parser.parse_args()
+
+    questions = read_questions(args.questions)
+    if not questions:
+        sys.exit(f"No questions found in {args.questions}")
+    if not args.use_cache:
+        # The answer cache would answer the replayed questions without running the query path
+        os.environ["ANSWER_CACHE_MAX_ENTRIES"] = "0"
+        if args.server:
+            # The setting only reaches this process, the server answers from its own cache
+            print("Warning: the answer cache of the server stays enabled, start it with ANSWER_CACHE_MAX_ENTRIES=0 "
+                  "to measure the query path", file=sys.stderr)
+
+    if args.server:
+        samples, counters = replay_server(args.server, questions, args.repeat, args.warmup)
+    else:
+        samples, counters = replay_local(questions, args.repeat, args.warmup)
+
+    result = report(samples, counters, len(questions) * args.repeat)
+    print_table(result)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
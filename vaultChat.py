@@ -1,17 +1,19 @@
 #!/usr/bin/env python3
+import time
+STARTED = time.time()
 import os
 import argparse
-import time
-import chromadb
+import json
+import threading
+import contextvars
+import urllib.request
+from concurrent.futures import Future
 from dotenv import load_dotenv
-from chromadb.config import Settings
-from langchain.chains import RetrievalQA
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
-from langchain_community.vectorstores import Chroma
-from langchain_community.llms import Ollama
+from query_metrics import current_trace, metrics
 import logging
 from datetime import datetime
+# langchain, chromadb and the embeddings model are imported when the QA chain is built,
+# in a background thread while the prompt is already shown
 
 # Load environment variables from .env file
 load_dotenv()
@@ -23,9 +25,33 @@ SOURCE_DIRECTORY = os.getenv('SOURCE_DIRECTORY', 'private_documents')
 PERSIST_DIRECTORY = os.getenv("PERSISTENT_DATABASE", "chroma_db")
 ANONYMIZE_TELEMETRY = os.getenv('ANONYMIZE_TELEMETRY', 'True') == 'True'
 TARGET_SOURCE_CHUNKS = int(os.getenv('TARGET_SOURCE_CHUNKS', 5))
-
-# Define anonymize telemetry for Chroma DB
-client = chromadb.Client(Settings(anonymized_telemetry=ANONYMIZE_TELEMETRY))
+HYBRID_SEARCH = os.getenv('HYBRID_SEARCH', 'True') == 'True'
+HYBRID_CANDIDATES = int(os.getenv('HYBRID_CANDIDATES', 20))
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 2000))
+CONTEXT_DEDUP_SIMILARITY = float(os.getenv('CONTEXT_DEDUP_SIMILARITY', 0.8))
+CONTEXT_MMR_LAMBDA = float(os.getenv('CONTEXT_MMR_LAMBDA', 0.7))
+ANSWER_CACHE_SIMILARITY = float(os.getenv('ANSWER_CACHE_SIMILARITY', 0.95))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', 1000))
+ANSWER_CACHE_TTL_HOURS = float(os.getenv('ANSWER_CACHE_TTL_HOURS', 168))
+SERVER_HOST = os.getenv('VAULTCHAT_HOST', '127.0.0.1')
+SERVER_PORT = int(os.getenv('VAULTCHAT_PORT', 8765))
+SERVER_WORKERS = int(os.getenv('VAULTCHAT_SERVER_WORKERS', 4))
+SERVER_MAX_SESSIONS = int(os.getenv('VAULTCHAT_MAX_SESSIONS', 1000))
+SERVER_SESSION_TTL_HOURS = float(os.getenv('VAULTCHAT_SESSION_TTL_HOURS', 24))
+QUERY_TRACE_FILE = os.getenv('QUERY_TRACE_FILE', 'query_traces.jsonl')
+VECTOR_STORE = os.getenv('VECTOR_STORE', 'chroma')
+VECTOR_QUANTIZATION = os.getenv('VECTOR_QUANTIZATION', 'int8')
+VECTOR_PROBES = int(os.getenv('VECTOR_PROBES', 16))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 4))
+QUERY_ENCODER = os.getenv('QUERY_ENCODER', 'torch')
+QUERY_ENCODER_CACHE = os.getenv('QUERY_ENCODER_CACHE', 'query_encoder_cache')
+QUERY_ENCODER_TOLERANCE = float(os.getenv('QUERY_ENCODER_TOLERANCE', 0.01))
+RERANK_MODEL = os.getenv('RERANK_MODEL', '')
+RERANK_CANDIDATES = int(os.getenv('RERANK_CANDIDATES', 50))
+RERANK_BATCH_SIZE = int(os.getenv('RERANK_BATCH_SIZE', 32))
+RERANK_CACHE_SIZE = int(os.getenv('RERANK_CACHE_SIZE', 10000))
+SHARDS = os.getenv('SHARDS', '')
+QUERY_SHARDS = os.getenv('QUERY_SHARDS', '')
 
 def main():
     # Initialize logging
@@ -33,29 +59,129 @@ def main():
 
     # Parse the command line arguments
     args = parse_arguments()
-    
-    # Initialize embeddings and database
-    embeddings = HuggingFaceEmbeddings(model_name=EMBEDDINGS_MODEL_NAME)
-    db = Chroma(persist_directory=PERSIST_DIRECTORY, embedding_function=embeddings)
-    retriever = db.as_retriever(search_kwargs={"k": TARGET_SOURCE_CHUNKS})
-    
-    # Initialize callback handlers
-    callbacks = [StreamingStdOutCallbackHandler()] if args.streaming else []
-    llm = Ollama(model=MODEL, callbacks=callbacks)
-
-    # Setup RetrievalQA chain
-    qa = RetrievalQA.from_chain_type(llm=llm, chain_type="stuff", retriever=retriever, return_source_documents=not args.hide_source)
 
     # Initialize conversation history
     conversation_history = []
 
+    # Per-question stage latencies are appended to the trace file
+    metrics.trace_file = QUERY_TRACE_FILE or None
+
+    if args.server:
+        # Thin client, the models stay warm in the server
+        client = VaultClient(args.server, args.hide_source)
+        interactive_qa(client, args, conversation_history, client_invoke_streaming)
+        return
+
+    if args.batch:
+        from batch_qa import PrecomputedQueryEmbeddings, run_batch
+        embeddings = PrecomputedQueryEmbeddings(create_embeddings())
+        qa = build_qa(return_source_documents=True, embeddings=embeddings, shards=args.shards)
+        run_batch(qa, stream_answer, embeddings, args.batch, args.output, args.concurrency, args.hide_source)
+        return
+
+    if args.serve:
+        from vault_server import run_server
+        qa = build_qa(return_source_documents=True, shards=args.shards)
+        run_server(qa, stream_answer, args.host, args.port, args.workers, SERVER_MAX_SESSIONS, SERVER_SESSION_TTL_HOURS * 3600)
+        return
+
+    qa = BackgroundQA(return_source_documents=not args.hide_source, shards=args.shards)
+
     # Run interactive Q&A
     interactive_qa(qa, args, conversation_history)
 
-def interactive_qa(qa, args, history):
+def create_embeddings():
+    """The query embeddings of EMBEDDINGS_MODEL_NAME, run by the QUERY_ENCODER backend."""
+    from query_encoder import create_query_encoder
+    return create_query_encoder(EMBEDDINGS_MODEL_NAME, QUERY_ENCODER, QUERY_ENCODER_CACHE, QUERY_ENCODER_TOLERANCE)
+
+def open_database(embeddings, shards=""):
+    """
+    The vector store of PERSIST_DIRECTORY, or a fan-out over the selected shards when SHARDS is set,
+    with the lexical index directories and ingestion manifests to go with it.
+    """
+    from vector_store import open_vector_store
+    if not SHARDS:
+        return (open_vector_store(VECTOR_STORE, PERSIST_DIRECTORY, embeddings, VECTOR_QUANTIZATION, VECTOR_PROBES),
+                os.path.join(PERSIST_DIRECTORY, 'lexical_index'), os.path.join(PERSIST_DIRECTORY, 'ingest_manifest.json'))
+    from shards import ShardedVectorStore, parse_shards, select_shards, shard_directory
+    names = select_shards(parse_shards(SHARDS, SOURCE_DIRECTORY), shards)
+    directories = {name: shard_directory(PERSIST_DIRECTORY, name) for name in names}
+    stores = {name: open_vector_store(VECTOR_STORE, directory, embeddings, VECTOR_QUANTIZATION, VECTOR_PROBES)
+              for name, directory in directories.items()}
+    logging.info(f"Searching {len(names)} shards: {', '.join(names)}")
+    return (ShardedVectorStore(stores, embeddings),
+            {name: os.path.join(directory, 'lexical_index') for name, directory in directories.items()},
+            [os.path.join(directory, 'ingest_manifest.json') for directory in directories.values()])
+
+def build_qa(return_source_documents=True, embeddings=None, shards=""):
+    """Initialize the embeddings, database and RetrievalQA chain."""
+    from langchain.chains import RetrievalQA
+    from langchain_community.llms import Ollama
+    from answer_cache import AnswerCache, CachedQA
+    from retrieval import build_retriever
+    from query_tracing import TracedEmbeddings
+    if VECTOR_STORE == 'chroma':
+        # Define anonymize telemetry for Chroma DB
+        import chromadb
+        from chromadb.config import Settings
+        chromadb.Client(Settings(anonymized_telemetry=ANONYMIZE_TELEMETRY))
+
+    # Initialize embeddings and database
+    embeddings = TracedEmbeddings(embeddings or create_embeddings())
+    db, lexical_index_directory, manifest_path = open_database(embeddings, shards)
+    reranker = None
+    if RERANK_MODEL:
+        from reranker import CrossEncoderReranker
+        reranker = CrossEncoderReranker(RERANK_MODEL, RERANK_BATCH_SIZE, RERANK_CACHE_SIZE)
+    retriever = build_retriever(db, TARGET_SOURCE_CHUNKS, HYBRID_SEARCH, lexical_index_directory, HYBRID_CANDIDATES,
+                                CONTEXT_TOKEN_BUDGET, CONTEXT_DEDUP_SIMILARITY, CONTEXT_MMR_LAMBDA,
+                                reranker, RERANK_CANDIDATES)
+    
+    llm = Ollama(model=MODEL)
+
+    # Setup RetrievalQA chain
+    qa = RetrievalQA.from_chain_type(llm=llm, chain_type="stuff", retriever=retriever, return_source_documents=return_source_documents)
+    if ANSWER_CACHE_MAX_ENTRIES <= 0:
+        return qa
+
+    # Repeated and near-duplicate questions are answered from the cache until the documents change
+    # Answers from other shards must not be reused
+    shard_names = ",".join(sorted(lexical_index_directory)) if isinstance(lexical_index_directory, dict) else ""
+    cache = AnswerCache(os.path.join(PERSIST_DIRECTORY, 'answer_cache.sqlite3'), manifest_path,
+                        f"{MODEL}|{EMBEDDINGS_MODEL_NAME}|{TARGET_SOURCE_CHUNKS}|{HYBRID_SEARCH}|{CONTEXT_TOKEN_BUDGET}"
+                        f"{'|' + RERANK_MODEL + '|' + str(RERANK_CANDIDATES) if RERANK_MODEL else ''}"
+                        f"{'|' + shard_names if shard_names else ''}",
+                        embeddings.embed_query, ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_MAX_ENTRIES,
+                        ANSWER_CACHE_TTL_HOURS * 3600)
+    return CachedQA(qa, cache)
+
+class BackgroundQA:
+    """Build the QA chain in a background thread, the first question waits for it."""
+
+    def __init__(self, **kwargs):
+        self.future = Future()
+        self.ready_seconds = None
+        threading.Thread(target=self.build, kwargs=kwargs, daemon=True).start()
+
+    def build(self, **kwargs):
+        try:
+            qa = build_qa(**kwargs)
+            self.ready_seconds = time.time() - STARTED
+            self.future.set_result(qa)
+        except BaseException as e:
+            self.future.set_exception(e)
+
+    def result(self):
+        return self.future.result()
+
+def interactive_qa(qa, args, history, invoke_streaming=None):
     # Usage instructions
-    print(f"\n\033[31;47m>>> Ready for private chat. Exit the session by typing 'exit' or '/bye'. Save the chat by typing '/save <summary_name>'.\033[0m")
+    print(f"\n\033[31;47m>>> Ready for private chat. Exit the session by typing 'exit' or '/bye'. Save the chat by typing '/save <summary_name>'. "
+          f"Show the latency of each stage by typing '/stats'.\033[0m")
     """Run interactive question and answer sessions with your private data."""
+    print(f" >>> Started in {time.time() - STARTED:.2f} seconds")
+    first_answer = isinstance(qa, BackgroundQA)
     while True:
         query = input("\n\033[31;47m>>> Enter a question: \033[0m").strip().lower()  # Normalize the input to handle case-insensitivity
         
@@ -65,36 +191,205 @@ def interactive_qa(qa, args, history):
         elif query.startswith("/save"):
             save_chat_history(history, query)
             continue
+        elif query == "/stats":
+            print(query_stats(qa))
+            continue
         if not query:
             continue
 
         try:
             start = time.time()
-            for output in qa_invoke_streaming(qa, query, history):
+            stats = {}
+            for output in (invoke_streaming or qa_invoke_streaming)(qa, query, history, stats):
                 print(output, end='', flush=True)
             end = time.time()
 
-            print(f"\n >>> Processing time: {end - start:.2f} seconds")
+            print(f"\n >>> Processing time: {end - start:.2f} seconds{format_stats(stats)}")
+            if first_answer:
+                first_answer = False
+                print(f" >>> First answer {end - STARTED:.2f} seconds after the start, "
+                      f"the models were ready after {qa.ready_seconds:.2f} seconds")
         except Exception as e:
             logging.error(f"Error processing query: {e}")
 
-def qa_invoke_streaming(qa, query, history):
-    """Invoke the QA system with streaming output."""
-    result = qa.invoke(query)
-    history.append(f"### Question: {query}\n{result['result']}\n")
-    
-    yield f"\n\n> Question: {query}\n{result['result']}"
-    
-    if 'source_documents' in result:
-        color_code = "\033[94m"  # Bright blue color
-        reset_code = "\033[0m"  # Resets the color to default
-        sources_text = ""
-        for document in result['source_documents']:
-            source_line = f"{color_code}> {document.metadata['source']}{reset_code}"
-            source_content = f"{source_line}:\n{document.page_content}"
-            sources_text += f"\n{source_content}"
-            yield f"\n{source_content}"
-        history[-1] += sources_text
+def format_stats(stats):
+    """Describe the cache hit or the generation speed of an answer."""
+    if stats.get('cache_hit'):
+        return f" (cache hit: {stats['cache_hit']})"
+    if stats.get('first_token_seconds') is None:
+        return ""
+    rerank = f"rerank: {stats['rerank_seconds']:.2f} seconds, " if stats.get('rerank_seconds') is not None else ""
+    prompt = f"prompt: ~{stats['prompt_tokens']} tokens, " if stats.get('prompt_tokens') is not None else ""
+    return (f" ({rerank}{prompt}first token: {stats['first_token_seconds']:.2f} seconds, "
+            f"{stats['tokens']} tokens at {stats['tokens_per_second']:.1f} tokens/sec)")
+
+def query_stats(qa):
+    """Latency summary of the answered questions, of the server when connected to one."""
+    if isinstance(qa, VaultClient):
+        with urllib.request.urlopen(f"{qa.url}/stats") as response:
+            return response.read().decode('utf-8')
+    return metrics.summary()
+
+def build_prompt(chain, query, documents):
+    """The prompt the "stuff" chain sends to the LLM for the question and retrieved documents."""
+    from langchain_core.prompts import format_document
+    combine_chain = chain.combine_documents_chain
+    context_text = combine_chain.document_separator.join(format_document(document, combine_chain.document_prompt)
+                                                         for document in documents)
+    return combine_chain.llm_chain.prompt.format(**{combine_chain.document_variable_name: context_text, "question": query})
+
+def stream_answer(qa, query, config=None):
+    """
+    Answer a question incrementally. Yields ("sources", documents) as soon as the retrieval
+    finishes, then ("token", text) as the LLM generates them, then ("done", stats).
+    The latency of every stage is recorded in the query metrics.
+    """
+    from retrieval import estimate_tokens
+    from query_tracing import OllamaStatsHandler
+    start = time.time()
+    cache = getattr(qa, 'cache', None)
+    chain = getattr(qa, 'qa', qa)
+    embedding = None
+    # The stages timed deeper in the retrieval record into the trace of this question
+    trace = metrics.start(query)
+    context = contextvars.copy_context()
+    context.run(current_trace.set, trace)
+    if cache is not None:
+        result, embedding = context.run(cache.lookup, query, need_sources=chain.return_source_documents)
+        if result is not None:
+            trace.add_stage("cache_lookup", time.time() - start)
+            trace.add_stage("total", time.time() - start)
+            trace.set_counter("cache_hits", 1)
+            metrics.record(trace)
+            yield "sources", result.get('source_documents', [])
+            yield "token", result['result']
+            yield "done", {"cache_hit": result['cache_hit'], "total_seconds": time.time() - start}
+            return
+        trace.add_stage("cache_lookup", time.time() - start)
+
+    retrieval_start = time.time()
+    documents = context.run(chain.retriever.invoke, query, config=config)
+    retrieval_seconds = time.time() - start
+    trace.add_stage("retrieval", time.time() - retrieval_start)
+    trace.set_counter("chunks_in_context", len(documents))
+    yield "sources", documents if chain.return_source_documents else []
+
+    # Build the prompt of the "stuff" chain and stream the LLM directly instead of waiting for the chain
+    prompt_start = time.time()
+    combine_chain = chain.combine_documents_chain
+    prompt = build_prompt(chain, query, documents)
+    trace.add_stage("prompt_assembly", time.time() - prompt_start)
+    prompt_tokens = estimate_tokens(prompt)
+    trace.set_counter("prompt_tokens", prompt_tokens)
+
+    # Ollama reports its prompt evaluation and generation counters at the end of the stream
+    llm_config = dict(config or {})
+    llm_config['callbacks'] = list(llm_config.get('callbacks') or []) + [OllamaStatsHandler(trace)]
+    answer = []
+    first_token = None
+    generation_start = time.time()
+    for token in combine_chain.llm_chain.llm.stream(prompt, config=llm_config):
+        if first_token is None:
+            first_token = time.time()
+        answer.append(token)
+        yield "token", token
+    end = time.time()
+
+    result = {"query": query, "result": "".join(answer)}
+    if chain.return_source_documents:
+        result['source_documents'] = documents
+    if cache is not None:
+        try:
+            cache.store(query, result, embedding)
+        except Exception as e:
+            logging.warning(f"Failed to cache the answer: {e}")
+
+    first_token = first_token or end
+    trace.add_stage("first_token", first_token - generation_start)
+    trace.add_stage("generation", end - first_token)
+    trace.add_stage("total", end - start)
+    trace.set_counter("answer_tokens", len(answer))
+    metrics.record(trace)
+    yield "done", {"cache_hit": None,
+                   "retrieval_seconds": retrieval_seconds,
+                   "rerank_seconds": trace.stages.get("rerank"),
+                   "prompt_tokens": prompt_tokens,
+                   "first_token_seconds": first_token - start,
+                   "tokens": len(answer),
+                   "tokens_per_second": len(answer) / (end - first_token) if end > first_token else 0.0,
+                   "total_seconds": end - start}
+
+def qa_invoke_streaming(qa, query, history, stats=None):
+    """Invoke the QA system with streaming output, sources first and then the answer as it is generated."""
+    color_code = "\033[94m"  # Bright blue color
+    reset_code = "\033[0m"  # Resets the color to default
+    sources_text = ""
+    if isinstance(qa, BackgroundQA):
+        qa = qa.result()
+    history.append(f"### Question: {query}\n")
+    for event, data in stream_answer(qa, query):
+        if event == "sources":
+            yield f"\n\n> Question: {query}"
+            for document in data:
+                source_line = f"{color_code}> {document.metadata['source']}{reset_code}"
+                source_content = f"{source_line}:\n{document.page_content}"
+                sources_text += f"\n{source_content}"
+                yield f"\n{source_content}"
+            yield "\n\n> Answer:\n"
+        elif event == "token":
+            history[-1] += data
+            yield data
+        elif event == "done" and stats is not None:
+            stats.update(data)
+    history[-1] += f"\n{sources_text}"
+
+class VaultClient:
+    """Connection details and session of a running VaultChat server."""
+
+    def __init__(self, url, hide_source=False):
+        self.url = url.rstrip('/')
+        self.hide_source = hide_source
+        self.session = None
+
+def read_server_events(response):
+    """Parse server-sent events from a streaming HTTP response."""
+    event, data = None, []
+    for raw_line in response:
+        line = raw_line.decode('utf-8').rstrip('\n')
+        if line.startswith('event:'):
+            event = line[len('event:'):].strip()
+        elif line.startswith('data:'):
+            data.append(line[len('data:'):].strip())
+        elif not line and event:
+            yield event, json.loads('\n'.join(data))
+            event, data = None, []
+
+def client_invoke_streaming(client, query, history, stats=None):
+    """Ask a VaultChat server and stream its answer as it is generated."""
+    payload = json.dumps({"question": query, "session": client.session}).encode('utf-8')
+    request = urllib.request.Request(f"{client.url}/ask", data=payload, headers={"Content-Type": "application/json"})
+    color_code = "\033[94m"  # Bright blue color
+    reset_code = "\033[0m"  # Resets the color to default
+    sources_text = ""
+    with urllib.request.urlopen(request) as response:
+        yield f"\n\n> Question: {query}"
+        history.append(f"### Question: {query}\n")
+        for event, data in read_server_events(response):
+            if event == "session":
+                client.session = data
+            elif event == "sources":
+                for source in ([] if client.hide_source else data):
+                    sources_text += f"\n> {source['source']}:\n{source['content']}"
+                    yield f"\n{color_code}> {source['source']}{reset_code}:\n{source['content']}"
+                yield "\n\n> Answer:\n"
+            elif event == "token":
+                history[-1] += data
+                yield data
+            elif event == "done" and stats is not None:
+                stats.update(data)
+            elif event == "error":
+                raise RuntimeError(data)
+        history[-1] += f"\n{sources_text}"
 
 # def save_chat_history(history, query):
 #     """Save the chat history to a markdown file."""
@@ -134,7 +429,16 @@ def parse_arguments():
     """Parse command-line arguments."""
     parser = argparse.ArgumentParser(description='VaultChat: Ask questions about your documents via a LLM.')
     parser.add_argument("--hide-source", "-S", action='store_true', help='Disable printing of source documents used for answers.')
-    parser.add_argument("--streaming", action='store_true', help='Enable the streaming from LLMs.')
+    parser.add_argument("--streaming", action='store_true', help='Deprecated, answers are always streamed as they are generated.')
+    parser.add_argument("--serve", action='store_true', help='Run a VaultChat server keeping the models warm for many concurrent sessions.')
+    parser.add_argument("--host", default=SERVER_HOST, help='Address the server listens on.')
+    parser.add_argument("--port", type=int, default=SERVER_PORT, help='Port the server listens on.')
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS, help='Number of questions the server answers concurrently.')
+    parser.add_argument("--server", metavar="URL", help='Chat through a running VaultChat server, e.g. http://127.0.0.1:8765')
+    parser.add_argument("--batch", metavar="FILE", help='Answer the questions of a file, one per line, or of stdin with "-", without interaction.')
+    parser.add_argument("--output", default="batch_answers.jsonl", help='JSON-lines file of the batch answers, an interrupted batch resumes from it.')
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help='Number of batch answers generated by Ollama at a time.')
+    parser.add_argument("--shards", default=QUERY_SHARDS, help='Comma-separated shards to search when SHARDS is set, all shards by default.')
     return parser.parse_args()
 
 if __name__ == "__main__":
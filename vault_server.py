@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+import json
+import time
+import uuid
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+from urllib.parse import urlsplit
+
+from query_metrics import metrics
+
+# Keep the request head small, questions are short
+MAX_HEADER_BYTES = 64 * 1024
+MAX_BODY_BYTES = 1024 * 1024
+
+
+class Session:
+    """History of a session, its questions are answered one at a time."""
+
+    def __init__(self):
+        self.history: List[str] = []
+        self.lock = asyncio.Lock()
+        self.last_used = time.time()
+
+
+class VaultServer:
+    """
+    Long-lived VaultChat server, the embeddings model, vectorstore and chain stay warm
+    between questions. Each session keeps its own history, questions of different
+    sessions run concurrently in a thread pool and answers stream as server-sent events.
+    Idle sessions are evicted by least recent use and age.
+    """
+
+    def __init__(self, qa, stream_answer: Callable, workers: int = 4, max_sessions: int = 1000,
+                 session_ttl_seconds: float = 24 * 3600):
+        self.qa = qa
+        self.stream_answer = stream_answer
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="vaultchat")
+        self.max_sessions = max_sessions
+        self.session_ttl_seconds = session_ttl_seconds
+        self.sessions: "OrderedDict[str, Session]" = OrderedDict()
+
+    def session(self, name: str) -> Session:
+        """The session of that name, created when missing, after evicting expired and least recently used sessions."""
+        now = time.time()
+        session = self.sessions.pop(name, None) or Session()
+        session.last_used = now
+        idle = [key for key, other in self.sessions.items() if not other.lock.locked()]
+        for key in idle:
+            if now - self.sessions[key].last_used > self.session_ttl_seconds:
+                del self.sessions[key]
+        # Oldest first, sessions answering a question are kept
+        for key in [key for key in idle if key in self.sessions]:
+            if len(self.sessions) < self.max_sessions:
+                break
+            del self.sessions[key]
+        self.sessions[name] = session
+        return session
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            method, path, body = await self.read_request(reader)
+            route = urlsplit(path).path.rstrip("/")
+            if method == "GET" and route == "/health":
+                await self.send_json(writer, 200, {"status": "ok", "sessions": len(self.sessions)})
+            elif method == "GET" and route == "/metrics":
+                await self.send_text(writer, 200, metrics.prometheus(), "text/plain; version=0.0.4")
+            elif method == "GET" and route == "/stats":
+                await self.send_text(writer, 200, metrics.summary() + "\n", "text/plain")
+            elif method == "POST" and route == "/ask":
+                await self.handle_ask(writer, json.loads(body or b"{}"))
+            elif method == "GET" and route.startswith("/sessions/") and route.endswith("/history"):
+                session = route[len("/sessions/"):-len("/history")]
+                if session not in self.sessions:
+                    await self.send_json(writer, 404, {"error": f"Unknown session: {session}"})
+                else:
+                    await self.send_json(writer, 200, {"session": session, "history": self.sessions[session].history})
+            else:
+                await self.send_json(writer, 404, {"error": f"Not found: {method} {path}"})
+        except (ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+            await self.send_json(writer, 400, {"error": f"Bad request: {e}"})
+        except ConnectionError:
+            pass
+        except Exception as e:
+            logging.error(f"Error handling request: {e}", exc_info=True)
+        finally:
+            writer.close()
+
+    async def read_request(self, reader: asyncio.StreamReader) -> Tuple[str, str, bytes]:
+        head = await reader.readuntil(b"\r\n\r\n")
+        if len(head) > MAX_HEADER_BYTES:
+            raise ValueError("request head too large")
+        request_line, *header_lines = head.decode("latin-1").split("\r\n")
+        method, path, _ = request_line.split(" ", 2)
+        headers = {}
+        for line in header_lines:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY_BYTES:
+            raise ValueError("request body too large")
+        body = await reader.readexactly(length) if length else b""
+        return method.upper(), path, body
+
+    async def send_json(self, writer: asyncio.StreamWriter, status: int, payload: Dict) -> None:
+        await self.send_text(writer, status, json.dumps(payload), "application/json")
+
+    async def send_text(self, writer: asyncio.StreamWriter, status: int, text: str, content_type: str) -> None:
+        body = text.encode("utf-8")
+        reason = {200: "OK", 400: "Bad Request", 404: "Not Found"}.get(status, "Error")
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+
+    async def send_event(self, writer: asyncio.StreamWriter, event: str, data) -> None:
+        writer.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+        await writer.drain()
+
+    async def handle_ask(self, writer: asyncio.StreamWriter, request: Dict) -> None:
+        query = str(request.get("question", "")).strip().lower()
+        if not query:
+            await self.send_json(writer, 400, {"error": "Missing question"})
+            return
+        name = str(request.get("session") or uuid.uuid4().hex)
+        session = self.session(name)
+        # Concurrent questions of a session would interleave their turns in its history
+        async with session.lock:
+            session.last_used = time.time()
+            await self.answer(writer, query, name, session.history)
+            session.last_used = time.time()
+
+    async def answer(self, writer: asyncio.StreamWriter, query: str, session: str, history: List[str]) -> None:
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Connection: close\r\n\r\n")
+        await self.send_event(writer, "session", session)
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        def run_chain():
+            # Forward the answer events from the chain thread to this request handler
+            try:
+                for event in self.stream_answer(self.qa, query):
+                    loop.call_soon_threadsafe(queue.put_nowait, event)
+            except Exception as e:
+                logging.error(f"Error processing query: {e}", exc_info=True)
+                loop.call_soon_threadsafe(queue.put_nowait, ("error", str(e)))
+
+        loop.run_in_executor(self.executor, run_chain)
+        history.append(f"### Question: {query}\n")
+        sources_text = ""
+        while True:
+            event, data = await queue.get()
+            if event == "sources":
+                sources = [{"source": document.metadata['source'], "content": document.page_content} for document in data]
+                sources_text = "".join(f"\n> {source['source']}:\n{source['content']}" for source in sources)
+                await self.send_event(writer, "sources", sources)
+            elif event == "token":
+                history[-1] += data
+                await self.send_event(writer, "token", data)
+            elif event == "done":
+                history[-1] += f"\n{sources_text}"
+                await self.send_event(writer, "done", data)
+                return
+            else:
+                await self.send_event(writer, "error", data)
+                return
+
+    async def serve_forever(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_HEADER_BYTES)
+        print(f"\n\033[31;47m>>> VaultChat server listening on http://{host}:{port}\033[0m")
+        async with server:
+            await server.serve_forever()
+
+
+def run_server(qa, stream_answer: Callable, host: str, port: int, workers: int, max_sessions: int = 1000,
+               session_ttl_seconds: float = 24 * 3600) -> None:
+    try:
+        asyncio.run(VaultServer(qa, stream_answer, workers, max_sessions, session_ttl_seconds).serve_forever(host, port))
+    except KeyboardInterrupt:
+        print("Server stopped. Goodbye!")
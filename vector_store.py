@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+import os
+import re
+import json
+import sqlite3
+import logging
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+# Below this many vectors a scan of the quantized array beats the IVF index
+MIN_IVF_VECTORS = 10000
+# Candidates of the quantized search rescored with the float32 vectors, per result
+RESCORE_FACTOR = 4
+# Rows scored per matrix product, bounds the memory of a scan
+SCAN_ROWS = 65536
+QUANTIZATIONS = {"none": np.float32, "float16": np.float16, "int8": np.int8}
+# Files rewritten by compaction and indexing, each rewrite writes new files published by a meta commit
+GENERATION_FILES = ('vectors.f32', 'vectors.q', 'lists.i32', 'centroids.npy', 'ivf_rows.npy', 'ivf_offsets.npy')
+GENERATION_FILE = re.compile(f"^({'|'.join(re.escape(name) for name in GENERATION_FILES)})(\\.\\d+)?$")
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first."""
+    if len(scores) <= k:
+        return np.argsort(-scores, kind='stable')
+    best = np.argpartition(-scores, k)[:k]
+    return best[np.argsort(-scores[best], kind='stable')]
+
+
+class MmapVectorStore(VectorStore):
+    """
+    Vector store keeping the normalized embeddings in memory-mapped contiguous arrays:
+    float32 vectors for exact rescoring and a float16 or int8 copy for the scan.
+    Above MIN_IVF_VECTORS an inverted file index of k-means lists restricts the scan
+    to the lists closest to the query. Chunk texts and metadata live in a SQLite side
+    table, only the rows of the results are read. Similarity is the cosine similarity.
+    The get and delete methods follow the Chroma API used by docs_loader.py.
+
+    Every committed write bumps the generation in the meta table, and other processes
+    with the store open reload before their next search. Compaction and indexing write
+    new array files and switch to them in the same SQLite commit as the side table,
+    so readers and a crash never see arrays and rows of different generations.
+    """
+
+    def __init__(self, directory: str, embedding_function: Embeddings, quantization: str = "int8", probes: int = 16):
+        self.directory = directory
+        self.embedding_function = embedding_function
+        self.probes = probes
+        # The connection is shared by the query threads of the server, one statement at a time
+        self.lock = threading.Lock()
+        # Held while the arrays are mapped again or scanned, the query threads of a process share them
+        self.state_lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, 'chunks.sqlite3'), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS chunks (row INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, "
+                        "source TEXT, document TEXT NOT NULL, metadata TEXT NOT NULL, deleted INTEGER NOT NULL DEFAULT 0)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS chunks_source ON chunks (source)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.db.commit()
+        meta = dict(self.db.execute("SELECT key, value FROM meta"))
+        self.quantization = meta.get('quantization', quantization)
+        if self.quantization != quantization:
+            logging.warning(f"{directory} was created with {self.quantization} quantization, ignoring {quantization}")
+        if self.quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown vector quantization: {self.quantization}")
+        self.dimension = int(meta['dimension']) if 'dimension' in meta else None
+        self.reload()
+
+    # Files and state
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def file_path(self, name: str) -> Optional[str]:
+        """Path of a generation file of the current generation, None when it has none."""
+        file_name = self.files.get(name, name)
+        return self.path(file_name) if file_name and os.path.exists(self.path(file_name)) else None
+
+    def new_file(self, name: str, generation: int) -> str:
+        return f"{name}.{generation}"
+
+    def meta(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key: str, value: Any) -> None:
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def open_array(self, name: str, dtype, width: int) -> np.ndarray:
+        # Rows appended after the last committed one, by an interrupted run, are ignored
+        itemsize = np.dtype(dtype).itemsize * width
+        path = self.file_path(name)
+        size = os.path.getsize(path) if path else 0
+        rows = min(self.count, size // itemsize) if itemsize else 0
+        if not rows:
+            return np.zeros((0, width), dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(rows, width))
+
+    def stored_generation(self) -> int:
+        with self.lock:
+            return int(self.meta('generation', 0))
+
+    def reload(self) -> None:
+        """Map the arrays written so far and load the deleted rows and the IVF lists."""
+        with self.state_lock, self.lock:
+            # One read transaction, a commit of another process lands before or after all of it
+            started = not self.db.in_transaction
+            if started:
+                self.db.execute("BEGIN")
+            try:
+                meta = dict(self.db.execute("SELECT key, value FROM meta"))
+                self.count = self.db.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM chunks").fetchone()[0]
+                self.deleted = np.array([row for (row,) in self.db.execute("SELECT row FROM chunks WHERE deleted = 1")], dtype=np.int64)
+            finally:
+                if started:
+                    self.db.rollback()
+            self.generation = int(meta.get('generation', 0))
+            self.files = {name: meta.get(f'file:{name}', name) for name in GENERATION_FILES}
+            if self.dimension is None and 'dimension' in meta:
+                self.dimension = int(meta['dimension'])
+            width = self.dimension or 0
+            self.vectors = self.open_array('vectors.f32', np.float32, width)
+            self.codes = self.vectors if self.quantization == "none" else self.open_array('vectors.q', QUANTIZATIONS[self.quantization], width)
+            self.scales = np.load(self.path('scales.npy')) if os.path.exists(self.path('scales.npy')) else None
+            self.centroids = np.load(self.file_path('centroids.npy')) if self.file_path('centroids.npy') else None
+            self.assignments = self.open_array('lists.i32', np.int32, 1)[:, 0] if self.centroids is not None else None
+            self.indexed_count = int(meta.get('indexed_count', 0))
+            if self.centroids is not None and self.file_path('ivf_rows.npy'):
+                self.ivf_rows = np.load(self.file_path('ivf_rows.npy'), mmap_mode='r')
+                self.ivf_offsets = np.load(self.file_path('ivf_offsets.npy'))
+            else:
+                self.ivf_rows, self.ivf_offsets, self.indexed_count = None, None, 0
+
+    def refresh(self) -> None:
+        """Reload when another process committed a write since the arrays were mapped."""
+        if self.stored_generation() != self.generation:
+            self.reload()
+
+    def commit(self, files: Optional[Dict[str, str]] = None) -> None:
+        """Commit the pending writes as a new generation, switching to the given generation files."""
+        generation = int(self.meta('generation', 0)) + 1
+        for name, file_name in (files or {}).items():
+            self.set_meta(f'file:{name}', file_name)
+        self.set_meta('generation', generation)
+        self.db.commit()
+        self.reload()
+        if not files:
+            return
+        # Remove the replaced files and those of an interrupted rewrite. Readers keep their
+        # mapping of a removed file until they reload, Windows refuses to remove it
+        current = set(self.files.values())
+        for file_name in os.listdir(self.directory):
+            if GENERATION_FILE.match(file_name) and file_name not in current:
+                try:
+                    os.remove(self.path(file_name))
+                except OSError:
+                    pass
+
+    def __len__(self) -> int:
+        return self.count - len(self.deleted)
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding_function
+
+    # Writing, used by docs_loader.py
+
+    def quantize(self, vectors: np.ndarray) -> np.ndarray:
+        if self.quantization == "float16":
+            return vectors.astype(np.float16)
+        if self.scales is None:
+            # Per-dimension scales from the first vectors, with headroom for later ones
+            self.scales = np.maximum(np.abs(vectors).max(axis=0) * 1.25, 1e-6).astype(np.float32) / 127
+            np.save(self.path('scales.npy'), self.scales)
+        return np.clip(np.rint(vectors / self.scales), -127, 127).astype(np.int8)
+
+    def append_array(self, name: str, rows: np.ndarray) -> None:
+        with open(self.path(self.files.get(name, name)), 'ab') as f:
+            # Drop the rows of an interrupted run, their chunks were never committed to the side table
+            f.truncate(self.count * rows[0].nbytes)
+            f.write(rows.tobytes())
+
+    def add_embeddings(self, ids: List[str], texts: List[str], metadatas: List[Dict], vectors: np.ndarray) -> List[str]:
+        """Store chunks with their precomputed embeddings."""
+        vectors = normalize(np.asarray(vectors, dtype=np.float32))
+        if self.dimension is None:
+            self.dimension = vectors.shape[1]
+            self.set_meta('dimension', self.dimension)
+            self.set_meta('quantization', self.quantization)
+        # A chunk id stored again replaces its previous version
+        self.delete_rows([row for (row,) in self.db.execute(
+            f"SELECT row FROM chunks WHERE deleted = 0 AND id IN ({','.join('?' * len(ids))})", ids)])
+        self.db.execute("UPDATE chunks SET id = '#' || row WHERE deleted = 1 AND id IN "
+                        f"({','.join('?' * len(ids))})", ids)
+        self.append_array('vectors.f32', vectors)
+        if self.quantization != "none":
+            self.append_array('vectors.q', self.quantize(vectors))
+        if self.centroids is not None:
+            self.append_array('lists.i32', np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32))
+        rows = range(self.count, self.count + len(ids))
+        self.db.executemany("INSERT INTO chunks (row, id, source, document, metadata) VALUES (?, ?, ?, ?, ?)",
+                            [(row, chunk_id, (metadata or {}).get('source'), text, json.dumps(metadata or {}))
+                             for row, chunk_id, text, metadata in zip(rows, ids, texts, metadatas)])
+        self.commit()
+        return list(ids)
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[Dict]] = None,
+                  ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = metadatas or [{} for _ in texts]
+        if ids is None:
+            import uuid
+            ids = [str(uuid.uuid4()) for _ in texts]
+        vectors = np.array(self.embedding_function.embed_documents(texts), dtype=np.float32)
+        return self.add_embeddings(ids, texts, metadatas, vectors)
+
+    def delete_rows(self, rows: List[int]) -> None:
+        for i in range(0, len(rows), 500):
+            batch = rows[i:i+500]
+            self.db.execute(f"UPDATE chunks SET deleted = 1 WHERE row IN ({','.join('?' * len(batch))})", batch)
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        ids = list(ids or [])
+        for i in range(0, len(ids), 500):
+            batch = ids[i:i+500]
+            self.db.execute(f"UPDATE chunks SET deleted = 1 WHERE id IN ({','.join('?' * len(batch))})", batch)
+        self.commit()
+        return True
+
+    def build_index(self) -> None:
+        """
+        Compact the deleted rows away and build the IVF lists of every vector, the k-means
+        centroids are trained again when the store grew fourfold since they were trained.
+        Called by docs_loader.py at the end of an ingestion run.
+        """
+        if len(self.deleted) > self.count // 4:
+            self.compact()
+        if self.count < MIN_IVF_VECTORS:
+            return
+        if self.centroids is None or self.count > 4 * int(self.meta('trained_count', 0)):
+            self.train_centroids()
+        assignments = np.asarray(self.assignments)
+        order = np.argsort(assignments, kind='stable').astype(np.int64)
+        offsets = np.searchsorted(assignments[order], np.arange(len(self.centroids) + 1)).astype(np.int64)
+        generation = self.generation + 1
+        files = {name: self.new_file(name, generation) for name in ('ivf_rows.npy', 'ivf_offsets.npy')}
+        # np.save would add .npy to a name without it
+        with open(self.path(files['ivf_rows.npy']), 'wb') as f:
+            np.save(f, order)
+        with open(self.path(files['ivf_offsets.npy']), 'wb') as f:
+            np.save(f, offsets)
+        self.set_meta('indexed_count', len(assignments))
+        self.commit(files)
+
+    def train_centroids(self, iterations: int = 10, seed: int = 42) -> None:
+        num_lists = int(min(65536, max(16, np.sqrt(self.count))))
+        rng = np.random.default_rng(seed)
+        sample = np.asarray(self.vectors[np.sort(rng.choice(self.count, min(self.count, num_lists * 64), replace=False))])
+        centroids = sample[rng.choice(len(sample), num_lists, replace=False)]
+        # Spherical k-means, centroids are kept normalized for the cosine similarity
+        for _ in range(iterations):
+            nearest = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, nearest, sample)
+            empty = np.flatnonzero(~sums.any(axis=1))
+            sums[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+            centroids = normalize(sums)
+        assignments = np.concatenate([np.argmax(self.vectors[i:i+SCAN_ROWS] @ centroids.T, axis=1)
+                                      for i in range(0, self.count, SCAN_ROWS)]).astype(np.int32)
+        generation = self.generation + 1
+        # The lists of the old centroids are unusable, so is their index
+        files = {'centroids.npy': self.new_file('centroids.npy', generation), 'lists.i32': self.new_file('lists.i32', generation),
+                 'ivf_rows.npy': '', 'ivf_offsets.npy': ''}
+        with open(self.path(files['centroids.npy']), 'wb') as f:
+            np.save(f, centroids.astype(np.float32))
+        assignments.tofile(self.path(files['lists.i32']))
+        self.set_meta('trained_count', self.count)
+        self.set_meta('indexed_count', 0)
+        self.commit(files)
+
+    def compact(self) -> None:
+        """
+        Rewrite the arrays and the side table without the deleted rows. The arrays of the
+        new generation are written aside, and the renumbered rows and the new file names
+        are committed together, an interrupted compaction leaves the store as it was.
+        """
+        alive = np.setdiff1d(np.arange(self.count), self.deleted)
+        generation = self.generation + 1
+        files = {}
+        for name, array in (('vectors.f32', self.vectors), ('vectors.q', self.codes), ('lists.i32', self.assignments)):
+            if not self.file_path(name) or array is None:
+                continue
+            files[name] = self.new_file(name, generation)
+            with open(self.path(files[name]), 'wb') as f:
+                for i in range(0, len(alive), SCAN_ROWS):
+                    f.write(np.ascontiguousarray(array[alive[i:i+SCAN_ROWS]]).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        files.update({'ivf_rows.npy': '', 'ivf_offsets.npy': ''})
+        self.db.execute("DELETE FROM chunks WHERE deleted = 1")
+        self.db.execute("CREATE TEMP TABLE renumber AS SELECT row AS old_row, ROW_NUMBER() OVER (ORDER BY row) - 1 AS new_row FROM chunks")
+        # Negative rows first so the renumbering never collides with an existing row
+        self.db.execute("UPDATE chunks SET row = -1 - (SELECT new_row FROM renumber WHERE old_row = chunks.row)")
+        self.db.execute("UPDATE chunks SET row = -1 - row")
+        self.db.execute("DROP TABLE renumber")
+        self.set_meta('indexed_count', 0)
+        self.commit(files)
+
+    # Reading
+
+    def get(self, ids: Optional[List[str]] = None, where: Optional[Dict] = None, limit: Optional[int] = None,
+            offset: Optional[int] = None, include: Optional[List[str]] = None, **kwargs: Any) -> Dict[str, List]:
+        """Chroma-style get, where supports {"source": value} and {"source": {"$in": [...]}}."""
+        include = ["metadatas", "documents"] if include is None else include
+        clauses, params = ["deleted = 0"], []
+        if ids is not None:
+            clauses.append(f"id IN ({','.join('?' * len(ids))})")
+            params.extend(ids)
+        for key, condition in (where or {}).items():
+            if key != 'source':
+                raise ValueError(f"Unsupported where clause on {key}")
+            values = condition['$in'] if isinstance(condition, dict) else [condition]
+            clauses.append(f"source IN ({','.join('?' * len(values))})")
+            params.extend(values)
+        query = f"SELECT id, document, metadata FROM chunks WHERE {' AND '.join(clauses)} ORDER BY row"
+        if limit is not None or offset:
+            query += " LIMIT ? OFFSET ?"
+            params.extend([limit if limit is not None else -1, offset or 0])
+        with self.lock:
+            rows = self.db.execute(query, params).fetchall()
+        result = {"ids": [chunk_id for chunk_id, _, _ in rows]}
+        if "documents" in include:
+            result["documents"] = [document for _, document, _ in rows]
+        if "metadatas" in include:
+            result["metadatas"] = [json.loads(metadata) for _, _, metadata in rows]
+        return result
+
+    def candidate_rows(self, query: np.ndarray) -> Optional[np.ndarray]:
+        """Rows of the IVF lists closest to the query and the rows added since the index was built, None to scan all."""
+        if self.ivf_rows is None:
+            return None
+        lists = top_k(self.centroids @ query, self.probes)
+        rows = [self.ivf_rows[self.ivf_offsets[i]:self.ivf_offsets[i + 1]] for i in lists]
+        rows.append(np.arange(self.indexed_count, self.count))
+        return np.sort(np.concatenate(rows))
+
+    def search_by_vector(self, vector: List[float], k: int) -> List[Tuple[int, float]]:
+        """Return the rows and cosine similarities of the k most similar live chunks."""
+        return self.search_rows(vector, k)[1]
+
+    def search_rows(self, vector: List[float], k: int) -> Tuple[int, List[Tuple[int, float]]]:
+        """The generation searched, with the latest writes of other processes, and its matches."""
+        with self.state_lock:
+            self.refresh()
+            return self.generation, self.scan(vector, k)
+
+    def scan(self, vector: List[float], k: int) -> List[Tuple[int, float]]:
+        if not len(self) or self.dimension is None:
+            return []
+        query = normalize(np.asarray(vector, dtype=np.float32)[None, :])[0]
+        # The scales of int8 codes are folded into the query
+        scan_query = query * self.scales if self.quantization == "int8" else query
+        rows = self.candidate_rows(query)
+        fetch = k * RESCORE_FACTOR if self.quantization != "none" else k
+        candidates, scores = [], []
+        total = self.count if rows is None else len(rows)
+        for i in range(0, total, SCAN_ROWS):
+            block_rows = np.arange(i, min(i + SCAN_ROWS, total)) if rows is None else rows[i:i + SCAN_ROWS]
+            codes = self.codes[i:i + len(block_rows)] if rows is None else self.codes[block_rows]
+            block_scores = codes.astype(np.float32) @ scan_query
+            if len(self.deleted):
+                block_scores[np.isin(block_rows, self.deleted)] = -np.inf
+            best = top_k(block_scores, fetch)
+            candidates.append(block_rows[best])
+            scores.append(block_scores[best])
+        candidates, scores = np.concatenate(candidates), np.concatenate(scores)
+        best = top_k(scores, fetch)
+        candidates, scores = candidates[best], scores[best]
+        candidates = candidates[np.isfinite(scores)]
+        if self.quantization != "none":
+            # Rescore the candidates with the float32 vectors
+            order = np.sort(candidates)
+            exact = np.asarray(self.vectors[order]) @ query
+            best = top_k(exact, k)
+            return [(int(order[i]), float(exact[i])) for i in best]
+        return [(int(row), float(score)) for row, score in zip(candidates[:k], scores[:k])]
+
+    def documents_by_rows(self, rows: List[int], generation: Optional[int] = None) -> Optional[Dict[int, Document]]:
+        """The documents of rows, None when the store is no longer at the given generation."""
+        if not rows:
+            return {}
+        with self.lock:
+            # One read transaction, the generation and the rows come from the same snapshot
+            started = not self.db.in_transaction
+            if started:
+                self.db.execute("BEGIN")
+            try:
+                stored_generation = int(self.meta('generation', 0))
+                result = self.db.execute(f"SELECT row, document, metadata FROM chunks WHERE row IN ({','.join('?' * len(rows))})", rows).fetchall()
+            finally:
+                if started:
+                    self.db.rollback()
+        if generation is not None and stored_generation != generation:
+            return None
+        return {row: Document(page_content=document, metadata=json.loads(metadata)) for row, document, metadata in result}
+
+    def similarity_search_by_vector_with_score(self, embedding: List[float], k: int = 4) -> List[Tuple[Document, float]]:
+        # Rows are renumbered by a compaction, search again when one was committed in between
+        for attempt in range(3):
+            generation, matches = self.search_rows(embedding, k)
+            documents = self.documents_by_rows([row for row, _ in matches], None if attempt == 2 else generation)
+            if documents is not None:
+                return [(documents[row], score) for row, score in matches if row in documents]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_by_vector_with_score(embedding, k)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self.embedding_function.embed_query(query), k)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_with_score(query, k)]
+
+    def _select_relevance_score_fn(self):
+        return lambda score: (score + 1) / 2
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[Dict]] = None,
+                   ids: Optional[List[str]] = None, persist_directory: str = "vectors", **kwargs: Any) -> "MmapVectorStore":
+        store = cls(persist_directory, embedding, **kwargs)
+        store.add_texts(texts, metadatas, ids)
+        return store
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def vector_store_directory(persist_directory: str) -> str:
+    return os.path.join(persist_directory, 'vectors')
+
+
+def vector_store_exists(kind: str, persist_directory: str) -> bool:
+    if kind == 'mmap':
+        return os.path.exists(os.path.join(vector_store_directory(persist_directory), 'chunks.sqlite3'))
+    return os.path.exists(os.path.join(persist_directory, 'chroma.sqlite3'))
+
+
+def open_vector_store(kind: str, persist_directory: str, embeddings: Embeddings,
+                      quantization: str = "int8", probes: int = 16) -> VectorStore:
+    """The vector store selected by VECTOR_STORE, "chroma" or "mmap", created when missing."""
+    if kind == 'mmap':
+        return MmapVectorStore(vector_store_directory(persist_directory), embeddings, quantization, probes)
+    if kind != 'chroma':
+        raise ValueError(f"Unknown VECTOR_STORE: {kind}")
+    from langchain_community.vectorstores import Chroma
+    return Chroma(persist_directory=persist_directory, embedding_function=embeddings)